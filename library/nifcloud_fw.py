@@ -17,15 +17,20 @@
 
 import base64
 import copy
+import csv
 import hashlib
 import hmac
+import json
+import os
 import sys
+import tempfile
 import time
 import xml.etree.ElementTree as etree
+from multiprocessing.pool import ThreadPool
 
 import requests
 from ansible.module_utils.basic import *  # noqa
-from ansible.module_utils.six import text_type
+from ansible.module_utils.six import string_types, text_type
 
 try:
     # Python 2
@@ -34,6 +39,24 @@ except ImportError:
     # Python 3
     from urllib.parse import quote, urlencode
 
+try:
+    import ipaddress
+    HAS_IPADDRESS = True
+except ImportError:
+    HAS_IPADDRESS = False
+
+try:
+    import fcntl
+    HAS_FCNTL = True
+except ImportError:
+    HAS_FCNTL = False
+
+try:
+    import yaml
+    HAS_YAML = True
+except ImportError:
+    HAS_YAML = False
+
 try:
     # Python 2
     unicode  # noqa
@@ -64,7 +87,8 @@ options:
     group_name:
         description:
             - Target firewall group ID
-        required: true
+            - Required unless security_groups is given
+        required: false
         aliases: "name"
     description:
         description:
@@ -85,6 +109,16 @@ options:
         description:
             - List of rules that allows incoming or outgoing communication to resources
         default: null
+    ip_permissions_file:
+        description:
+            - Path of a file of rules read in addition to ip_permissions. It is read one rule at a time on the host running the module
+        required: false
+        default: null
+    ip_permissions_file_format:
+        description:
+            - Format of ip_permissions_file ("csv", "jsonl" or "yaml"). Guessed from the file extension if not specified
+        required: false
+        default: null
     state:
         description:
             - Goal status ("present")
@@ -100,6 +134,84 @@ options:
             - Authorize ip_permissions for each group. Instead of taking a short time, It will shorten the execution time, but will not guarantee the order of ip_permission instead
         required: false
         default: 'false'
+    compact_ip_permissions:
+        description:
+            - Merge adjacent or overlapping CIDR blocks and contiguous port ranges of ip_permissions before comparing with current rules (requires ipaddress)
+        required: false
+        default: 'false'
+    ip_permissions_strategy:
+        description:
+            - How to apply the difference of ip_permissions ("incremental": authorize then revoke, "replace": revoke then authorize, "chunked": authorize and revoke alternately per ip_permissions_per_request rules, "pipelined": revoke right after the last authorize request and wait once, "auto": the cheapest safe one of them)
+        required: false
+        default: 'incremental'
+    ip_permissions_per_request:
+        description:
+            - The upper limit number of ip_permissions sent with one authorize/revoke request by the "chunked" strategy. The other strategies do not split the requests, and "auto" does not select them when a request exceeds the limit
+        required: false
+        default: null
+    wait_timeout:
+        description:
+            - Seconds to wait for the firewall group to be applied after each change
+        required: false
+        default: 100
+    wait_interval:
+        description:
+            - Seconds of the first interval to poll the firewall group status (doubled on each retry)
+        required: false
+        default: 1
+    wait_max_interval:
+        description:
+            - The upper limit seconds of the interval to poll the firewall group status
+        required: false
+        default: 10
+    coalesce:
+        description:
+            - Share one reconcile among the forks on the control node applying the same firewall group with the same parameters. One fork applies the changes and the others reuse its result
+        required: false
+        default: 'false'
+    coalesce_dir:
+        description:
+            - Directory of the lock and result files for coalesce
+        required: false
+        default: '(temporary directory)/ansible-nifcloud-fw'
+    coalesce_ttl:
+        description:
+            - Seconds for which a coalesced result is reused
+        required: false
+        default: 60
+    coalesce_timeout:
+        description:
+            - Seconds to wait for the fork applying the changes
+        required: false
+        default: 1800
+    fingerprint_cache:
+        description:
+            - Skip the detailed diff when ip_permissions and other options are unchanged since the last run and the firewall group is the same as observed then. A hit still sends one DescribeSecurityGroups, and saves parsing the rules, the diff and the authorize/revoke requests
+        required: false
+        default: false
+    fingerprint_cache_dir:
+        description:
+            - Directory of the fingerprint files on the host running the module
+        required: false
+        default: '(temporary directory)/ansible-nifcloud-fw-fingerprint'
+    fingerprint_cache_max_age:
+        description:
+            - Seconds for which a fingerprint is used. The detailed diff runs at least once in this period
+        required: false
+        default: 300
+    security_groups:
+        description:
+            - List of firewall groups to apply in parallel instead of group_name
+            - Each item takes group_name, description, availability_zone, log_limit, ip_permissions, ip_permissions_file and ip_permissions_file_format
+            - Other options are shared by all groups. coalesce and fingerprint_cache can not be used with it
+            - Rules referencing a group of the list are applied after the group is created
+        required: false
+        default: null
+    max_workers:
+        description:
+            - Number of firewall groups applied concurrently with security_groups
+        required: false
+        default: 10
 '''  # noqa
 
 EXAMPLES = '''
@@ -107,6 +219,48 @@ EXAMPLES = '''
 '''  # noqa
 
 
+IP_PERMISSION_KEYS = ('in_out', 'ip_protocol', 'from_port', 'to_port',
+                      'cidr_ip', 'group_name', 'description')
+
+IP_PERMISSIONS_STRATEGIES = ['incremental', 'replace', 'chunked', 'pipelined']
+
+# default policy to wait for processing of the firewall group
+WAIT_TIMEOUT = 100
+WAIT_INTERVAL = 1
+WAIT_MAX_INTERVAL = 10
+WAIT_BACKOFF_FACTOR = 2
+WAIT_IMMEDIATE_POLL_RULES = 10
+
+# forks applying the same firewall group share one reconcile
+COALESCE_DIR = os.path.join(tempfile.gettempdir(), 'ansible-nifcloud-fw')
+COALESCE_TTL = 60
+COALESCE_TIMEOUT = 1800
+COALESCE_POLL_INTERVAL = 0.5
+
+# unchanged firewall groups are skipped with the fingerprint of the last run
+FINGERPRINT_CACHE_DIR = os.path.join(tempfile.gettempdir(),
+                                     'ansible-nifcloud-fw-fingerprint')
+FINGERPRINT_CACHE_MAX_AGE = 300
+
+# parameters of each firewall group in the multi-group mode,
+# which are not inherited from the module parameters
+SECURITY_GROUP_SPEC_DEFAULTS = dict(
+    group_name=None,
+    description=None,
+    availability_zone=None,
+    log_limit=None,
+    ip_permissions=[],
+    ip_permissions_file=None,
+    ip_permissions_file_format=None,
+)
+
+MAX_WORKERS = 10
+
+# rough costs to compare strategies of applying ip_permissions
+ESTIMATED_SECONDS_PER_REQUEST = 1
+ESTIMATED_SECONDS_PER_WAIT = 10
+
+
 def calculate_signature(secret_access_key, method, endpoint, path, params):
     payload = ''
     for v in sorted(params.items()):
@@ -216,14 +370,335 @@ def contains_ip_permissions(ip_permissions, target_ip_permission):
     return False
 
 
+def _get_ip_permission_index_key(ip_permission):
+    return tuple(
+        ip_permission.get(key) for key in
+        ('in_out', 'ip_protocol', 'group_name', 'cidr_ip', 'from_port')
+    )
+
+
 def except_ip_permissions(ip_permissions_a, ip_permissions_b):
+    # ip_permissions_b is indexed by the attributes compared with equality,
+    # so that only the rules in the same bucket are compared in detail.
+    index = dict()
+    for ip_permission_b in ip_permissions_b:
+        key = _get_ip_permission_index_key(ip_permission_b)
+        index.setdefault(key, []).append(ip_permission_b)
+
     ip_permissions = [
         ip_permission_a for ip_permission_a in ip_permissions_a
-        if not contains_ip_permissions(ip_permissions_b, ip_permission_a)
+        if not contains_ip_permissions(
+            index.get(_get_ip_permission_index_key(ip_permission_a), []),
+            ip_permission_a)
     ]
     return ip_permissions
 
 
+def normalize_ip_permission(ip_permission):
+    if not isinstance(ip_permission, dict):
+        raise ValueError(
+            'ip_permission must be a mapping: {0}'.format(ip_permission))
+
+    normalized = dict()
+    for key in IP_PERMISSION_KEYS:
+        value = ip_permission.get(key)
+        if isinstance(value, string_types):
+            value = value.strip()
+        if value is None or value == '':
+            continue
+
+        if key in ('from_port', 'to_port'):
+            value = int(value)
+        elif key in ('in_out', 'ip_protocol'):
+            value = value.upper()
+        normalized[key] = value
+    return normalized
+
+
+def _read_ip_permissions_csv(fp):
+    for row in csv.DictReader(fp):
+        yield row
+
+
+def _read_ip_permissions_json_lines(fp):
+    for line in fp:
+        line = line.strip()
+        if line == '' or line.startswith('#'):
+            continue
+        yield json.loads(line)
+
+
+def _read_ip_permissions_yaml(fp):
+    # each document is a rule or a list of rules
+    try:
+        for document in yaml.safe_load_all(fp):
+            if document is None:
+                continue
+            elif isinstance(document, list):
+                for ip_permission in document:
+                    yield ip_permission
+            else:
+                yield document
+    except yaml.YAMLError as e:
+        raise ValueError(str(e))
+
+
+IP_PERMISSIONS_FILE_READERS = dict(
+    csv=_read_ip_permissions_csv,
+    jsonl=_read_ip_permissions_json_lines,
+    yaml=_read_ip_permissions_yaml,
+)
+
+IP_PERMISSIONS_FILE_EXTENSIONS = {
+    '.csv': 'csv',
+    '.jsonl': 'jsonl',
+    '.ndjson': 'jsonl',
+    '.yml': 'yaml',
+    '.yaml': 'yaml',
+}
+
+
+def get_ip_permissions_file_format(path, file_format=None):
+    if file_format is not None:
+        return file_format
+    extension = os.path.splitext(path)[1].lower()
+    return IP_PERMISSIONS_FILE_EXTENSIONS.get(extension)
+
+
+def load_ip_permissions_file(path, file_format=None):
+    reader = IP_PERMISSIONS_FILE_READERS[
+        get_ip_permissions_file_format(path, file_format)]
+    with open(path, 'r') as fp:
+        for ip_permission in reader(fp):
+            yield normalize_ip_permission(ip_permission)
+
+
+def _get_port_range(ip_permission):
+    from_port = ip_permission.get('from_port')
+    to_port = ip_permission.get('to_port')
+    if from_port is None:
+        return None
+    if to_port is None:
+        to_port = from_port
+    try:
+        return (int(from_port), int(to_port))
+    except (TypeError, ValueError):
+        return None
+
+
+def _get_network(ip_permission):
+    cidr_ip = ip_permission.get('cidr_ip')
+    if cidr_ip is None or ip_permission.get('group_name') is not None:
+        return None
+    try:
+        return ipaddress.ip_network(unicode(cidr_ip))
+    except ValueError:
+        return None
+
+
+def _replace_merged_ip_permissions(ip_permissions, merged_groups):
+    # merged rule takes the place of its first member to keep the order
+    replaced = dict()
+    dropped = set()
+    for positions, ip_permission in merged_groups:
+        first = min(positions)
+        replaced[first] = ip_permission
+        dropped.update(p for p in positions if p != first)
+
+    return [
+        replaced.get(position, ip_permission)
+        for position, ip_permission in enumerate(ip_permissions)
+        if position not in dropped
+    ]
+
+
+def _group_ip_permissions(ip_permissions, get_key, get_value):
+    keys = []
+    groups = dict()
+    for position, ip_permission in enumerate(ip_permissions):
+        value = get_value(ip_permission)
+        if value is None:
+            continue
+        key = get_key(ip_permission, value)
+        if key not in groups:
+            keys.append(key)
+            groups[key] = []
+        groups[key].append((value, position))
+    return [groups[key] for key in keys if len(groups[key]) > 1]
+
+
+def compact_port_ranges(ip_permissions):
+    def get_key(ipp, port_range):
+        return (ipp.get('in_out'), ipp.get('ip_protocol'),
+                ipp.get('cidr_ip'), ipp.get('group_name'))
+
+    merged_groups = []
+    for members in _group_ip_permissions(ip_permissions, get_key,
+                                         _get_port_range):
+        merged = []
+        for (from_port, to_port), position in sorted(members):
+            if merged and from_port <= merged[-1][1] + 1:
+                merged[-1][1] = max(merged[-1][1], to_port)
+                merged[-1][2].append(position)
+            else:
+                merged.append([from_port, to_port, [position]])
+
+        for from_port, to_port, positions in merged:
+            if len(positions) == 1:
+                continue
+            ip_permission = dict(ip_permissions[min(positions)])
+            ip_permission['from_port'] = from_port
+            if to_port != from_port:
+                ip_permission['to_port'] = to_port
+            else:
+                ip_permission.pop('to_port', None)
+            merged_groups.append((positions, ip_permission))
+
+    return _replace_merged_ip_permissions(ip_permissions, merged_groups)
+
+
+def compact_cidr_blocks(ip_permissions):
+    def get_key(ipp, network):
+        return (ipp.get('in_out'), ipp.get('ip_protocol'),
+                _get_port_range(ipp), network.version)
+
+    merged_groups = []
+    for members in _group_ip_permissions(ip_permissions, get_key,
+                                         _get_network):
+        members = sorted(members)
+        networks = [network for network, position in members]
+        index = 0
+        for supernet in ipaddress.collapse_addresses(networks):
+            positions = []
+            cidr_ip = str(supernet)
+            while (index < len(members) and
+                   members[index][0].broadcast_address <=
+                   supernet.broadcast_address):
+                network, position = members[index]
+                positions.append(position)
+                if network == supernet:
+                    # keep the notation of the rule already covering all
+                    cidr_ip = ip_permissions[position].get('cidr_ip')
+                index += 1
+
+            if len(positions) == 1:
+                continue
+            ip_permission = dict(ip_permissions[min(positions)])
+            ip_permission['cidr_ip'] = cidr_ip
+            merged_groups.append((positions, ip_permission))
+
+    return _replace_merged_ip_permissions(ip_permissions, merged_groups)
+
+
+def compact_ip_permissions(ip_permissions):
+    # merging port ranges may allow merging cidr blocks and vice versa,
+    # so repeat until the number of rules is no longer reduced.
+    while True:
+        size = len(ip_permissions)
+        ip_permissions = compact_cidr_blocks(
+            compact_port_ranges(ip_permissions))
+        if len(ip_permissions) == size:
+            return ip_permissions
+
+
+def _build_xml_tags(namespace, names):
+    # get xml element by python 2.6 and 2.7 or more
+    # don't use xml.etree.ElementTree.Element.fint(match, namespaces)
+    # this is not inplemented by python 2.6
+    return dict(
+        (name, '{{{0}}}{1}'.format(namespace, name)) for name in names
+    )
+
+
+SECURITY_GROUP_TAG_NAMES = (
+    'securityGroupInfo', 'item', 'groupName', 'groupDescription',
+    'groupStatus', 'groupLogLimit', 'groupRuleLimit', 'ipPermissions',
+    'ipProtocol', 'inOut', 'fromPort', 'toPort', 'ipRanges', 'cidrIp',
+    'groups',
+)
+
+
+def parse_ip_permission_item(item, tags):
+    # parse one ipPermissions/item by a single pass over its direct children.
+    # an item having multiple ipRanges/groups entries is expanded to
+    # one rule per source, as same as ip_permissions parameter.
+    ip_protocol = None
+    in_out = None
+    from_port = None
+    to_port = None
+    cidr_ips = []
+    group_names = []
+
+    for child in item:
+        tag = child.tag
+        if tag == tags['ipProtocol']:
+            ip_protocol = child.text
+        elif tag == tags['inOut']:
+            in_out = child.text
+        elif tag == tags['fromPort']:
+            from_port = int(child.text)
+        elif tag == tags['toPort']:
+            to_port = int(child.text)
+        elif tag == tags['ipRanges']:
+            for source in child:
+                for field in source:
+                    if field.tag == tags['cidrIp']:
+                        cidr_ips.append(field.text)
+        elif tag == tags['groups']:
+            for source in child:
+                for field in source:
+                    if field.tag == tags['groupName']:
+                        group_names.append(field.text)
+
+    sources = ([(cidr_ip, None) for cidr_ip in cidr_ips] +
+               [(None, group_name) for group_name in group_names])
+
+    return [
+        dict(
+            ip_protocol=ip_protocol,
+            in_out=in_out,
+            from_port=from_port,
+            to_port=to_port,
+            cidr_ip=cidr_ip,
+            group_name=group_name,
+        )
+        for (cidr_ip, group_name) in (sources or [(None, None)])
+    ]
+
+
+def parse_security_group_item(item, tags):
+    # parse one securityGroupInfo/item by a single pass over its children.
+    # nested groupName elements (ipPermissions/item/groups) are never
+    # confused with the groupName of the firewall group itself.
+    info = dict(
+        group_name=None,
+        status=None,
+        description=None,
+        log_limit=None,
+        rule_limit=None,
+        ip_permissions=[],
+    )
+
+    for child in item:
+        tag = child.tag
+        if tag == tags['groupName']:
+            info['group_name'] = child.text
+        elif tag == tags['groupStatus']:
+            info['status'] = child.text
+        elif tag == tags['groupDescription']:
+            info['description'] = child.text
+        elif tag == tags['groupLogLimit']:
+            info['log_limit'] = int(child.text)
+        elif tag == tags['groupRuleLimit']:
+            info['rule_limit'] = int(child.text)
+        elif tag == tags['ipPermissions']:
+            for ip_permission in child:
+                info['ip_permissions'].extend(
+                    parse_ip_permission_item(ip_permission, tags))
+
+    return info
+
+
 def describe_security_group(module, result):
     result = copy.deepcopy(result)
     security_group_info = None
@@ -233,97 +708,84 @@ def describe_security_group(module, result):
 
     res = request_to_api(module, 'GET', 'DescribeSecurityGroups', params)
 
-    # get xml element by python 2.6 and 2.7 or more
-    # don't use xml.etree.ElementTree.Element.fint(match, namespaces)
-    # this is not inplemented by python 2.6
-    status = res['xml_body'].find(
-        './/{{{nc}}}groupStatus'.format(**res['xml_namespace']))
+    tags = _build_xml_tags(res['xml_namespace']['nc'],
+                           SECURITY_GROUP_TAG_NAMES)
+    item = res['xml_body'].find(
+        '{securityGroupInfo}/{item}'.format(**tags))
+    info = None
+    if item is not None:
+        info = parse_security_group_item(item, tags)
 
-    if res['status'] != 200 or status is None:
+    if res['status'] != 200 or info is None or info['status'] is None:
         result['state'] = 'absent'
-    elif status.text != 'applied':
+    elif info['status'] != 'applied':
         result['state'] = 'processing'
     else:
         result['state'] = 'present'
 
-        # get xml element by python 2.6 and 2.7 or more
-        # don't use xml.etree.ElementTree.Element.fint(match, namespaces)
-        # this is not inplemented by python 2.6
-        group_name = res['xml_body'].find(
-            './/{{{nc}}}groupName' .format(**res['xml_namespace']))
-        description = res['xml_body'].find(
-            './/{{{nc}}}groupDescription'.format(**res['xml_namespace']))
-        log_limit = res['xml_body'].find(
-            './/{{{nc}}}groupLogLimit'.format(**res['xml_namespace']))
-        # net_bios = res['xml_body'].find(
-        #     './/{{{nc}}}groupLogFilterNetBios'.format(**res['xml_namespace'])
-        # )
-        # broadcast = res['xml_body'].find(
-        #     './/{{{nc}}}groupLogFilterBroadcast'.format(**res['xml_namespace'])
-        # )
-        ip_permissions = res['xml_body'].findall(
-            './/{{{nc}}}ipPermissions/{{{nc}}}item'
-            .format(**res['xml_namespace'])
-        )
         # set description
-        if description is None or description.text is None:
+        description = info['description']
+        if description is None:
             description = ''
-        elif isinstance(description.text, unicode):
-            description = description.text.encode('utf-8')
-        else:
-            description = description.text
-
-        # set ip_permissions
-        ip_permission_list = []
-        for ip_permission in (ip_permissions or []):
-            # get xml element by python 2.6 and 2.7 or more
-            # don't use xml.etree.ElementTree.Element.fint(match, namespaces)
-            # this is not inplemented by python 2.6
-            _ip_protocol = ip_permission.find(
-                './/{{{nc}}}ipProtocol'.format(**res['xml_namespace']))
-            _in_out = ip_permission.find(
-                './/{{{nc}}}inOut'.format(**res['xml_namespace']))
-            _from_port = ip_permission.find(
-                './/{{{nc}}}fromPort'.format(**res['xml_namespace']))
-            _to_port = ip_permission.find(
-                './/{{{nc}}}toPort'.format(**res['xml_namespace']))
-            _cidr_ip = ip_permission.find(
-                './/{{{nc}}}cidrIp'.format(**res['xml_namespace']))
-            _group_name = ip_permission.find(
-                './/{{{nc}}}groupName'.format(**res['xml_namespace']))
-
-            ip_permission_list.append(dict(
-                ip_protocol=_ip_protocol.text,
-                in_out=_in_out.text,
-                from_port=(int(_from_port.text)
-                           if _from_port is not None else None),
-                to_port=int(_to_port.text) if _to_port is not None else None,
-                cidr_ip=_cidr_ip.text if _cidr_ip is not None else None,
-                group_name=(_group_name.text
-                            if _group_name is not None else None)
-            ))
+        elif isinstance(description, unicode):
+            description = description.encode('utf-8')
 
         security_group_info = dict(
-            group_name=group_name.text,
-            log_limit=int(log_limit.text),
+            group_name=info['group_name'],
+            log_limit=info['log_limit'],
+            rule_limit=info['rule_limit'],
             description=description,
-            ip_permissions=ip_permission_list,
+            ip_permissions=info['ip_permissions'],
         )
 
     return (result, security_group_info)
 
 
-def wait_for_processing(module, result, goal_state):
+def get_wait_policy(module):
+    def get_param(name, default):
+        value = module.params.get(name)
+        return default if value is None else value
+
+    return dict(
+        timeout=get_param('wait_timeout', WAIT_TIMEOUT),
+        interval=get_param('wait_interval', WAIT_INTERVAL),
+        max_interval=get_param('wait_max_interval', WAIT_MAX_INTERVAL),
+    )
+
+
+def wait_for_processing(module, result, goal_state, number_of_rules=1):
     current_method_name = sys._getframe().f_code.co_name
     group_name = module.params['group_name']
+    policy = get_wait_policy(module)
+
+    # poll immediately after short operations, and back off exponentially
+    # until the deadline. the elapsed time also counts the requested sleeps
+    # so that the deadline is kept even if the clock does not advance.
+    start = time.time()
+    slept = 0
+    delay = 0
+    if number_of_rules > WAIT_IMMEDIATE_POLL_RULES:
+        delay = policy['interval']
+
+    while True:
+        if delay > 0:
+            elapsed = max(time.time() - start, slept)
+            delay = min(delay, max(policy['timeout'] - elapsed, 0))
+            time.sleep(delay)
+            slept += delay
 
-    for retry_count in range(10):
         (result, security_group_info) = describe_security_group(module, result)
         current_state = result.get('state')
         if current_state == goal_state:
             break
+
+        if max(time.time() - start, slept) >= policy['timeout']:
+            break
+
+        if delay == 0:
+            delay = policy['interval']
         else:
-            time.sleep(10)
+            delay = min(delay * WAIT_BACKOFF_FACTOR, policy['max_interval'])
 
     if current_state != goal_state:
         fail(module, result, 'wait fot processing failed',
@@ -504,6 +966,66 @@ def update_security_group(module, result, security_group_info):
     return (result, security_group_info)
 
 
+def _build_ip_permissions_params(group_name, rules, with_description):
+    params = dict(GroupName=group_name)
+
+    for index, rule in enumerate(rules):
+        ip_permission_param_prefix = 'IpPermissions.{0}.'.format(index + 1)
+
+        params[ip_permission_param_prefix + 'InOut'] = rule.get('in_out')
+        params[ip_permission_param_prefix + 'IpProtocol'] = rule.get('ip_protocol')  # noqa
+        if with_description:
+            params[ip_permission_param_prefix + 'Description'] = rule.get('description', '')  # noqa
+
+        _from_port = rule.get('from_port')
+        if _from_port is not None:
+            params[ip_permission_param_prefix + 'FromPort'] = _from_port
+
+        _to_port = rule.get('to_port')
+        if _to_port is not None:
+            params[ip_permission_param_prefix + 'ToPort'] = _to_port
+
+        _group_name = rule.get('group_name')
+        if _group_name is not None:
+            params[ip_permission_param_prefix + 'Groups.1.GroupName'] = _group_name  # noqa
+
+        _cidr_ip = rule.get('cidr_ip')
+        if _cidr_ip is not None:
+            params[ip_permission_param_prefix + 'IpRanges.1.CidrIp'] = _cidr_ip  # noqa
+
+    return params
+
+
+def build_authorize_params(group_name, authorize_rules):
+    return _build_ip_permissions_params(group_name, authorize_rules, True)
+
+
+def build_revoke_params(group_name, revoke_rules):
+    return _build_ip_permissions_params(group_name, revoke_rules, False)
+
+
+def submit_security_group_request(module, result, action, params,
+                                  current_method_name,
+                                  retry_while_processing=False):
+    group_name = module.params['group_name']
+
+    res = request_to_api(module, 'POST', action, params)
+    if res['status'] != 200 and retry_while_processing:
+        # the request is rejected while the previous one is processed.
+        # it is sent again as soon as the firewall group is applied.
+        (processing_result, _) = describe_security_group(module, result)
+        if processing_result.get('state') == 'processing':
+            wait_for_processing(module, result, 'present')
+            res = request_to_api(module, 'POST', action, params)
+
+    if res['status'] != 200:
+        error_info = get_api_error(res['xml_body'])
+        fail(module, result, 'changes failed',
+             current_method=current_method_name,
+             group_name=group_name,
+             **error_info)
+
+
 def authorize_security_group(module, result, security_group_info):
     result = copy.deepcopy(result)
     security_group_info = copy.deepcopy(security_group_info)
@@ -577,36 +1099,10 @@ def authorize_security_group_one_by_one(module, result, security_group_info,
     # > So, I implemented so that all IP permissions to be added
     # > are registered one by one.
     for authorize_rule in authorize_rules:
-        params = dict(GroupName=group_name)
-
-        params['IpPermissions.1.InOut'] = authorize_rule.get('in_out')
-        params['IpPermissions.1.IpProtocol'] = authorize_rule.get('ip_protocol')  # noqa
-        params['IpPermissions.1.Description'] = authorize_rule.get('description', '')  # noqa
-
-        _from_port = authorize_rule.get('from_port')
-        if _from_port is not None:
-            params['IpPermissions.1.FromPort'] = _from_port
-
-        _to_port = authorize_rule.get('to_port')
-        if _to_port is not None:
-            params['IpPermissions.1.ToPort'] = _to_port
-
-        _group_name = authorize_rule.get('group_name')
-        if _group_name is not None:
-            params['IpPermissions.1.Groups.1.GroupName'] = _group_name
-
-        _cidr_ip = authorize_rule.get('cidr_ip')
-        if _cidr_ip is not None:
-            params['IpPermissions.1.IpRanges.1.CidrIp'] = _cidr_ip
-
-        res = request_to_api(module, 'POST', 'AuthorizeSecurityGroupIngress',
-                             params)
-        if res['status'] != 200:
-            error_info = get_api_error(res['xml_body'])
-            fail(module, result, 'changes failed',
-                 current_method=current_method_name,
-                 group_name=group_name,
-                 **error_info)
+        params = build_authorize_params(group_name, [authorize_rule])
+        submit_security_group_request(module, result,
+                                      'AuthorizeSecurityGroupIngress',
+                                      params, current_method_name)
 
         # wait for processing
         result, security_group_info = wait_for_processing(module, result,
@@ -622,44 +1118,15 @@ def authorize_security_group_in_bulk(module, result, security_group_info,
     security_group_info = copy.deepcopy(security_group_info)
 
     goal_state = 'present'
-    params = dict(GroupName=group_name)
-
-    for index, authorize_rule in enumerate(authorize_rules):
-        ip_permission_param_prefix = 'IpPermissions.{0}.'.format(index + 1)
-
-        params[ip_permission_param_prefix + 'InOut'] = authorize_rule.get('in_out')  # noqa
-        params[ip_permission_param_prefix + 'IpProtocol'] = authorize_rule.get('ip_protocol')  # noqa
-        params[ip_permission_param_prefix + 'Description'] = authorize_rule.get('description', '')  # noqa
-
-        _from_port = authorize_rule.get('from_port')
-        if _from_port is not None:
-            params[ip_permission_param_prefix + 'FromPort'] = _from_port
-
-        _to_port = authorize_rule.get('to_port')
-        if _to_port is not None:
-            params[ip_permission_param_prefix + 'ToPort'] = _to_port
-
-        _group_name = authorize_rule.get('group_name')
-        if _group_name is not None:
-            params[ip_permission_param_prefix + 'Groups.1.GroupName'] = _group_name  # noqa
-
-        _cidr_ip = authorize_rule.get('cidr_ip')
-        if _cidr_ip is not None:
-            params[ip_permission_param_prefix + 'IpRanges.1.CidrIp'] = _cidr_ip  # noqa
-
-    res = request_to_api(module, 'POST', 'AuthorizeSecurityGroupIngress',
-                         params)
-
-    if res['status'] != 200:
-        error_info = get_api_error(res['xml_body'])
-        fail(module, result, 'changes failed',
-             current_method=current_method_name,
-             group_name=group_name,
-             **error_info)
+    params = build_authorize_params(group_name, authorize_rules)
+    submit_security_group_request(module, result,
+                                  'AuthorizeSecurityGroupIngress', params,
+                                  current_method_name)
 
     # wait for processing
     result, security_group_info = wait_for_processing(module, result,
-                                                      goal_state)
+                                                      goal_state,
+                                                      len(authorize_rules))
     return (result, security_group_info)
 
 
@@ -670,7 +1137,6 @@ def revoke_security_group(module, result, security_group_info):
         return (result, security_group_info)
 
     current_method_name = sys._getframe().f_code.co_name
-    goal_state = 'present'
     group_name = module.params['group_name']
 
     # get target (current_ip_permissions - goal_ip_permissions = revoke_rules)
@@ -693,66 +1159,380 @@ def revoke_security_group(module, result, security_group_info):
         result['changed_attributes']['number_of_revoke_rules'] = revoke_rules_size  # noqa
         return (result, security_group_info)
 
-    # build parameters
-    params = dict(
-        GroupName=group_name,
-    )
-    for index, revoke_rule in enumerate(revoke_rules):
-        ip_permission_param_prefix = 'IpPermissions.{0}.'.format(index + 1)
+    (result, security_group_info) = revoke_security_group_rules(
+                                        module,
+                                        result,
+                                        security_group_info,
+                                        revoke_rules,
+                                        group_name,
+                                        current_method_name
+                                    )
 
-        params[ip_permission_param_prefix + 'InOut'] = revoke_rule.get('in_out')  # noqa
-        params[ip_permission_param_prefix + 'IpProtocol'] = revoke_rule.get('ip_protocol')  # noqa
+    # update check
+    current_ip_permissions = security_group_info.get('ip_permissions')
+    revoke_rules = except_ip_permissions(current_ip_permissions,
+                                         goal_ip_permissions)
+    if len(revoke_rules) != 0:
+        fail(module, result, 'changes failed',
+             current_method=current_method_name,
+             group_name=group_name,
+             current_info=security_group_info)
 
-        _from_port = revoke_rule.get('from_port')
-        if _from_port is not None:
-            params[ip_permission_param_prefix + 'FromPort'] = _from_port
+    result['changed_attributes']['number_of_revoke_rules'] = revoke_rules_size
+    return (result, security_group_info)
 
-        _to_port = revoke_rule.get('to_port')
-        if _to_port is not None:
-            params[ip_permission_param_prefix + 'ToPort'] = _to_port
 
-        _group_name = revoke_rule.get('group_name')
-        if _group_name is not None:
-            params[ip_permission_param_prefix + 'Groups.1.GroupName'] = _group_name  # noqa
+def revoke_security_group_rules(module, result, security_group_info,
+                                revoke_rules, group_name,
+                                current_method_name):
+    result = copy.deepcopy(result)
+    security_group_info = copy.deepcopy(security_group_info)
 
-        _cidr_ip = revoke_rule.get('cidr_ip')
-        if _cidr_ip is not None:
-            params[ip_permission_param_prefix + 'IpRanges.1.CidrIp'] = _cidr_ip
+    goal_state = 'present'
 
     # revoke ip_permissions
-    res = request_to_api(module, 'POST', 'RevokeSecurityGroupIngress', params)
-    if res['status'] != 200:
-        error_info = get_api_error(res['xml_body'])
+    params = build_revoke_params(group_name, revoke_rules)
+    submit_security_group_request(module, result,
+                                  'RevokeSecurityGroupIngress', params,
+                                  current_method_name)
+
+    # wait for processing
+    result, security_group_info = wait_for_processing(module, result,
+                                                      goal_state,
+                                                      len(revoke_rules))
+    return (result, security_group_info)
+
+
+def _split_into_chunks(rules, size):
+    if not rules:
+        return []
+    if not size:
+        return [rules]
+    return [rules[i:i + size] for i in range(0, len(rules), size)]
+
+
+def get_ip_permissions_diff(module, security_group_info):
+    current_ip_permissions = security_group_info.get('ip_permissions')
+    goal_ip_permissions = module.params.get('ip_permissions', list())
+
+    authorize_rules = except_ip_permissions(goal_ip_permissions,
+                                            current_ip_permissions)
+    revoke_rules = []
+    if module.params.get('purge_ip_permissions'):
+        revoke_rules = except_ip_permissions(current_ip_permissions,
+                                             goal_ip_permissions)
+    return (authorize_rules, revoke_rules)
+
+
+def estimate_ip_permissions_plan(strategy, current_size, authorize_size,
+                                 revoke_size, in_bulk, per_request,
+                                 rule_limit):
+    # every authorize/revoke request is followed by a wait for processing.
+    if strategy == 'chunked':
+        authorize_steps = [len(c) for c in _split_into_chunks(
+            range(authorize_size), per_request)]
+        revoke_steps = [-len(c) for c in _split_into_chunks(
+            range(revoke_size), per_request)]
+    else:
+        authorize_steps = [authorize_size] if authorize_size else []
+        revoke_steps = [-revoke_size] if revoke_size else []
+
+    steps = []
+    if strategy == 'replace':
+        steps = revoke_steps + authorize_steps
+    else:
+        for index in range(max(len(authorize_steps), len(revoke_steps))):
+            steps.extend(authorize_steps[index:index + 1])
+            steps.extend(revoke_steps[index:index + 1])
+
+    # ip_permissions to authorize are registered one by one if not in bulk
+    request_sizes = [-step for step in revoke_steps]
+    if in_bulk:
+        request_sizes.extend(authorize_steps)
+    else:
+        request_sizes.extend([1] * authorize_size)
+    request_count = len(request_sizes)
+
+    # the revoke request does not wait for the authorize one when pipelined
+    waits = request_count
+    if strategy == 'pipelined' and authorize_size and revoke_size:
+        waits -= 1
+
+    # peak number of rules registered in the group while applying
+    peak_rules = current_size
+    number_of_rules = current_size
+    for step in steps:
+        number_of_rules += step
+        peak_rules = max(peak_rules, number_of_rules)
+
+    safe = True
+    if per_request and max([0] + request_sizes) > per_request:
+        safe = False
+    if rule_limit is not None and peak_rules > rule_limit:
+        safe = False
+
+    return dict(
+        strategy=strategy,
+        estimated_requests=request_count,
+        estimated_waits=waits,
+        estimated_seconds=(request_count * ESTIMATED_SECONDS_PER_REQUEST +
+                           waits * ESTIMATED_SECONDS_PER_WAIT),
+        peak_rules=peak_rules,
+        safe=safe,
+    )
+
+
+def plan_ip_permissions(module, security_group_info):
+    strategy = module.params.get('ip_permissions_strategy') or 'incremental'
+    if strategy != 'auto' and strategy not in IP_PERMISSIONS_STRATEGIES:
+        fail(module, dict(), 'invalid ip_permissions_strategy',
+             group_name=module.params['group_name'],
+             ip_permissions_strategy=strategy)
+
+    if security_group_info is None:
+        return dict(
+            strategy=('incremental' if strategy == 'auto' else strategy),
+            number_of_authorize_rules=0,
+            number_of_revoke_rules=0,
+        )
+
+    (authorize_rules, revoke_rules) = get_ip_permissions_diff(
+        module, security_group_info)
+    current_size = len(security_group_info.get('ip_permissions'))
+
+    candidates = []
+    for candidate in IP_PERMISSIONS_STRATEGIES:
+        if candidate == 'replace':
+            # revoking first is only allowed when no current rule is kept,
+            # otherwise the group would lose rules it should keep.
+            # nothing is lost when there is nothing to revoke.
+            kept_size = current_size - len(revoke_rules)
+            if revoke_rules and kept_size:
+                continue
+        candidates.append(estimate_ip_permissions_plan(
+            candidate,
+            current_size,
+            len(authorize_rules),
+            len(revoke_rules),
+            module.params.get('authorize_in_bulk'),
+            module.params.get('ip_permissions_per_request'),
+            security_group_info.get('rule_limit'),
+        ))
+
+    if strategy == 'auto':
+        # prefer safe, then cheap, then the order of strategies
+        plan = sorted(candidates, key=lambda c: (
+            not c['safe'],
+            c['estimated_seconds'],
+            IP_PERMISSIONS_STRATEGIES.index(c['strategy']),
+        ))[0]
+    else:
+        # replace falls back to incremental when it would lose kept rules
+        plans = [c for c in candidates if c['strategy'] == strategy]
+        if len(plans) == 0:
+            plans = [c for c in candidates
+                     if c['strategy'] == 'incremental']
+        plan = plans[0]
+
+    return dict(
+        plan,
+        number_of_authorize_rules=len(authorize_rules),
+        number_of_revoke_rules=len(revoke_rules),
+    )
+
+
+def authorize_and_revoke_security_group_in_chunks(module, result,
+                                                  security_group_info):
+    result = copy.deepcopy(result)
+    security_group_info = copy.deepcopy(security_group_info)
+    if security_group_info is None:
+        return (result, security_group_info)
+
+    current_method_name = sys._getframe().f_code.co_name
+    group_name = module.params['group_name']
+
+    (authorize_rules, revoke_rules) = get_ip_permissions_diff(
+        module, security_group_info)
+
+    # skip check
+    authorize_rules_size = len(authorize_rules)
+    revoke_rules_size = len(revoke_rules)
+    if authorize_rules_size == 0 and revoke_rules_size == 0:
+        return (result, security_group_info)
+
+    changed_attributes = dict()
+    if authorize_rules_size != 0:
+        changed_attributes['number_of_authorize_rules'] = authorize_rules_size
+    if revoke_rules_size != 0:
+        changed_attributes['number_of_revoke_rules'] = revoke_rules_size
+
+    if module.check_mode:
+        result['changed_attributes'].update(changed_attributes)
+        return (result, security_group_info)
+
+    # authorize and revoke alternately, so that the number of rules
+    # in the group does not exceed the current one by more than a chunk.
+    per_request = module.params.get('ip_permissions_per_request')
+    authorize_chunks = _split_into_chunks(authorize_rules, per_request)
+    revoke_chunks = _split_into_chunks(revoke_rules, per_request)
+
+    if module.params.get('authorize_in_bulk'):
+        authorize_rules_function = authorize_security_group_in_bulk
+    else:
+        authorize_rules_function = authorize_security_group_one_by_one
+
+    for index in range(max(len(authorize_chunks), len(revoke_chunks))):
+        if index < len(authorize_chunks):
+            (result, security_group_info) = authorize_rules_function(
+                module,
+                result,
+                security_group_info,
+                authorize_chunks[index],
+                group_name,
+                current_method_name
+            )
+        if index < len(revoke_chunks):
+            (result, security_group_info) = revoke_security_group_rules(
+                module,
+                result,
+                security_group_info,
+                revoke_chunks[index],
+                group_name,
+                current_method_name
+            )
+
+    # update check
+    (authorize_rules, revoke_rules) = get_ip_permissions_diff(
+        module, security_group_info)
+    if len(authorize_rules) != 0 or len(revoke_rules) != 0:
         fail(module, result, 'changes failed',
              current_method=current_method_name,
              group_name=group_name,
-             **error_info)
+             current_info=security_group_info)
+
+    result['changed_attributes'].update(changed_attributes)
+    return (result, security_group_info)
+
+
+def authorize_and_revoke_security_group_pipelined(module, result,
+                                                  security_group_info):
+    result = copy.deepcopy(result)
+    security_group_info = copy.deepcopy(security_group_info)
+    if security_group_info is None:
+        return (result, security_group_info)
+
+    current_method_name = sys._getframe().f_code.co_name
+    group_name = module.params['group_name']
+    goal_state = 'present'
+
+    (authorize_rules, revoke_rules) = get_ip_permissions_diff(
+        module, security_group_info)
+
+    # skip check
+    authorize_rules_size = len(authorize_rules)
+    revoke_rules_size = len(revoke_rules)
+    if authorize_rules_size == 0 and revoke_rules_size == 0:
+        return (result, security_group_info)
+
+    changed_attributes = dict()
+    if authorize_rules_size != 0:
+        changed_attributes['number_of_authorize_rules'] = authorize_rules_size
+    if revoke_rules_size != 0:
+        changed_attributes['number_of_revoke_rules'] = revoke_rules_size
+
+    if module.check_mode:
+        result['changed_attributes'].update(changed_attributes)
+        return (result, security_group_info)
+
+    # the last authorize request is not waited for, the revoke request
+    # follows it at once and both are verified with one wait.
+    last_authorize_rules = authorize_rules
+    if not module.params.get('authorize_in_bulk') and authorize_rules:
+        (result, security_group_info) = authorize_security_group_one_by_one(
+            module,
+            result,
+            security_group_info,
+            authorize_rules[:-1],
+            group_name,
+            current_method_name
+        )
+        last_authorize_rules = authorize_rules[-1:]
+
+    if last_authorize_rules:
+        params = build_authorize_params(group_name, last_authorize_rules)
+        submit_security_group_request(module, result,
+                                      'AuthorizeSecurityGroupIngress',
+                                      params, current_method_name)
+
+    if revoke_rules:
+        params = build_revoke_params(group_name, revoke_rules)
+        submit_security_group_request(module, result,
+                                      'RevokeSecurityGroupIngress', params,
+                                      current_method_name,
+                                      retry_while_processing=True)
 
     # wait for processing
-    result, security_group_info = wait_for_processing(module, result,
-                                                      goal_state)
+    result, security_group_info = wait_for_processing(
+        module, result, goal_state,
+        len(last_authorize_rules) + revoke_rules_size)
 
     # update check
-    current_ip_permissions = security_group_info.get('ip_permissions')
-    revoke_rules = except_ip_permissions(current_ip_permissions,
-                                         goal_ip_permissions)
-    if len(revoke_rules) != 0:
+    (authorize_rules, revoke_rules) = get_ip_permissions_diff(
+        module, security_group_info)
+    if len(authorize_rules) != 0 or len(revoke_rules) != 0:
         fail(module, result, 'changes failed',
              current_method=current_method_name,
              group_name=group_name,
              current_info=security_group_info)
 
-    result['changed_attributes']['number_of_revoke_rules'] = revoke_rules_size
+    result['changed_attributes'].update(changed_attributes)
     return (result, security_group_info)
 
 
-def run(module):
-    result = dict(
-        created=False,
-        changed_attributes=dict(),
-        state='absent',
-    )
+def prepare_ip_permissions(module, result):
+    ip_permissions_file = module.params.get('ip_permissions_file')
+    if ip_permissions_file is not None:
+        file_format = get_ip_permissions_file_format(
+            ip_permissions_file,
+            module.params.get('ip_permissions_file_format')
+        )
+        if file_format not in IP_PERMISSIONS_FILE_READERS:
+            fail(module, result, 'unknown format of ip_permissions_file',
+                 group_name=module.params['group_name'],
+                 ip_permissions_file=ip_permissions_file)
+        if file_format == 'yaml' and not HAS_YAML:
+            fail(module, result, 'PyYAML is required for this option',
+                 group_name=module.params['group_name'])
+
+        ip_permissions = list(module.params.get('ip_permissions') or [])
+        try:
+            ip_permissions.extend(
+                load_ip_permissions_file(ip_permissions_file, file_format))
+        except (IOError, ValueError) as e:
+            fail(module, result, 'invalid ip_permissions_file',
+                 group_name=module.params['group_name'],
+                 ip_permissions_file=ip_permissions_file,
+                 error_message=str(e))
+        module.params['ip_permissions'] = ip_permissions
+
+    compaction = None
+    if module.params.get('compact_ip_permissions'):
+        if not HAS_IPADDRESS:
+            fail(module, result, 'ipaddress is required for this option',
+                 group_name=module.params['group_name'])
+
+        ip_permissions = module.params.get('ip_permissions', list())
+        compacted_ip_permissions = compact_ip_permissions(ip_permissions)
+        module.params['ip_permissions'] = compacted_ip_permissions
+        compaction = dict(
+            number_of_rules_before=len(ip_permissions),
+            number_of_rules_after=len(compacted_ip_permissions),
+        )
 
+    return compaction
+
+
+def ensure_security_group(module, result):
     result, security_group_info = describe_security_group(module, result)
 
     result, security_group_info = create_security_group(module, result,
@@ -761,11 +1541,32 @@ def run(module):
     result, security_group_info = update_security_group(module, result,
                                                         security_group_info)
 
-    result, security_group_info = authorize_security_group(module, result,
-                                                           security_group_info)
+    return (result, security_group_info)
 
-    result, security_group_info = revoke_security_group(module, result,
-                                                        security_group_info)
+
+def apply_ip_permissions(module, result, security_group_info, compaction):
+    plan = plan_ip_permissions(module, security_group_info)
+
+    if plan['strategy'] == 'chunked':
+        result, security_group_info = \
+            authorize_and_revoke_security_group_in_chunks(module, result,
+                                                          security_group_info)
+    elif plan['strategy'] == 'pipelined':
+        result, security_group_info = \
+            authorize_and_revoke_security_group_pipelined(module, result,
+                                                          security_group_info)
+    elif plan['strategy'] == 'replace':
+        result, security_group_info = revoke_security_group(
+            module, result, security_group_info)
+
+        result, security_group_info = authorize_security_group(
+            module, result, security_group_info)
+    else:
+        result, security_group_info = authorize_security_group(
+            module, result, security_group_info)
+
+        result, security_group_info = revoke_security_group(
+            module, result, security_group_info)
 
     group_name = module.params['group_name']
     goal_state = module.params['state']
@@ -775,10 +1576,408 @@ def run(module):
              group_name=group_name,
              goal_state=goal_state)
 
+    if compaction is not None:
+        result['ip_permissions_compaction'] = compaction
+    result['ip_permissions_plan'] = plan
+
     created = result.get('created')
     changed_attributes = result.get('changed_attributes')
     changed = (created or (len(changed_attributes) != 0))
-    module.exit_json(changed=changed, **result)
+    return dict(result, changed=changed)
+
+
+def reconcile_security_group(module):
+    result = dict(
+        created=False,
+        changed_attributes=dict(),
+        state='absent',
+    )
+
+    compaction = prepare_ip_permissions(module, result)
+    return reconcile_prepared_security_group(module, result, compaction)
+
+
+def reconcile_prepared_security_group(module, result, compaction):
+    if module.params.get('fingerprint_cache'):
+        return reconcile_security_group_cached(module, result, compaction)
+
+    result, security_group_info = ensure_security_group(module, result)
+
+    return apply_ip_permissions(module, result, security_group_info,
+                                compaction)
+
+
+class SecurityGroupError(Exception):
+    """Failure of one firewall group in the multi-group mode"""
+
+    def __init__(self, **kwargs):
+        Exception.__init__(self, kwargs.get('msg'))
+        self.kwargs = kwargs
+
+
+class SecurityGroupModule:
+    """Module with parameters of one firewall group in the multi-group mode
+
+    fail_json() raises SecurityGroupError instead of exiting, so that
+    the failure is reported once by the main thread.
+    """
+
+    def __init__(self, module, spec):
+        self.check_mode = module.check_mode
+        self.params = dict(
+            (key, value) for (key, value) in module.params.items()
+            if key not in SECURITY_GROUP_SPEC_DEFAULTS
+            and key != 'security_groups'
+        )
+        self.params.update(SECURITY_GROUP_SPEC_DEFAULTS)
+        self.params.update(spec)
+        self.params['ip_permissions'] = list(
+            self.params.get('ip_permissions') or [])
+
+    def fail_json(self, **kwargs):
+        raise SecurityGroupError(**kwargs)
+
+
+def get_security_group_references(specs):
+    # firewall groups of the list referenced by ip_permissions of each group
+    names = set(spec['group_name'] for spec in specs)
+    references = dict()
+    for spec in specs:
+        references[spec['group_name']] = sorted(set(
+            ip_permission.get('group_name')
+            for ip_permission in (spec.get('ip_permissions') or [])
+            if ip_permission.get('group_name') in names and
+            ip_permission.get('group_name') != spec['group_name']
+        ))
+    return references
+
+
+def _ensure_security_group_in_pool(group_module, result, compaction):
+    result, security_group_info = ensure_security_group(group_module, result)
+    return (result, security_group_info, compaction)
+
+
+def _apply_ip_permissions_in_pool(group_module, ensured, dependencies):
+    # rules referencing other groups wait only for their creation
+    for dependency in dependencies:
+        dependency.get()
+    (result, security_group_info, compaction) = ensured.get()
+    return apply_ip_permissions(group_module, result, security_group_info,
+                                compaction)
+
+
+def reconcile_security_groups(module):
+    specs = module.params['security_groups']
+    for spec in specs:
+        if not isinstance(spec, dict) or not spec.get('group_name'):
+            fail(module, dict(), 'group_name is required for each of '
+                                 'security_groups')
+
+    group_modules = [SecurityGroupModule(module, spec) for spec in specs]
+
+    # the rules of ip_permissions_file are read before the references are
+    # built, so that the groups referenced only by the files are waited too.
+    prepared = dict()
+    try:
+        for group_module in group_modules:
+            result = dict(
+                created=False,
+                changed_attributes=dict(),
+                state='absent',
+            )
+            compaction = prepare_ip_permissions(group_module, result)
+            prepared[group_module.params['group_name']] = (result, compaction)
+    except SecurityGroupError as e:
+        module.fail_json(**e.kwargs)
+    references = get_security_group_references(
+        [group_module.params for group_module in group_modules])
+
+    # all groups are created first in parallel (creation does not depend
+    # on other groups), then rules of each group are applied as soon as
+    # the groups it references exist.
+    max_workers = module.params.get('max_workers') or MAX_WORKERS
+    pool = ThreadPool(max(1, min(max_workers, len(specs))))
+    try:
+        ensured = dict(
+            (group_module.params['group_name'], pool.apply_async(
+                _ensure_security_group_in_pool,
+                (group_module,) + prepared[group_module.params['group_name']]))
+            for group_module in group_modules
+        )
+        applied = [
+            pool.apply_async(_apply_ip_permissions_in_pool, (
+                group_module,
+                ensured[group_module.params['group_name']],
+                [ensured[name] for name in
+                 references[group_module.params['group_name']]],
+            ))
+            for group_module in group_modules
+        ]
+        results = []
+        for group_module, group_result in zip(group_modules, applied):
+            results.append(dict(
+                group_result.get(),
+                group_name=group_module.params['group_name'],
+            ))
+    except SecurityGroupError as e:
+        module.fail_json(**e.kwargs)
+    finally:
+        pool.close()
+        pool.join()
+
+    return dict(
+        changed=any(result['changed'] for result in results),
+        security_groups=results,
+    )
+
+
+def make_cache_dir(module, result, directory, option_name):
+    if os.path.isdir(directory):
+        return
+    try:
+        os.makedirs(directory, 0o700)
+    except OSError:
+        if not os.path.isdir(directory):
+            fail(module, result, '{0} can not be created'.format(option_name),
+                 group_name=module.params['group_name'],
+                 **{option_name: directory})
+
+
+def get_coalesce_key(module):
+    # forks share the result only when they request the same changes.
+    # the rules read from ip_permissions_file are hashed instead of its path.
+    ignored = ('secret_access_key', 'coalesce', 'coalesce_dir',
+               'coalesce_ttl', 'coalesce_timeout', 'ip_permissions_file',
+               'ip_permissions_file_format')
+    spec = dict(
+        (key, value) for (key, value) in module.params.items()
+        if key not in ignored
+    )
+    spec['check_mode'] = module.check_mode
+    digest = hashlib.sha256(
+        json.dumps(spec, sort_keys=True, default=str).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def acquire_coalesce_lock(lock_file, timeout):
+    # the elapsed time also counts the requested sleeps as wait_for_processing
+    start = time.time()
+    slept = 0
+    while True:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except IOError:
+            if max(time.time() - start, slept) >= timeout:
+                return False
+            time.sleep(COALESCE_POLL_INTERVAL)
+            slept += COALESCE_POLL_INTERVAL
+
+
+def load_coalesced_result(path, ttl):
+    try:
+        with open(path, 'r') as fp:
+            saved = json.load(fp)
+    except (IOError, ValueError):
+        return None
+
+    if time.time() - saved.get('time', 0) > ttl:
+        return None
+    return saved.get('result')
+
+
+def save_coalesced_result(path, result):
+    temporary_path = '{0}.{1}'.format(path, os.getpid())
+    with open(temporary_path, 'w') as fp:
+        json.dump(dict(time=time.time(), result=result), fp, default=str)
+    os.rename(temporary_path, path)
+
+
+def reconcile_security_group_coalesced(module):
+    # one fork (the leader holding the lock) reconciles the group, and
+    # the others waiting for the lock reuse its result.
+    result = dict(created=False, changed_attributes=dict(), state='absent')
+    group_name = module.params['group_name']
+    if not HAS_FCNTL:
+        fail(module, result, 'fcntl is required for this option',
+             group_name=group_name)
+
+    directory = module.params.get('coalesce_dir') or COALESCE_DIR
+    make_cache_dir(module, result, directory, 'coalesce_dir')
+
+    compaction = prepare_ip_permissions(module, result)
+    key = get_coalesce_key(module)
+    lock_path = os.path.join(directory, key + '.lock')
+    result_path = os.path.join(directory, key + '.json')
+    ttl = module.params.get('coalesce_ttl')
+    if ttl is None:
+        ttl = COALESCE_TTL
+    timeout = module.params.get('coalesce_timeout')
+    if timeout is None:
+        timeout = COALESCE_TIMEOUT
+
+    with open(lock_path, 'a') as lock_file:
+        if not acquire_coalesce_lock(lock_file, timeout):
+            fail(module, result, 'wait for coalesced reconcile failed',
+                 group_name=group_name)
+        try:
+            coalesced_result = load_coalesced_result(result_path, ttl)
+            if coalesced_result is not None:
+                return dict(coalesced_result, coalesced=True)
+
+            result = reconcile_prepared_security_group(module, result,
+                                                       compaction)
+            save_coalesced_result(result_path, result)
+            return dict(result, coalesced=False)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def get_security_group_fingerprint(module):
+    # the raw item of the firewall group is hashed without parsing its
+    # rules. the rules are only counted for the plan of the cache hit.
+    params = dict()
+    params['GroupName.1'] = module.params['group_name']
+
+    res = request_to_api(module, 'GET', 'DescribeSecurityGroups', params)
+
+    tags = _build_xml_tags(res['xml_namespace']['nc'],
+                           SECURITY_GROUP_TAG_NAMES)
+    item = res['xml_body'].find(
+        '{securityGroupInfo}/{item}'.format(**tags))
+    if res['status'] != 200 or item is None:
+        return ('absent', None, None)
+
+    status = item.findtext(tags['groupStatus'])
+    if status != 'applied':
+        return ('processing', None, None)
+
+    # each source of ipRanges and groups is one rule of ip_permissions
+    number_of_rules = 0
+    for source in ('ipRanges', 'groups'):
+        number_of_rules += len(item.findall(
+            '{ipPermissions}/{item}/{0}/{item}'.format(tags[source], **tags)))
+    rule_limit = item.findtext(tags['groupRuleLimit'])
+
+    digest = hashlib.sha256(etree.tostring(item))
+    return ('present', digest.hexdigest(), dict(
+        number_of_rules=number_of_rules,
+        rule_limit=(int(rule_limit) if rule_limit else None),
+    ))
+
+
+def load_fingerprint(path, max_age):
+    try:
+        with open(path, 'r') as fp:
+            saved = json.load(fp)
+    except (IOError, ValueError):
+        return None
+
+    if time.time() - saved.get('time', 0) > max_age:
+        return None
+    return saved.get('fingerprint')
+
+
+def save_fingerprint(path, fingerprint):
+    temporary_path = '{0}.{1}'.format(path, os.getpid())
+    with open(temporary_path, 'w') as fp:
+        json.dump(dict(time=time.time(), fingerprint=fingerprint), fp)
+    os.rename(temporary_path, path)
+
+
+def get_in_sync_ip_permissions_plan(module, rules):
+    # nothing is authorized or revoked, and auto selects incremental
+    # (the first one of the strategies) when all of them cost nothing.
+    strategy = module.params.get('ip_permissions_strategy') or 'incremental'
+    if strategy == 'auto':
+        strategy = 'incremental'
+
+    plan = estimate_ip_permissions_plan(
+        strategy,
+        rules['number_of_rules'],
+        0,
+        0,
+        module.params.get('authorize_in_bulk'),
+        module.params.get('ip_permissions_per_request'),
+        rules['rule_limit'],
+    )
+    return dict(
+        plan,
+        number_of_authorize_rules=0,
+        number_of_revoke_rules=0,
+    )
+
+
+def get_desired_fingerprint(module):
+    ignored = ('secret_access_key', 'ip_permissions_file',
+               'ip_permissions_file_format', 'fingerprint_cache',
+               'fingerprint_cache_dir', 'fingerprint_cache_max_age')
+    spec = dict(
+        (key, value) for (key, value) in module.params.items()
+        if key not in ignored
+    )
+    digest = hashlib.sha256(
+        json.dumps(spec, sort_keys=True, default=str).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def reconcile_security_group_cached(module, result, compaction):
+    # the detailed diff is skipped while the desired spec is unchanged
+    # and the firewall group is the same as the one observed last time
+    directory = module.params.get('fingerprint_cache_dir') or \
+        FINGERPRINT_CACHE_DIR
+    make_cache_dir(module, result, directory, 'fingerprint_cache_dir')
+    max_age = module.params.get('fingerprint_cache_max_age')
+    if max_age is None:
+        max_age = FINGERPRINT_CACHE_MAX_AGE
+
+    key = hashlib.sha256('{0}/{1}'.format(
+        module.params['endpoint'],
+        module.params['group_name']).encode('utf-8')).hexdigest()
+    cache_path = os.path.join(directory, key + '.json')
+    desired = get_desired_fingerprint(module)
+
+    # the result of the cache hit has the same keys as the detailed diff
+    cached = load_fingerprint(cache_path, max_age)
+    if cached is not None and cached.get('desired') == desired:
+        state, observed, rules = get_security_group_fingerprint(module)
+        if state == 'present' and observed == cached.get('observed'):
+            result = dict(result, state='present', changed=False,
+                          fingerprint_cache='hit')
+            if compaction is not None:
+                result['ip_permissions_compaction'] = compaction
+            result['ip_permissions_plan'] = \
+                get_in_sync_ip_permissions_plan(module, rules)
+            return result
+
+    result, security_group_info = ensure_security_group(module, result)
+    result = apply_ip_permissions(module, result, security_group_info,
+                                  compaction)
+
+    # the changes are not applied in check mode
+    if not (module.check_mode and result['changed']):
+        state, observed, rules = get_security_group_fingerprint(module)
+        if state == 'present':
+            save_fingerprint(cache_path,
+                             dict(desired=desired, observed=observed))
+
+    return dict(result, fingerprint_cache='miss')
+
+
+def run(module):
+    if module.params.get('security_groups') and (
+            module.params.get('coalesce') or
+            module.params.get('fingerprint_cache')):
+        fail(module, dict(), 'coalesce and fingerprint_cache can not be used '
+                             'with security_groups')
+
+    if module.params.get('security_groups'):
+        result = reconcile_security_groups(module)
+    elif module.params.get('coalesce'):
+        result = reconcile_security_group_coalesced(module)
+    else:
+        result = reconcile_security_group(module)
+    module.exit_json(**result)
 
 
 def main():
@@ -787,7 +1986,7 @@ def main():
             access_key=dict(required=True,  type='str'),
             secret_access_key=dict(required=True,  type='str',  no_log=True),
             endpoint=dict(required=True,  type='str'),
-            group_name=dict(required=True,  type='str',  aliases=['name']),
+            group_name=dict(required=False, type='str',  aliases=['name']),
             description=dict(required=False, type='str',  default=None),
             availability_zone=dict(required=False, type='str',  default=None),
             log_limit=dict(required=False, type='int',  default=None),
@@ -797,7 +1996,43 @@ def main():
             purge_ip_permissions=dict(required=False, type='bool',
                                       default=True),
             authorize_in_bulk=dict(required=False, type='bool', default=False),
+            compact_ip_permissions=dict(required=False, type='bool',
+                                        default=False),
+            ip_permissions_file=dict(required=False, type='path',
+                                     default=None),
+            ip_permissions_file_format=dict(required=False, type='str',
+                                            default=None,
+                                            choices=['csv', 'jsonl', 'yaml']),
+            ip_permissions_strategy=dict(required=False, type='str',
+                                         default='incremental',
+                                         choices=(IP_PERMISSIONS_STRATEGIES +
+                                                  ['auto'])),
+            ip_permissions_per_request=dict(required=False, type='int',
+                                            default=None),
+            wait_timeout=dict(required=False, type='int',
+                              default=WAIT_TIMEOUT),
+            wait_interval=dict(required=False, type='int',
+                               default=WAIT_INTERVAL),
+            wait_max_interval=dict(required=False, type='int',
+                                   default=WAIT_MAX_INTERVAL),
+            coalesce=dict(required=False, type='bool', default=False),
+            coalesce_dir=dict(required=False, type='path', default=None),
+            coalesce_ttl=dict(required=False, type='int',
+                              default=COALESCE_TTL),
+            coalesce_timeout=dict(required=False, type='int',
+                                  default=COALESCE_TIMEOUT),
+            fingerprint_cache=dict(required=False, type='bool',
+                                   default=False),
+            fingerprint_cache_dir=dict(required=False, type='path',
+                                       default=None),
+            fingerprint_cache_max_age=dict(required=False, type='int',
+                                           default=FINGERPRINT_CACHE_MAX_AGE),
+            security_groups=dict(required=False, type='list', default=None),
+            max_workers=dict(required=False, type='int',
+                             default=MAX_WORKERS),
         ),
+        required_one_of=[['group_name', 'security_groups']],
+        mutually_exclusive=[['group_name', 'security_groups']],
         supports_check_mode=True
     )
     run(module)
@@ -18,8 +18,13 @@
 import base64
 import hashlib
 import hmac
+import json
+import os
+import tempfile
 import time
+import uuid
 import xml.etree.ElementTree as etree
+from multiprocessing.pool import ThreadPool
 
 import requests
 from ansible.module_utils.basic import *  # noqa
@@ -31,6 +36,25 @@ except ImportError:
     # Python 3
     from urllib.parse import quote, urlencode
 
+try:
+    import fcntl
+    HAS_FCNTL = True
+except ImportError:
+    HAS_FCNTL = False
+
+try:
+    import ipaddress
+    HAS_IPADDRESS = True
+except ImportError:
+    HAS_IPADDRESS = False
+
+try:
+    # Python 2
+    unicode  # noqa
+except NameError:
+    # Python 3
+    unicode = str
+
 DOCUMENTATION = '''
 ---
 module: nifcloud_lb
@@ -53,16 +77,18 @@ options:
         required: true
     loadbalancer_name:
         description:
-            - Target Load Balancer name
-        required: true
+            - Target Load Balancer name (required unless load_balancers is given)
+        required: false
     loadbalancer_port:
         description:
             - Target Load Balancer port number
-        required: true
+            - Required unless listeners is given
+        required: false
     instance_port:
         description:
             - Destination port number
-        required: true
+            - Required unless listeners is given
+        required: false
     balancing_type:
         description:
             - Balancing type (1: Round-Robin or 2: Least-Connection)
@@ -113,6 +139,11 @@ options:
             - Purge existing filter ip addresses that are not found in filter_ip_addresses
         required: false
         default: true
+    filter_ip_addresses_per_request:
+        description:
+            - The upper limit number of filter ip addresses sent with one SetFilterForLoadBalancer request (all in one request if not specified)
+        required: false
+        default: null
     health_check_target:
         description:
             - Health check protocol and port
@@ -133,6 +164,90 @@ options:
             - SSL policy template name
         required: false
         default: ''
+    instance_ids_per_request:
+        description:
+            - The upper limit number of instance ids sent with one register/deregister request (all in one request if not specified)
+        required: false
+        default: null
+    max_workers:
+        description:
+            - Number of register/deregister requests of instance ids sent concurrently
+        required: false
+        default: 1
+    parallel_sync:
+        description:
+            - Send the changes of filter, health check, SSL policy and instances concurrently, and verify them with one describe
+        required: false
+        default: false
+    rolling:
+        description:
+            - Replace instances in waves. Each wave of new instances has to be InService before the same number of old instances is deregistered
+        required: false
+        default: false
+    rolling_wave_size:
+        description:
+            - Number of instances registered in each wave of rolling
+        required: false
+        default: 1
+    rolling_timeout:
+        description:
+            - Seconds to wait until each wave of rolling becomes InService
+        required: false
+        default: 600
+    wait_timeout:
+        description:
+            - Seconds to wait until the load balancer or the port is created
+        required: false
+        default: 600
+    wait_interval:
+        description:
+            - The first interval seconds to poll the load balancer after it is created, and the instances of each wave of rolling until InService. The interval is doubled at each poll
+        required: false
+        default: 2
+    wait_max_interval:
+        description:
+            - The upper limit seconds of the interval to poll the load balancer and the instances of rolling
+        required: false
+        default: 60
+    load_balancers:
+        description:
+            - List of load balancers reconciled at once with one DescribeLoadBalancers instead of loadbalancer_name, loadbalancer_port and instance_port
+            - Each item takes loadbalancer_name, loadbalancer_port and instance_port, and optionally the other options of the module
+            - Options not given in an item default to the module options
+        required: false
+        default: null
+    load_balancers_max_workers:
+        description:
+            - Number of load balancers of load_balancers reconciled concurrently
+        required: false
+        default: 10
+    coalesce:
+        description:
+            - Register instance_ids of the forks on the control node targeting the same listener with one request. One fork registers the queued instance ids of all forks, and purge_instance_ids is not applied
+        required: false
+        default: false
+    coalesce_dir:
+        description:
+            - Directory of the lock, queue and result files for coalesce
+        required: false
+        default: '(temporary directory)/ansible-nifcloud-lb'
+    coalesce_window:
+        description:
+            - Seconds for which the registering fork waits for the instance ids of the other forks
+        required: false
+        default: 2
+    coalesce_timeout:
+        description:
+            - Seconds to wait for the fork registering the instance ids
+        required: false
+        default: 1800
+    listeners:
+        description:
+            - List of listeners reconciled at once instead of loadbalancer_port and instance_port
+            - Each item takes loadbalancer_port and instance_port, and optionally balancing_type, instance_ids, purge_instance_ids, filter_ip_addresses, filter_type, purge_filter_ip_addresses, health_check_target, health_check_interval, health_check_unhealthy_threshold and ssl_policy_name
+            - Options not given in an item default to the module options
+        required: false
+        default: null
     state:
         description:
             - Goal status (only "present")
@@ -146,35 +261,221 @@ EXAMPLES = '''
 
 ISO8601 = '%Y-%m-%dT%H:%M:%SZ'
 
+MAX_WORKERS = 1
+LOAD_BALANCERS_MAX_WORKERS = 10
+
+ROLLING_WAVE_SIZE = 1
+ROLLING_TIMEOUT = 600
+
+WAIT_TIMEOUT = 600
+WAIT_INTERVAL = 2
+WAIT_MAX_INTERVAL = 60
+WAIT_BACKOFF_FACTOR = 2
+
+COALESCE_DIR = os.path.join(tempfile.gettempdir(), 'ansible-nifcloud-lb')
+COALESCE_WINDOW = 2
+COALESCE_TIMEOUT = 1800
+COALESCE_POLL_INTERVAL = 0.5
+
+# options of each listener, which default to the module options
+LISTENER_KEYS = (
+    'loadbalancer_port', 'instance_port', 'balancing_type',
+    'instance_ids', 'purge_instance_ids',
+    'filter_ip_addresses', 'filter_type', 'purge_filter_ip_addresses',
+    'health_check_target', 'health_check_interval',
+    'health_check_unhealthy_threshold', 'ssl_policy_name',
+)
+
+
+class LoadBalancerListener(object):
+    """Model of NIFCLOUD LoadBalancer Listener"""
+
+    __slots__ = ('loadbalancer_port', 'instance_port', 'balancing_type')
+
+    def __init__(self, loadbalancer_port=None, instance_port=None,
+                 balancing_type=None):
+        self.loadbalancer_port = loadbalancer_port
+        self.instance_port = instance_port
+        self.balancing_type = balancing_type
+
+    def get_key(self):
+        return (self.loadbalancer_port, self.instance_port)
+
+    def parse(self, element, nc):
+        self.loadbalancer_port = find_int(element, nc + 'LoadBalancerPort')
+        self.instance_port = find_int(element, nc + 'InstancePort')
+        self.balancing_type = find_int(element, nc + 'BalancingType',
+                                       find_int(element,
+                                                nc + 'balancingType'))
+
+
+class LoadBalancerFilter(object):
+    """Model of NIFCLOUD LoadBalancer Filter"""
+
+    __slots__ = ('filter_type', 'ip_addresses')
 
-class LoadBalancerHealthCheck:
+    def __init__(self, filter_type=1, ip_addresses=None):
+        self.filter_type = filter_type
+        self.ip_addresses = ip_addresses or []
+
+    def parse(self, element, nc):
+        self.filter_type = find_int(element, nc + 'FilterType',
+                                    self.filter_type)
+
+        self.ip_addresses = []
+        ip_addresses = element.find(nc + 'IPAddresses')
+        if ip_addresses is None:
+            return
+
+        for member in ip_addresses.findall(nc + 'member'):
+            for ip_address in member.findall(nc + 'IPAddress'):
+                # DescribeLoadBalancers returns ['*.*.*.*'] when none
+                # filter ip.
+                if ip_address.text != '*.*.*.*':
+                    self.ip_addresses.append(ip_address.text)
+
+    def diff(self, ip_addresses, purge):
+        # addresses are compared in the normalized notation, and the current
+        # ones are purged in the notation returned by the load balancer.
+        current_ips = dict(
+            (normalize_ip_address(ip), ip) for ip in self.ip_addresses
+        )
+        desired_ips = set(normalize_ip_address(ip) for ip in ip_addresses)
+
+        purge_ip_list = []
+        if purge:
+            purge_ip_list = sorted(current_ips[ip] for ip
+                                   in set(current_ips) - desired_ips)
+
+        merge_ip_list = sorted(desired_ips - set(current_ips))
+
+        return (purge_ip_list, merge_ip_list)
+
+
+class LoadBalancerHealthCheck(object):
     """Model of NIFCLOUD LoadBalancer HealthCheck """
 
+    __slots__ = ('target', 'interval', 'unhealthy_threshold')
+
     def __init__(self, target='ICMP', interval=5, unhealthy_threshold=1):
         self.target = target
         self.interval = interval
         self.unhealthy_threshold = unhealthy_threshold
 
     def __eq__(self, other):
-        if other is None or type(self) != type(other):
+        if not isinstance(other, LoadBalancerHealthCheck):
             return False
 
-        return self.__dict__ == other.__dict__
+        return all(getattr(self, key) == getattr(other, key)
+                   for key in self.__slots__)
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
+    def parse(self, element, nc):
+        self.target = find_text(element, nc + 'Target', self.target)
+        self.interval = find_int(element, nc + 'Interval', self.interval)
+        self.unhealthy_threshold = find_int(
+            element, nc + 'UnhealthyThreshold', self.unhealthy_threshold)
+
+    def diff(self, health_check):
+        if self == health_check:
+            return None
+        return health_check
+
+
+class LoadBalancerInstances(object):
+    """Model of the instances registered in NIFCLOUD LoadBalancer"""
+
+    __slots__ = ('instance_ids',)
+
+    def __init__(self, instance_ids=None):
+        self.instance_ids = instance_ids or []
+
+    def parse(self, element, nc):
+        for member in element.findall(nc + 'member'):
+            instance_id = member.find(nc + 'InstanceId')
+            if instance_id is not None:
+                self.instance_ids.append(instance_id.text)
+
+    def diff(self, instance_ids, purge):
+        current_ids = set(self.instance_ids)
+        desired_ids = set(instance_ids)
+
+        deregister_instance_ids = []
+        if purge:
+            deregister_instance_ids = sorted(current_ids - desired_ids)
+
+        register_instance_ids = sorted(desired_ids - current_ids)
+
+        return (deregister_instance_ids, register_instance_ids)
+
+
+class LoadBalancerSnapshot(object):
+    """Model of the target listener in NIFCLOUD DescribeLoadBalancers"""
+
+    __slots__ = ('listener', 'filter', 'health_check', 'ssl_policy_name',
+                 'instances')
+
+    def __init__(self):
+        self.listener = LoadBalancerListener()
+        self.filter = LoadBalancerFilter()
+        self.health_check = LoadBalancerHealthCheck()
+        self.ssl_policy_name = ''
+        self.instances = LoadBalancerInstances()
+
     def parse_describe(self, res):
-        health_check = res['xml_body'].find(
-            './/{{{nc}}}HealthCheck'.format(**res['xml_namespace']))
+        # the response is traversed once. the describe is narrowed to the
+        # target listener, so the first element of each kind is taken, and
+        # the instance ids are collected from every element as before.
+        nc = '{{{nc}}}'.format(**res['xml_namespace'])
+        parsers = {
+            nc + 'Listener': self.listener.parse,
+            nc + 'Filter': self.filter.parse,
+            nc + 'HealthCheck': self.health_check.parse,
+            nc + 'SSLPolicy': self._parse_ssl_policy,
+        }
+        instances_tag = nc + 'Instances'
+
+        for element in res['xml_body'].iter():
+            if element.tag == instances_tag:
+                self.instances.parse(element, nc)
+                continue
+
+            parser = parsers.pop(element.tag, None)
+            if parser is not None:
+                parser(element, nc)
+
+    def _parse_ssl_policy(self, element, nc):
+        self.ssl_policy_name = find_text(element, nc + 'SSLPolicyName',
+                                         self.ssl_policy_name)
+
+
+class LoadBalancerError(Exception):
+    """Failure of one load balancer in the load_balancers mode"""
+
+    def __init__(self, **kwargs):
+        super(LoadBalancerError, self).__init__(kwargs.get('msg'))
+        self.kwargs = kwargs
+
+
+class LoadBalancerModule(object):
+    """Module with parameters of one load balancer in the load_balancers mode
+
+    fail_json() raises LoadBalancerError instead of exiting, so that
+    the failure is reported once by the main thread.
+    """
+
+    def __init__(self, module, spec):
+        self.check_mode = module.check_mode
+        self.params = dict(
+            (key, value) for (key, value) in module.params.items()
+            if key not in ('load_balancers', 'listeners')
+        )
+        self.params.update(spec)
 
-        if health_check is not None:
-            self.target = health_check.find(
-                './/{{{nc}}}Target'.format(**res['xml_namespace'])).text
-            self.interval = int(health_check.find(
-                './/{{{nc}}}Interval'.format(**res['xml_namespace'])).text)
-            self.unhealthy_threshold = int(health_check.find(
-                './/{{{nc}}}UnhealthyThreshold'.format(**res['xml_namespace'])).text)  # noqa
+    def fail_json(self, **kwargs):
+        raise LoadBalancerError(**kwargs)
 
 
 class LoadBalancerManager:
@@ -204,28 +505,166 @@ class LoadBalancerManager:
         self.filter_ip_addresses = module.params['filter_ip_addresses']
         self.filter_type = module.params['filter_type']
         self.purge_filter_ip_addresses = module.params['purge_filter_ip_addresses']  # noqa
+        self.filter_ip_addresses_per_request = module.params.get('filter_ip_addresses_per_request')  # noqa
         self.health_check_target = module.params['health_check_target']
         self.health_check_interval = module.params['health_check_interval']
         self.health_check_unhealthy_threshold = module.params['health_check_unhealthy_threshold']  # noqa
         self.ssl_policy_name = module.params['ssl_policy_name']
         self.state = module.params['state']
+        self.instance_ids_per_request = module.params.get('instance_ids_per_request')  # noqa
+        self.max_workers = module.params.get('max_workers') or MAX_WORKERS
+        self.parallel_sync = module.params.get('parallel_sync') or False
+        self.rolling = module.params.get('rolling') or False
+        self.rolling_wave_size = module.params.get('rolling_wave_size') or ROLLING_WAVE_SIZE  # noqa
+        self.rolling_timeout = module.params.get('rolling_timeout')
+        if self.rolling_timeout is None:
+            self.rolling_timeout = ROLLING_TIMEOUT
+        self.wait_timeout = get_param(module, 'wait_timeout', WAIT_TIMEOUT)
+        self.wait_interval = get_param(module, 'wait_interval', WAIT_INTERVAL)
+        self.wait_max_interval = get_param(module, 'wait_max_interval',
+                                           WAIT_MAX_INTERVAL)
+
+        self.listeners = None
+        if module.params.get('listeners'):
+            for listener in module.params['listeners']:
+                if not isinstance(listener, dict) or \
+                   listener.get('loadbalancer_port') is None or \
+                   listener.get('instance_port') is None:
+                    module.fail_json(
+                        status=-1,
+                        msg='loadbalancer_port and instance_port are '
+                            'required for each of listeners'
+                    )
+            self.listeners = [
+                dict(
+                    dict((key, module.params.get(key))
+                         for key in LISTENER_KEYS),
+                    **listener
+                )
+                for listener in module.params['listeners']
+            ]
 
         self.current_state = ''
         self.changed = False
         self.result = dict()
+        # seconds until the last wait for the load balancer status ended
+        self.seconds_to_ready = None
 
-    def ensure_present(self):
-        self.current_state = self._get_state_instance_in_load_balancer()
+        # parsed DescribeLoadBalancers, shared by the syncs until a change
+        self.snapshot = None
+
+    def ensure_present(self, described_state=None):
+        if self.listeners is not None:
+            self._ensure_listeners_present()
+            return
+
+        if described_state is None:
+            self.current_state = self._get_state_instance_in_load_balancer()
+        else:
+            # described with the other load balancers in advance
+            (self.current_state, self.snapshot) = described_state
 
         if self.current_state == 'absent':
             self._create_load_balancer()
         elif self.current_state == 'port-not-found':
             self._register_port()
 
-        self._sync_filter()
-        self._sync_health_check()
-        self._sync_ssl_policy()
-        self._sync_instances()
+        self._sync_listener()
+
+    def _ensure_listeners_present(self):
+        # all listeners are described at once, and the ones not found are
+        # created or registered with one request.
+        self._select_listener(self.listeners[0])
+        snapshots = self._describe_listeners()
+
+        changed_listeners = False
+        if snapshots is None:
+            self.current_state = 'absent'
+            self._create_load_balancer(self.listeners)
+            snapshots = dict()
+            changed_listeners = True
+        else:
+            self.current_state = 'present'
+            missing_listeners = [
+                listener for listener in self.listeners
+                if self._get_listener_key(listener) not in snapshots
+            ]
+            if len(missing_listeners) != 0:
+                self.current_state = 'port-not-found'
+                self._register_port(missing_listeners)
+                changed_listeners = True
+
+        # described again after all the listeners are ready
+        if changed_listeners and not self.module.check_mode:
+            self._select_listener(self.listeners[0])
+            snapshots = self._describe_listeners() or dict()
+            self.current_state = 'present'
+
+        result = self.result
+        listener_results = []
+        for listener in self.listeners:
+            self._select_listener(listener)
+            self.snapshot = snapshots.get(self._get_listener_key(listener))
+            if self.snapshot is None:
+                # not created yet in check mode
+                self.snapshot = LoadBalancerSnapshot()
+
+            self.result = dict()
+            self._sync_listener()
+            listener_results.append(dict(
+                loadbalancer_port=self.loadbalancer_port,
+                instance_port=self.instance_port,
+                **self.result
+            ))
+
+        self.result = dict(result, listeners=listener_results)
+
+    def _select_listener(self, listener):
+        for key in LISTENER_KEYS:
+            setattr(self, key, listener[key])
+
+    def _get_listener_key(self, listener):
+        return (int(listener['loadbalancer_port']),
+                int(listener['instance_port']))
+
+    def _describe_listeners(self):
+        params = dict()
+        params['LoadBalancerNames.member.1'] = self.loadbalancer_name
+        res = self._describe_load_balancers(params)
+
+        if res['status'] != 200:
+            error_info = get_api_error(res['xml_body'])
+            if error_info.get('code') == self._ERROR_LB_NAME_NOT_FOUND:
+                return None
+            self._fail_request(res, 'check current state failed')
+
+        namespace = res['xml_namespace']
+        snapshots = dict()
+        members_key = './/{{{nc}}}LoadBalancerDescriptions/{{{nc}}}member'.format(**namespace)  # noqa
+        for member in res['xml_body'].findall(members_key):
+            name = member.find('{{{nc}}}LoadBalancerName'.format(**namespace))
+            if name is None or name.text != self.loadbalancer_name:
+                continue
+
+            snapshot = LoadBalancerSnapshot()
+            snapshot.parse_describe(dict(res, xml_body=member))
+            snapshots[snapshot.listener.get_key()] = snapshot
+
+        return snapshots
+
+    def _set_listener_params(self, params, listeners):
+        if listeners is None:
+            listeners = [dict(
+                loadbalancer_port=self.loadbalancer_port,
+                instance_port=self.instance_port,
+                balancing_type=self.balancing_type,
+            )]
+
+        for index, listener in enumerate(listeners):
+            prefix = 'Listeners.member.{0}.'.format(index + 1)
+            params[prefix + 'LoadBalancerPort'] = listener['loadbalancer_port']  # noqa
+            params[prefix + 'InstancePort'] = listener['instance_port']
+            params[prefix + 'BalancingType'] = listener['balancing_type']
 
     def _describe_load_balancers(self, params):
         return request_to_api(self.module, 'GET', 'DescribeLoadBalancers',
@@ -238,10 +677,21 @@ class LoadBalancerManager:
         params['LoadBalancerNames.InstancePort.1'] = self.instance_port
         return self._describe_load_balancers(params)
 
+    def _get_snapshot(self):
+        if self.snapshot is None:
+            res = self._describe_current_load_balancers()
+            self.snapshot = LoadBalancerSnapshot()
+            self.snapshot.parse_describe(res)
+
+        return self.snapshot
+
     def _get_state_instance_in_load_balancer(self):
         res = self._describe_current_load_balancers()
+        self.snapshot = None
 
         if res['status'] == 200:
+            self.snapshot = LoadBalancerSnapshot()
+            self.snapshot.parse_describe(res)
             return 'present'
         else:
             error_info = get_api_error(res['xml_body'])
@@ -259,12 +709,10 @@ class LoadBalancerManager:
     def _is_absent_in_load_balancer(self):
         return self._get_state_instance_in_load_balancer() == 'absent'
 
-    def _create_load_balancer(self):
+    def _create_load_balancer(self, listeners=None):
         params = dict()
         params['LoadBalancerName'] = self.loadbalancer_name
-        params['Listeners.member.1.LoadBalancerPort'] = self.loadbalancer_port
-        params['Listeners.member.1.InstancePort'] = self.instance_port
-        params['Listeners.member.1.BalancingType'] = self.balancing_type
+        self._set_listener_params(params, listeners)
         params['NetworkVolume'] = self.network_volume
         params['IpVersion'] = self.ip_version
         params['AccountingType'] = self.accounting_type
@@ -283,25 +731,36 @@ class LoadBalancerManager:
 
         failed_msg = 'changes failed (create_load_balancer)'
         if res['status'] == 200:
-            if self._wait_for_loadbalancer_status('present'):
+            ready = self._wait_for_listeners(listeners)
+            self.result['create_load_balancer']['seconds_to_ready'] = \
+                self.seconds_to_ready
+            if ready:
                 self.changed = True
             else:
                 self._fail_request(res, failed_msg)
         else:
             self._fail_request(res, failed_msg)
 
-    def _register_port(self):
+    def _register_port(self, listeners=None):
         params = dict()
         params['LoadBalancerName'] = self.loadbalancer_name
-        params['Listeners.member.1.LoadBalancerPort'] = self.loadbalancer_port
-        params['Listeners.member.1.InstancePort'] = self.instance_port
-        params['Listeners.member.1.BalancingType'] = self.balancing_type
-
-        self.result['register_port'] = dict(
-            loadbalancer_name=self.loadbalancer_name,
-            loadbalancer_port=self.loadbalancer_port,
-            instance_port=self.instance_port,
-        )
+        self._set_listener_params(params, listeners)
+
+        if listeners is None:
+            self.result['register_port'] = dict(
+                loadbalancer_name=self.loadbalancer_name,
+                loadbalancer_port=self.loadbalancer_port,
+                instance_port=self.instance_port,
+            )
+        else:
+            self.result['register_port'] = dict(
+                loadbalancer_name=self.loadbalancer_name,
+                listeners=[
+                    dict(loadbalancer_port=listener['loadbalancer_port'],
+                         instance_port=listener['instance_port'])
+                    for listener in listeners
+                ],
+            )
 
         if self.module.check_mode:
             self.changed = True
@@ -312,135 +771,242 @@ class LoadBalancerManager:
 
         failed_msg = 'changes failed (register_port)'
         if res['status'] == 200:
-            if self._wait_for_loadbalancer_status('present'):
+            ready = self._wait_for_listeners(listeners)
+            self.result['register_port']['seconds_to_ready'] = \
+                self.seconds_to_ready
+            if ready:
                 self.changed = True
             else:
                 self._fail_request(res, failed_msg)
         else:
             self._fail_request(res, failed_msg)
 
-    def _wait_for_loadbalancer_status(self, goal_state):
-        self.current_state = self._get_state_instance_in_load_balancer()
+    def _wait_for_listeners(self, listeners):
+        # each of the listeners is waited, since the selected listener may
+        # exist already while the others are not ready yet.
+        if listeners is None:
+            return self._wait_for_loadbalancer_status('present')
 
-        if self.current_state == goal_state:
-            return True
+        seconds_to_ready = 0
+        ready = True
+        for listener in listeners:
+            self._select_listener(listener)
+            ready = self._wait_for_loadbalancer_status('present')
+            seconds_to_ready += self.seconds_to_ready or 0
+            if not ready:
+                break
 
-        retry_count = 10
-        while retry_count > 0 and self.current_state != goal_state:
-            time.sleep(60)
-            self.current_state = self._get_state_instance_in_load_balancer()
-            retry_count -= 1
+        self.seconds_to_ready = round(seconds_to_ready, 3)
+        return ready
 
-        return self.current_state == goal_state
+    def _wait_for_loadbalancer_status(self, goal_state):
+        # poll immediately, and back off exponentially until the deadline.
+        # the elapsed time also counts the requested sleeps so that the
+        # deadline is kept even if the clock does not advance.
+        start = time.time()
+        slept = 0
+        delay = self.wait_interval
+
+        while True:
+            self.current_state = self._get_state_instance_in_load_balancer()
+            elapsed = max(time.time() - start, slept)
+            if self.current_state == goal_state \
+               or elapsed >= self.wait_timeout:
+                break
 
-    def _sync_filter(self):
-        res_desc = self._describe_current_load_balancers()
+            delay = min(delay, self.wait_timeout - elapsed)
+            time.sleep(delay)
+            slept += delay
+            delay = min(delay * WAIT_BACKOFF_FACTOR, self.wait_max_interval)
 
-        current_filter_type = self._parse_filter_type(res_desc)
-        (purge_ip_list, merge_ip_list) = self._extract_filter_ip_diff(res_desc)
+        self.seconds_to_ready = round(elapsed, 3)
+        return self.current_state == goal_state
 
-        if (self.filter_type == current_filter_type) \
-           and (len(purge_ip_list) == 0) and (len(merge_ip_list) == 0):
+    def _sync_listener(self):
+        if self.parallel_sync:
+            self._sync_in_parallel()
             return
 
-        self.result['sync_filter'] = dict(
-            purge_filter_ip_addresses=purge_ip_list,
-            merge_filter_ip_addresses=merge_ip_list,
-            filter_type=self.filter_type,
-        )
-
-        params = dict()
-        params['LoadBalancerName'] = self.loadbalancer_name
-        params['LoadBalancerPort'] = self.loadbalancer_port
-        params['InstancePort'] = self.instance_port
-        params['FilterType'] = self.filter_type
-
-        ip_no = 1
-
-        for ip in purge_ip_list:
-            params['IPAddresses.member.{0}.IPAddress'.format(ip_no)] = ip
-            addon_key = 'IPAddresses.member.{0}.AddOnFilter'.format(ip_no)
-            params[addon_key] = 'false'
-            ip_no = ip_no + 1
+        self._sync_filter()
+        self._sync_health_check()
+        self._sync_ssl_policy()
+        self._sync_instances()
 
-        for ip in merge_ip_list:
-            params['IPAddresses.member.{0}.IPAddress'.format(ip_no)] = ip
-            addon_key = 'IPAddresses.member.{0}.AddOnFilter'.format(ip_no)
-            params[addon_key] = 'true'
-            ip_no = ip_no + 1
+    def _sync_in_parallel(self):
+        # the independent writes are computed from one snapshot and sent at
+        # once, and the result is verified with a single describe.
+        snapshot = self._get_snapshot()
+        sync_requests = self._build_sync_requests(snapshot)
+        for request in sync_requests:
+            self.result[request['name']] = request['result']
 
         if self.module.check_mode:
-            self.changed = True
+            if len(sync_requests) != 0:
+                self.changed = True
+            self._sync_instances()
             return
 
-        api_name = 'SetFilterForLoadBalancer'
-        res_post = request_to_api(self.module, 'POST', api_name, params)
-
-        if res_post['status'] == 200:
-            self.changed = True
+        def send(request):
+            return (request, self._request_sync(request))
+
+        responses = []
+        if len(sync_requests) != 0:
+            pool = ThreadPool(len(sync_requests))
+            try:
+                async_responses = pool.map_async(send, sync_requests)
+                # instances are changed while the other writes run
+                self._sync_instances()
+                responses = async_responses.get()
+            finally:
+                pool.close()
+                pool.join()
         else:
-            self._fail_request(res_post, 'changes failed (set_filter)')
+            self._sync_instances()
 
-    def _parse_filter_type(self, res):
-        filter_type = 1
+        failed_responses = []
+        for (request, (sent, res)) in responses:
+            if sent != 0:
+                self.changed = True
+            if res['status'] != 200:
+                failed_responses.append((request, res))
 
-        filter = res['xml_body'].find(
-            './/{{{nc}}}Filter'.format(**res['xml_namespace']))
+        if self.changed:
+            self.snapshot = None
 
-        if filter is not None:
-            filter_type = int(filter.find(
-                './/{{{nc}}}FilterType'.format(**res['xml_namespace'])).text)
+        if len(failed_responses) != 0:
+            (request, res) = failed_responses[0]
+            self._fail_request(res, request['msg'])
 
-        return filter_type
+        if self.changed:
+            self._verify_sync()
 
-    def _extract_filter_ip_diff(self, res):
-        filter_ip_list = []
+    def _verify_sync(self):
+        snapshot = self._get_snapshot()
 
-        filter = res['xml_body'].find(
-            './/{{{nc}}}Filter'.format(**res['xml_namespace']))
+        unsynced = [request['name']
+                    for request in self._build_sync_requests(snapshot)]
+        (deregister_instance_ids, register_instance_ids) = \
+            self._extract_instance_ids_diff(snapshot)
+        if len(deregister_instance_ids) != 0 \
+           or len(register_instance_ids) != 0:
+            unsynced.append('sync_instances')
+
+        if len(unsynced) != 0:
+            self.module.fail_json(
+                status=-1,
+                msg='changes not applied ({0})'.format(', '.join(unsynced)),
+                changed=self.changed,
+            )
+
+    def _build_sync_requests(self, snapshot):
+        sync_requests = (
+            self._build_filter_request(snapshot),
+            self._build_health_check_request(snapshot),
+            self._build_ssl_policy_request(snapshot),
+        )
+        return [request for request in sync_requests if request is not None]
 
-        if filter is not None:
-            addresses_key = './/{{{nc}}}IPAddresses/{{{nc}}}member/{{{nc}}}IPAddress'.format(**res['xml_namespace'])  # noqa
-            address_elements = filter.findall(addresses_key)
-            filter_ip_list = [x.text for x in address_elements]
+    def _send_sync_request(self, request):
+        self.result[request['name']] = request['result']
 
-            # DescribeLoadBalancers returns ['*.*.*.*'] when none filter ip.
-            filter_ip_list = [x for x in filter_ip_list if x != '*.*.*.*']
+        if self.module.check_mode:
+            self.changed = True
+            return
 
-        purge_ip_list = []
-        if self.purge_filter_ip_addresses:
-            purge_ip_list = list(set(filter_ip_list)
-                                 - set(self.filter_ip_addresses))
+        (sent, res_post) = self._request_sync(request)
 
-        merge_ip_list = list(set(self.filter_ip_addresses)
-                             - set(filter_ip_list))
+        if sent != 0:
+            self.changed = True
+            self.snapshot = None
 
-        return (purge_ip_list, merge_ip_list)
+        if res_post['status'] != 200:
+            self._fail_request(res_post, request['msg'])
 
-    def _sync_health_check(self):
-        res_desc = self._describe_current_load_balancers()
+    def _request_sync(self, request):
+        # the chunks are sent in order until one of them fails. the number
+        # of the succeeded chunks and the last response are returned.
+        sent = 0
+        res = None
+        for params in request['params_list']:
+            res = request_to_api(self.module, 'POST', request['api_name'],
+                                 params)
+            if res['status'] != 200:
+                break
+            sent += 1
 
-        current = LoadBalancerHealthCheck()
-        current.parse_describe(res_desc)
+        return (sent, res)
 
-        change = LoadBalancerHealthCheck(
-                    target=self.health_check_target,
-                    interval=self.health_check_interval,
-                    unhealthy_threshold=self.health_check_unhealthy_threshold,
-                )
+    def _sync_filter(self):
+        request = self._build_filter_request(self._get_snapshot())
+        if request is not None:
+            self._send_sync_request(request)
 
-        if current == change:
-            return
+    def _build_filter_request(self, snapshot):
+        current_filter_type = snapshot.filter.filter_type
+        (purge_ip_list, merge_ip_list) = self._extract_filter_ip_diff(snapshot)
 
-        self.result['sync_health_check'] = dict(
-            health_check_target=change.target,
-            health_check_interval=change.interval,
-            health_check_unhealthy_threshold=change.unhealthy_threshold,
+        if (self.filter_type == current_filter_type) \
+           and (len(purge_ip_list) == 0) and (len(merge_ip_list) == 0):
+            return None
+
+        # the addresses are merged before purged, and the filter type is
+        # changed by the last chunk, so that the filter is not emptied
+        # (allow all) or switched while the old addresses are attached.
+        addresses = [(ip, 'true') for ip in merge_ip_list] + \
+            [(ip, 'false') for ip in purge_ip_list]
+        chunks = split_into_chunks(addresses,
+                                   self.filter_ip_addresses_per_request)
+
+        params_list = []
+        # only the filter type is changed without addresses
+        chunks = chunks or [[]]
+        for (index, chunk) in enumerate(chunks):
+            params = dict()
+            params['LoadBalancerName'] = self.loadbalancer_name
+            params['LoadBalancerPort'] = self.loadbalancer_port
+            params['InstancePort'] = self.instance_port
+            if index == len(chunks) - 1:
+                params['FilterType'] = self.filter_type
+
+            ip_no = 1
+            for (ip, add_on_filter) in chunk:
+                params['IPAddresses.member.{0}.IPAddress'.format(ip_no)] = ip
+                addon_key = 'IPAddresses.member.{0}.AddOnFilter'.format(ip_no)
+                params[addon_key] = add_on_filter
+                ip_no = ip_no + 1
+
+            params_list.append(params)
+
+        return dict(
+            name='sync_filter',
+            result=dict(
+                purge_filter_ip_addresses=purge_ip_list,
+                merge_filter_ip_addresses=merge_ip_list,
+                filter_type=self.filter_type,
+            ),
+            api_name='SetFilterForLoadBalancer',
+            params_list=params_list,
+            msg='changes failed (set_filter)',
         )
 
-        if self.module.check_mode:
-            self.changed = True
-            return
+    def _extract_filter_ip_diff(self, snapshot):
+        return snapshot.filter.diff(self.filter_ip_addresses,
+                                    self.purge_filter_ip_addresses)
+
+    def _sync_health_check(self):
+        request = self._build_health_check_request(self._get_snapshot())
+        if request is not None:
+            self._send_sync_request(request)
+
+    def _build_health_check_request(self, snapshot):
+        change = snapshot.health_check.diff(LoadBalancerHealthCheck(
+            target=self.health_check_target,
+            interval=self.health_check_interval,
+            unhealthy_threshold=self.health_check_unhealthy_threshold,
+        ))
+
+        if change is None:
+            return None
 
         params = dict()
         params['LoadBalancerName'] = self.loadbalancer_name
@@ -450,35 +1016,26 @@ class LoadBalancerManager:
         params['HealthCheck.Interval'] = change.interval
         params['HealthCheck.UnhealthyThreshold'] = change.unhealthy_threshold
 
-        api_name = 'ConfigureHealthCheck'
-        res_post = request_to_api(self.module, 'POST', api_name, params)
-
-        if res_post['status'] == 200:
-            self.changed = True
-        else:
-            self._fail_request(res_post, 'changes failed (sync_health_check)')
+        return dict(
+            name='sync_health_check',
+            result=dict(
+                health_check_target=change.target,
+                health_check_interval=change.interval,
+                health_check_unhealthy_threshold=change.unhealthy_threshold,
+            ),
+            api_name='ConfigureHealthCheck',
+            params_list=[params],
+            msg='changes failed (sync_health_check)',
+        )
 
     def _sync_ssl_policy(self):
-        res = self._describe_current_load_balancers()
-
-        ssl_policy = res['xml_body'].find(
-            './/{{{nc}}}SSLPolicy'.format(**res['xml_namespace']))
-
-        current = ''
-        if ssl_policy is not None:
-            current = ssl_policy.find(
-                './/{{{nc}}}SSLPolicyName'.format(**res['xml_namespace'])).text
+        request = self._build_ssl_policy_request(self._get_snapshot())
+        if request is not None:
+            self._send_sync_request(request)
 
-        if current == self.ssl_policy_name:
-            return
-
-        self.result['sync_ssl_policy'] = dict(
-            ssl_policy_name=self.ssl_policy_name,
-        )
-
-        if self.module.check_mode:
-            self.changed = True
-            return
+    def _build_ssl_policy_request(self, snapshot):
+        if snapshot.ssl_policy_name == self.ssl_policy_name:
+            return None
 
         params = dict()
         params['LoadBalancerName'] = self.loadbalancer_name
@@ -492,18 +1049,19 @@ class LoadBalancerManager:
         else:
             api_name = 'NiftyUnsetLoadBalancerSSLPoliciesOfListener'
 
-        res_post = request_to_api(self.module, 'POST', api_name, params)
-
-        if res_post['status'] == 200:
-            self.changed = True
-        else:
-            self._fail_request(res_post, 'changes failed (sync_ssl_policy)')
+        return dict(
+            name='sync_ssl_policy',
+            result=dict(
+                ssl_policy_name=self.ssl_policy_name,
+            ),
+            api_name=api_name,
+            params_list=[params],
+            msg='changes failed (sync_ssl_policy)',
+        )
 
     def _sync_instances(self):
-        res = self._describe_current_load_balancers()
-
         (deregister_instance_ids, register_instance_ids) = \
-            self._extract_instance_ids_diff(res)
+            self._extract_instance_ids_diff(self._get_snapshot())
 
         if (len(deregister_instance_ids) == 0) \
            and (len(register_instance_ids) == 0):
@@ -518,28 +1076,84 @@ class LoadBalancerManager:
             self.changed = True
             return
 
+        if self.rolling and len(register_instance_ids) != 0:
+            self.result['sync_instances']['waves'] = self._roll_instances(
+                register_instance_ids, deregister_instance_ids)
+            return
+
         if len(register_instance_ids) != 0:
             self._register_instances(register_instance_ids)
 
         if len(deregister_instance_ids) != 0:
             self._deregister_instances(deregister_instance_ids)
 
-    def _extract_instance_ids_diff(self, res):
-        instance_ids_key = './/{{{nc}}}Instances/{{{nc}}}member/{{{nc}}}InstanceId'.format(**res['xml_namespace'])  # noqa
-        instance_ids_elements = res['xml_body'].findall(instance_ids_key)
-        instance_ids = [x.text for x in instance_ids_elements]
-
-        deregister_instance_ids = []
-        if self.purge_instance_ids:
-            deregister_instance_ids = list(set(instance_ids)
-                                           - set(self.instance_ids))
+    def _roll_instances(self, register_instance_ids, deregister_instance_ids):
+        # new instances are registered in waves, and each wave has to be
+        # InService before the same number of old instances is deregistered
+        # so that the capacity is kept during the replacement.
+        deregister_instance_ids = sorted(deregister_instance_ids)
+        waves = []
+        for wave in split_into_chunks(sorted(register_instance_ids),
+                                      self.rolling_wave_size):
+            self._register_instances(wave)
+            self._wait_for_instances_in_service(wave)
+
+            old_instance_ids = deregister_instance_ids[:len(wave)]
+            deregister_instance_ids = deregister_instance_ids[len(wave):]
+            if len(old_instance_ids) != 0:
+                self._deregister_instances(old_instance_ids)
+
+            waves.append(dict(
+                register_instance_ids=wave,
+                deregister_instance_ids=old_instance_ids,
+            ))
 
-        register_instance_ids = list(set(self.instance_ids)
-                                     - set(instance_ids))
+        if len(deregister_instance_ids) != 0:
+            self._deregister_instances(deregister_instance_ids)
+            waves.append(dict(
+                register_instance_ids=[],
+                deregister_instance_ids=deregister_instance_ids,
+            ))
+
+        return waves
+
+    def _wait_for_instances_in_service(self, instance_ids):
+        # poll immediately, and back off exponentially until the deadline.
+        # the elapsed time also counts the requested sleeps so that the
+        # deadline is kept even if the clock does not advance.
+        start = time.time()
+        slept = 0
+        delay = self.wait_interval
+
+        while True:
+            states = self._describe_instance_health(instance_ids)
+            pending_instance_ids = [
+                instance_id for instance_id in instance_ids
+                if states.get(instance_id) != 'InService'
+            ]
+            if len(pending_instance_ids) == 0:
+                return
+
+            elapsed = max(time.time() - start, slept)
+            if elapsed >= self.rolling_timeout:
+                break
+
+            delay = min(delay, self.rolling_timeout - elapsed)
+            time.sleep(delay)
+            slept += delay
+            delay = min(delay * WAIT_BACKOFF_FACTOR, self.wait_max_interval)
 
-        return (deregister_instance_ids, register_instance_ids)
+        self.module.fail_json(
+            status=-1,
+            msg='changes failed (wait_for_instances_in_service)',
+            changed=self.changed,
+            instance_states=dict(
+                (instance_id, states.get(instance_id))
+                for instance_id in pending_instance_ids
+            ),
+        )
 
-    def _register_instances(self, instance_ids):
+    def _describe_instance_health(self, instance_ids):
         params = dict()
         params['LoadBalancerName'] = self.loadbalancer_name
         params['LoadBalancerPort'] = self.loadbalancer_port
@@ -551,15 +1165,86 @@ class LoadBalancerManager:
             params[key] = instance_id
             instance_no = instance_no + 1
 
-        api_name = 'RegisterInstancesWithLoadBalancer'
-        res = request_to_api(self.module, 'POST', api_name, params)
+        res = request_to_api(self.module, 'GET', 'DescribeInstanceHealth',
+                             params)
+        if res['status'] != 200:
+            self._fail_request(res, 'check instance health failed')
 
-        if res['status'] == 200:
-            self.changed = True
-        else:
-            self._fail_request(res, 'changes failed (register_instances)')
+        namespace = res['xml_namespace']
+        members_key = './/{{{nc}}}InstanceStates/{{{nc}}}member'.format(**namespace)  # noqa
+        states = dict()
+        for member in res['xml_body'].findall(members_key):
+            instance_id = member.find('{{{nc}}}InstanceId'.format(**namespace))
+            state = member.find('{{{nc}}}State'.format(**namespace))
+            if instance_id is not None and state is not None:
+                states[instance_id.text] = state.text
+
+        return states
+
+    def _extract_instance_ids_diff(self, snapshot):
+        return snapshot.instances.diff(self.instance_ids,
+                                       self.purge_instance_ids)
+
+    def _register_instances(self, instance_ids):
+        self._change_instances('RegisterInstancesWithLoadBalancer',
+                               instance_ids, 'register_instances')
 
     def _deregister_instances(self, instance_ids):
+        self._change_instances('DeregisterInstancesFromLoadBalancer',
+                               instance_ids, 'deregister_instances')
+
+    def _change_instances(self, api_name, instance_ids, method_name):
+        # instance ids are sent in chunks of instance_ids_per_request,
+        # max_workers chunks at a time. a failed chunk does not stop others.
+        chunks = split_into_chunks(instance_ids,
+                                   self.instance_ids_per_request)
+
+        def request(chunk):
+            return (chunk, self._request_instances(api_name, chunk))
+
+        if self.max_workers > 1 and len(chunks) > 1:
+            pool = ThreadPool(min(self.max_workers, len(chunks)))
+            try:
+                responses = pool.map(request, chunks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            responses = [request(chunk) for chunk in chunks]
+
+        succeeded_instance_ids = []
+        errors = []
+        for (chunk, res) in responses:
+            if res['status'] == 200:
+                succeeded_instance_ids.extend(chunk)
+            else:
+                error_info = get_api_error(res['xml_body'])
+                errors.append(dict(
+                    instance_ids=chunk,
+                    error_code=error_info.get('code'),
+                    error_message=error_info.get('message'),
+                ))
+
+        if len(succeeded_instance_ids) != 0:
+            self.changed = True
+            self.snapshot = None
+
+        if len(errors) != 0:
+            self.module.fail_json(
+                status=-1,
+                msg='changes failed ({0})'.format(method_name),
+                error_code=errors[0]['error_code'],
+                error_message=errors[0]['error_message'],
+                changed=self.changed,
+                succeeded_instance_ids=succeeded_instance_ids,
+                failed_instance_ids=[
+                    instance_id for error in errors
+                    for instance_id in error['instance_ids']
+                ],
+                errors=errors,
+            )
+
+    def _request_instances(self, api_name, instance_ids):
         params = dict()
         params['LoadBalancerName'] = self.loadbalancer_name
         params['LoadBalancerPort'] = self.loadbalancer_port
@@ -571,13 +1256,7 @@ class LoadBalancerManager:
             params[key] = instance_id
             instance_no = instance_no + 1
 
-        api_name = 'DeregisterInstancesFromLoadBalancer'
-        res = request_to_api(self.module, 'POST', api_name, params)
-
-        if res['status'] == 200:
-            self.changed = True
-        else:
-            self._fail_request(res, 'changes failed (deregister_instances)')
+        return request_to_api(self.module, 'POST', api_name, params)
 
     def _fail_request(self, response, msg):
         error_info = get_api_error(response['xml_body'])
@@ -589,6 +1268,380 @@ class LoadBalancerManager:
         )
 
 
+def describe_load_balancers_by_key(module, names):
+    # one DescribeLoadBalancers for all the names (all the load balancers
+    # if some of them do not exist yet), indexed by the name and the ports
+    params = dict()
+    for index, name in enumerate(names):
+        params['LoadBalancerNames.member.{0}'.format(index + 1)] = name
+    res = request_to_api(module, 'GET', 'DescribeLoadBalancers', params)
+
+    if res['status'] != 200:
+        error_info = get_api_error(res['xml_body'])
+        if error_info.get('code') == \
+           LoadBalancerManager._ERROR_LB_NAME_NOT_FOUND:
+            res = request_to_api(module, 'GET', 'DescribeLoadBalancers',
+                                 dict())
+
+    if res['status'] != 200:
+        error_info = get_api_error(res['xml_body'])
+        module.fail_json(
+            status=-1,
+            msg='check current state failed',
+            error_code=error_info.get('code'),
+            error_message=error_info.get('message'),
+        )
+
+    nc = '{{{nc}}}'.format(**res['xml_namespace'])
+    snapshots = dict()
+    members_key = './/{0}LoadBalancerDescriptions/{0}member'.format(nc)
+    for member in res['xml_body'].findall(members_key):
+        name = find_text(member, nc + 'LoadBalancerName')
+        if name not in names:
+            continue
+
+        snapshot = LoadBalancerSnapshot()
+        snapshot.parse_describe(dict(res, xml_body=member))
+        snapshots[(name,) + snapshot.listener.get_key()] = snapshot
+
+    return snapshots
+
+
+def _ensure_load_balancer_in_pool(lb_module, described_state):
+    manager = LoadBalancerManager(lb_module)
+    try:
+        manager.ensure_present(described_state)
+    except LoadBalancerError as e:
+        e.kwargs.setdefault('loadbalancer_name', manager.loadbalancer_name)
+        e.kwargs.setdefault('loadbalancer_port', manager.loadbalancer_port)
+        e.kwargs.setdefault('instance_port', manager.instance_port)
+        raise
+    return dict(
+        manager.result,
+        changed=manager.changed,
+        status=manager.current_state,
+        loadbalancer_name=manager.loadbalancer_name,
+        loadbalancer_port=manager.loadbalancer_port,
+        instance_port=manager.instance_port,
+    )
+
+
+def _register_load_balancer_in_pool(lb_modules, current_state):
+    # one CreateLoadBalancer or RegisterPortWithLoadBalancer for all the
+    # listeners of the load balancer not found
+    manager = LoadBalancerManager(lb_modules[0])
+    listeners = [
+        dict((key, lb_module.params.get(key)) for key in LISTENER_KEYS)
+        for lb_module in lb_modules
+    ]
+    try:
+        if current_state == 'absent':
+            manager._create_load_balancer(listeners)
+        else:
+            manager._register_port(listeners)
+    except LoadBalancerError as e:
+        e.kwargs.setdefault('loadbalancer_name', manager.loadbalancer_name)
+        raise
+    return dict(manager.result, changed=manager.changed)
+
+
+def ensure_load_balancers_present(module):
+    specs = module.params['load_balancers']
+    for spec in specs:
+        if not isinstance(spec, dict) or not spec.get('loadbalancer_name') \
+           or spec.get('loadbalancer_port') is None \
+           or spec.get('instance_port') is None:
+            module.fail_json(
+                status=-1,
+                msg='loadbalancer_name, loadbalancer_port and instance_port '
+                    'are required for each of load_balancers'
+            )
+
+    lb_modules = [LoadBalancerModule(module, spec) for spec in specs]
+    names = sorted(set(spec['loadbalancer_name'] for spec in specs))
+    snapshots = describe_load_balancers_by_key(module, names)
+    described_names = set(key[0] for key in snapshots)
+
+    def get_key(lb_module):
+        return (lb_module.params['loadbalancer_name'],
+                int(lb_module.params['loadbalancer_port']),
+                int(lb_module.params['instance_port']))
+
+    # the listeners not found are grouped by the load balancer, so that
+    # each load balancer is created or registered with one request.
+    missing = dict()
+    for lb_module in lb_modules:
+        key = get_key(lb_module)
+        if key in snapshots:
+            continue
+        current_state = 'port-not-found'
+        if key[0] not in described_names:
+            current_state = 'absent'
+        missing.setdefault(key[0], (current_state, []))[1].append(lb_module)
+
+    # the states are taken from the describe above, so the load balancers
+    # are reconciled concurrently without describing them again.
+    max_workers = module.params.get('load_balancers_max_workers') or \
+        LOAD_BALANCERS_MAX_WORKERS
+    pool = ThreadPool(max(1, min(max_workers, len(specs))))
+    try:
+        registering = dict(
+            (name, pool.apply_async(_register_load_balancer_in_pool, (
+                missing_lb_modules, current_state)))
+            for (name, (current_state, missing_lb_modules))
+            in missing.items()
+        )
+        registered = dict(
+            (name, registered_result.get())
+            for (name, registered_result) in registering.items()
+        )
+
+        # the registered listeners are described again at once
+        if len(registered) != 0 and not module.check_mode:
+            snapshots.update(describe_load_balancers_by_key(
+                module, sorted(registered)))
+
+        def get_described_state(lb_module):
+            snapshot = snapshots.get(get_key(lb_module))
+            if snapshot is None and module.check_mode:
+                # not registered yet in check mode
+                snapshot = LoadBalancerSnapshot()
+            return ('present', snapshot)
+
+        ensured = [
+            pool.apply_async(_ensure_load_balancer_in_pool, (
+                lb_module, get_described_state(lb_module)))
+            for lb_module in lb_modules
+        ]
+        results = [lb_result.get() for lb_result in ensured]
+    except LoadBalancerError as e:
+        module.fail_json(**e.kwargs)
+    finally:
+        pool.close()
+        pool.join()
+
+    for (lb_module, result) in zip(lb_modules, results):
+        name = lb_module.params['loadbalancer_name']
+        if name in registered and lb_module in missing[name][1]:
+            result.update(dict(
+                (key, value) for (key, value) in registered[name].items()
+                if key != 'changed'))
+            result['changed'] = result['changed'] or \
+                registered[name]['changed']
+
+    return dict(
+        changed=any(result['changed'] for result in results),
+        load_balancers=results,
+    )
+
+
+def make_cache_dir(module, directory, option_name):
+    if os.path.isdir(directory):
+        return
+    try:
+        os.makedirs(directory, 0o700)
+    except OSError:
+        if not os.path.isdir(directory):
+            module.fail_json(
+                status=-1,
+                msg='{0} can not be created'.format(option_name),
+                **{option_name: directory}
+            )
+
+
+def get_coalesce_key(module):
+    # forks share the queue when they target the same listener
+    target = [module.params[key] for key in ('endpoint', 'loadbalancer_name',
+                                             'loadbalancer_port',
+                                             'instance_port')]
+    target.append(module.check_mode)
+    digest = hashlib.sha256(json.dumps(target).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def acquire_coalesce_lock(lock_file, timeout):
+    # the elapsed time also counts the requested sleeps
+    start = time.time()
+    slept = 0
+    while True:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except IOError:
+            if max(time.time() - start, slept) >= timeout:
+                return False
+            time.sleep(COALESCE_POLL_INTERVAL)
+            slept += COALESCE_POLL_INTERVAL
+
+
+def enqueue_coalesce_entry(path, entry):
+    with open(path, 'a') as fp:
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        try:
+            fp.write(json.dumps(entry) + '\n')
+            fp.flush()
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+
+def dequeue_coalesce_entries(path):
+    with open(path, 'a+') as fp:
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        try:
+            fp.seek(0)
+            lines = fp.readlines()
+            fp.seek(0)
+            fp.truncate()
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+    entries = []
+    for line in lines:
+        try:
+            entries.append(json.loads(line))
+        except ValueError:
+            continue
+    return entries
+
+
+def load_coalesced_result(path):
+    try:
+        with open(path, 'r') as fp:
+            result = json.load(fp)
+    except (IOError, ValueError):
+        return None
+
+    os.remove(path)
+    return result
+
+
+def save_coalesced_result(path, result):
+    temporary_path = '{0}.{1}'.format(path, os.getpid())
+    with open(temporary_path, 'w') as fp:
+        json.dump(result, fp, default=str)
+    os.rename(temporary_path, path)
+
+
+def ensure_present(module):
+    manager = LoadBalancerManager(module)
+    manager.ensure_present()
+    return dict(
+        changed=manager.changed,
+        status=manager.current_state,
+        **manager.result
+    )
+
+
+def ensure_present_coalesced(module):
+    # every fork enqueues its instance ids, and the first fork holding the
+    # lock (the leader) registers all the queued ids at once. the other
+    # forks find the result for their ids when they get the lock.
+    if not HAS_FCNTL:
+        module.fail_json(status=-1, msg='fcntl is required for coalesce')
+
+    directory = module.params.get('coalesce_dir') or COALESCE_DIR
+    make_cache_dir(module, directory, 'coalesce_dir')
+
+    key = get_coalesce_key(module)
+    lock_path = os.path.join(directory, key + '.lock')
+    queue_path = os.path.join(directory, key + '.queue')
+    window = module.params.get('coalesce_window')
+    if window is None:
+        window = COALESCE_WINDOW
+    timeout = module.params.get('coalesce_timeout')
+    if timeout is None:
+        timeout = COALESCE_TIMEOUT
+
+    def get_result_path(entry):
+        return os.path.join(directory, '{0}.{1}.json'.format(key, entry['id']))
+
+    entry = dict(
+        id=uuid.uuid4().hex,
+        instance_ids=list(module.params['instance_ids']),
+    )
+    enqueue_coalesce_entry(queue_path, entry)
+
+    with open(lock_path, 'a') as lock_file:
+        if not acquire_coalesce_lock(lock_file, timeout):
+            module.fail_json(
+                status=-1,
+                msg='wait for coalesced registration failed',
+            )
+        try:
+            result = load_coalesced_result(get_result_path(entry))
+            if result is not None:
+                return dict(result, coalesced=True)
+
+            # the other forks enqueue their ids in the meantime
+            time.sleep(window)
+            entries = dequeue_coalesce_entries(queue_path)
+            # the entry was dequeued by a leader which failed
+            if entry['id'] not in [queued['id'] for queued in entries]:
+                entries.append(entry)
+
+            instance_ids = []
+            for queued in entries:
+                for instance_id in queued['instance_ids']:
+                    if instance_id not in instance_ids:
+                        instance_ids.append(instance_id)
+
+            # each fork knows only its instances, so nothing is purged
+            module.params['instance_ids'] = instance_ids
+            module.params['purge_instance_ids'] = False
+            result = dict(ensure_present(module),
+                          coalesced_instance_ids=instance_ids)
+
+            for queued in entries:
+                if queued['id'] != entry['id']:
+                    save_coalesced_result(get_result_path(queued), result)
+            return dict(result, coalesced=False)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def find_text(element, tag, default=None):
+    child = element.find(tag)
+    if child is None or child.text is None:
+        return default
+    return child.text
+
+
+def find_int(element, tag, default=None):
+    text = find_text(element, tag)
+    if text is None:
+        return default
+    return int(text)
+
+
+def get_param(module, name, default):
+    value = module.params.get(name)
+    return default if value is None else value
+
+
+def normalize_ip_address(ip_address):
+    # "192.0.2.1/32" is "192.0.2.1", and "192.0.2.1/24" is "192.0.2.0/24"
+    ip_address = str(ip_address).strip()
+    if not HAS_IPADDRESS:
+        return ip_address
+
+    try:
+        network = ipaddress.ip_network(unicode(ip_address), strict=False)
+    except ValueError:
+        return ip_address
+
+    if network.prefixlen == network.max_prefixlen:
+        return str(network.network_address)
+    return str(network)
+
+
+def split_into_chunks(items, size):
+    if not items:
+        return []
+    if not size:
+        return [items]
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
 def calculate_signature(secret_access_key, method, endpoint, path, params):
     payload = ''
     for v in sorted(params.items()):
@@ -664,9 +1717,9 @@ def main():
             access_key=dict(required=True,  type='str'),
             secret_access_key=dict(required=True,  type='str', no_log=True),
             endpoint=dict(required=True,  type='str'),
-            loadbalancer_name=dict(required=True, type='str'),
-            loadbalancer_port=dict(required=True, type='int'),
-            instance_port=dict(required=True, type='int'),
+            loadbalancer_name=dict(required=False, type='str'),
+            loadbalancer_port=dict(required=False, type='int'),
+            instance_port=dict(required=False, type='int'),
             balancing_type=dict(required=False, type='int', default=1),
             network_volume=dict(required=False, type='int', default=10),
             ip_version=dict(required=False, type='str', default='v4'),
@@ -680,34 +1733,77 @@ def main():
             filter_type=dict(required=False, type='int', default=1),
             purge_filter_ip_addresses=dict(required=False, type='bool',
                                            default=True),
+            filter_ip_addresses_per_request=dict(required=False, type='int',
+                                                 default=None),
             health_check_target=dict(required=False, type='str',
                                      default='ICMP'),
             health_check_interval=dict(required=False, type='int', default=5),
             health_check_unhealthy_threshold=dict(required=False, type='int',
                                                   default=1),
             ssl_policy_name=dict(required=False, type='str', default=''),
+            listeners=dict(required=False, type='list', default=None),
+            load_balancers=dict(required=False, type='list', default=None),
+            load_balancers_max_workers=dict(
+                required=False, type='int',
+                default=LOAD_BALANCERS_MAX_WORKERS),
+            instance_ids_per_request=dict(required=False, type='int',
+                                          default=None),
+            max_workers=dict(required=False, type='int',
+                             default=MAX_WORKERS),
+            parallel_sync=dict(required=False, type='bool', default=False),
+            rolling=dict(required=False, type='bool', default=False),
+            rolling_wave_size=dict(required=False, type='int',
+                                   default=ROLLING_WAVE_SIZE),
+            rolling_timeout=dict(required=False, type='int',
+                                 default=ROLLING_TIMEOUT),
+            wait_timeout=dict(required=False, type='int',
+                              default=WAIT_TIMEOUT),
+            wait_interval=dict(required=False, type='int',
+                               default=WAIT_INTERVAL),
+            wait_max_interval=dict(required=False, type='int',
+                                   default=WAIT_MAX_INTERVAL),
+            coalesce=dict(required=False, type='bool', default=False),
+            coalesce_dir=dict(required=False, type='path', default=None),
+            coalesce_window=dict(required=False, type='int',
+                                 default=COALESCE_WINDOW),
+            coalesce_timeout=dict(required=False, type='int',
+                                  default=COALESCE_TIMEOUT),
             state=dict(required=True,  type='str'),
         ),
+        required_one_of=[['loadbalancer_port', 'listeners',
+                          'load_balancers'],
+                         ['loadbalancer_name', 'load_balancers']],
+        required_together=[['loadbalancer_port', 'instance_port']],
+        mutually_exclusive=[['loadbalancer_port', 'listeners',
+                             'load_balancers'],
+                            ['loadbalancer_name', 'load_balancers']],
         supports_check_mode=True
     )
 
     goal_state = module.params['state']
 
-    manager = LoadBalancerManager(module)
-
-    if goal_state == 'present':
-        manager.ensure_present()
-    else:
+    if goal_state != 'present':
         module.fail_json(
             status=-1,
             msg='invalid state (goal state = "{0}")'.format(goal_state)
         )
 
-    module.exit_json(
-        changed=manager.changed,
-        status=manager.current_state,
-        **manager.result
-    )
+    # coalesce: false is allowed with listeners and load_balancers
+    if module.params.get('coalesce') and (module.params.get('listeners') or
+                                          module.params.get('load_balancers')):
+        module.fail_json(
+            status=-1,
+            msg='coalesce can not be used with listeners or load_balancers'
+        )
+
+    if module.params.get('load_balancers'):
+        result = ensure_load_balancers_present(module)
+    elif module.params.get('coalesce'):
+        result = ensure_present_coalesced(module)
+    else:
+        result = ensure_present(module)
+
+    module.exit_json(**result)
 
 
 if __name__ == '__main__':
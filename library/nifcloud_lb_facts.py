@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright Fujitsu
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import base64
+import hashlib
+import hmac
+import io
+import json
+import os
+import tempfile
+import time
+import xml.etree.ElementTree as etree
+
+import requests
+from ansible.module_utils.basic import *  # noqa
+
+try:
+    # Python 2
+    from urllib import quote, urlencode
+except ImportError:
+    # Python 3
+    from urllib.parse import quote, urlencode
+
+DOCUMENTATION = '''
+---
+module: nifcloud_lb_facts
+short_description: Gather facts about load balancers in NIFCLOUD
+description:
+    - Gather facts about load balancers, listeners, health checks and registered instances of NIFCLOUD with one DescribeLoadBalancers.
+version_added: "0.1"
+options:
+    access_key:
+        description:
+            - Access key
+        required: true
+    secret_access_key:
+        description:
+            - Secret access key
+        required: true
+    endpoint:
+        description:
+            - API endpoint of target region.
+        required: true
+    loadbalancer_names:
+        description:
+            - List of target Load Balancer names (all load balancers if not given)
+        required: false
+        default: []
+    cache:
+        description:
+            - Reuse the facts saved by the other tasks until they get older than cache_max_age
+        required: false
+        default: false
+    cache_dir:
+        description:
+            - Directory of the cache files
+        required: false
+        default: '(temporary directory)/ansible-nifcloud-lb-facts'
+    cache_max_age:
+        description:
+            - Seconds for which the saved facts are reused
+        required: false
+        default: 300
+'''  # noqa
+
+EXAMPLES = '''
+- action: nifcloud_lb_facts access_key="YOUR_ACCESS_KEY" secret_access_key="YOUR_SECRET_ACCESS_KEY" endpoint="west-1.cp.cloud.nifty.com" loadbalancer_names="lb001" cache=true
+'''  # noqa
+
+
+ISO8601 = '%Y-%m-%dT%H:%M:%SZ'
+
+CACHE_DIR = os.path.join(tempfile.gettempdir(), 'ansible-nifcloud-lb-facts')
+CACHE_MAX_AGE = 300
+
+ERROR_LB_NAME_NOT_FOUND = 'Client.InvalidParameterNotFound.LoadBalancer'
+
+
+def describe_load_balancers(module):
+    names = module.params.get('loadbalancer_names') or []
+
+    params = dict()
+    for index, name in enumerate(names):
+        params['LoadBalancerNames.member.{0}'.format(index + 1)] = name
+    res = request_to_api(module, 'GET', 'DescribeLoadBalancers', params)
+
+    # the load balancers not created yet are not listed
+    # instead of failing the whole describe
+    if res['status'] != 200:
+        error_info = get_api_error(etree.fromstring(res['body']))
+        if error_info.get('code') == ERROR_LB_NAME_NOT_FOUND:
+            res = request_to_api(module, 'GET', 'DescribeLoadBalancers',
+                                 dict())
+
+    if res['status'] != 200:
+        error_info = get_api_error(etree.fromstring(res['body']))
+        module.fail_json(
+            status=-1,
+            msg='describe load balancers failed',
+            error_code=error_info.get('code'),
+            error_message=error_info.get('message'),
+        )
+
+    load_balancers = []
+    indexes = dict()
+    for listener in parse_load_balancer_descriptions(res['body']):
+        name = listener.pop('loadbalancer_name')
+        if names and name not in names:
+            continue
+
+        load_balancer = listener.pop('load_balancer')
+        if name not in indexes:
+            indexes[name] = len(load_balancers)
+            load_balancers.append(dict(load_balancer,
+                                       loadbalancer_name=name,
+                                       listeners=[]))
+        load_balancers[indexes[name]]['listeners'].append(listener)
+
+    return load_balancers
+
+
+def parse_load_balancer_descriptions(body):
+    # each member of LoadBalancerDescriptions (one listener of a load
+    # balancer) is parsed as soon as it ends and then cleared, so the whole
+    # response is not kept as a tree.
+    nc = None
+    tags = []
+    for event, element in etree.iterparse(io.BytesIO(body),
+                                          events=('start', 'end')):
+        if event == 'start':
+            if nc is None:
+                nc = element.tag[:element.tag.find('}') + 1]
+            tags.append(element.tag)
+            continue
+
+        tags.pop()
+        if element.tag == nc + 'member' and len(tags) != 0 \
+           and tags[-1] == nc + 'LoadBalancerDescriptions':
+            yield parse_listener_description(element, nc)
+            element.clear()
+
+
+def parse_listener_description(element, nc):
+    listener = dict(
+        loadbalancer_name=find_text(element, nc + 'LoadBalancerName'),
+        load_balancer=dict(
+            dns_name=find_text(element, nc + 'DNSName'),
+            network_volume=find_int(element, nc + 'NetworkVolume'),
+            accounting_type=find_text(element, nc + 'AccountingType'),
+        ),
+        loadbalancer_port=None,
+        instance_port=None,
+        protocol=None,
+        balancing_type=None,
+        ssl_policy_name='',
+        instance_ids=[],
+        health_check=dict(),
+        filter=dict(filter_type=None, ip_addresses=[]),
+    )
+
+    listener_element = element.find('.//{0}Listener'.format(nc))
+    if listener_element is not None:
+        listener['loadbalancer_port'] = find_int(listener_element,
+                                                 nc + 'LoadBalancerPort')
+        listener['instance_port'] = find_int(listener_element,
+                                             nc + 'InstancePort')
+        listener['protocol'] = find_text(listener_element, nc + 'Protocol')
+        listener['balancing_type'] = find_int(
+            listener_element, nc + 'BalancingType',
+            find_int(listener_element, nc + 'balancingType'))
+
+    ssl_policy = element.find('.//{0}SSLPolicy'.format(nc))
+    if ssl_policy is not None:
+        listener['ssl_policy_name'] = find_text(ssl_policy,
+                                                nc + 'SSLPolicyName', '')
+
+    for instance_id in element.findall(
+            '{0}Instances/{0}member/{0}InstanceId'.format(nc)):
+        listener['instance_ids'].append(instance_id.text)
+
+    health_check = element.find(nc + 'HealthCheck')
+    if health_check is not None:
+        listener['health_check'] = dict(
+            target=find_text(health_check, nc + 'Target'),
+            interval=find_int(health_check, nc + 'Interval'),
+            unhealthy_threshold=find_int(health_check,
+                                         nc + 'UnhealthyThreshold'),
+            instance_states=[
+                dict(instance_id=find_text(member, nc + 'InstanceId'),
+                     state=find_text(member, nc + 'State'))
+                for member in health_check.findall(
+                    '{0}InstanceStates/{0}member'.format(nc))
+            ],
+        )
+
+    filter_element = element.find(nc + 'Filter')
+    if filter_element is not None:
+        listener['filter']['filter_type'] = find_int(filter_element,
+                                                     nc + 'FilterType')
+        for ip_address in filter_element.findall(
+                '{0}IPAddresses/{0}member/{0}IPAddress'.format(nc)):
+            # DescribeLoadBalancers returns ['*.*.*.*'] when none filter ip.
+            if ip_address.text != '*.*.*.*':
+                listener['filter']['ip_addresses'].append(ip_address.text)
+
+    return listener
+
+
+def get_cache_path(module):
+    # the secret access key is not a part of the key
+    names = sorted(module.params.get('loadbalancer_names') or [])
+    key = hashlib.sha256(json.dumps(
+        [module.params['endpoint'], module.params['access_key'], names]
+    ).encode('utf-8')).hexdigest()
+    directory = module.params.get('cache_dir') or CACHE_DIR
+    return os.path.join(directory, key + '.json')
+
+
+def make_cache_dir(module, directory):
+    if os.path.isdir(directory):
+        return
+    try:
+        os.makedirs(directory, 0o700)
+    except OSError:
+        if not os.path.isdir(directory):
+            module.fail_json(
+                status=-1,
+                msg='cache_dir can not be created',
+                cache_dir=directory,
+            )
+
+
+def load_cached_facts(path, max_age):
+    try:
+        with open(path, 'r') as fp:
+            saved = json.load(fp)
+    except (IOError, ValueError):
+        return None
+
+    if time.time() - saved.get('time', 0) > max_age:
+        return None
+    return saved.get('load_balancers')
+
+
+def save_cached_facts(path, load_balancers):
+    temporary_path = '{0}.{1}'.format(path, os.getpid())
+    with open(temporary_path, 'w') as fp:
+        json.dump(dict(time=time.time(), load_balancers=load_balancers), fp)
+    os.rename(temporary_path, path)
+
+
+def get_load_balancer_facts(module):
+    if not module.params.get('cache'):
+        return dict(load_balancers=describe_load_balancers(module),
+                    cached=False)
+
+    cache_path = get_cache_path(module)
+    make_cache_dir(module, os.path.dirname(cache_path))
+    max_age = module.params.get('cache_max_age')
+    if max_age is None:
+        max_age = CACHE_MAX_AGE
+
+    load_balancers = load_cached_facts(cache_path, max_age)
+    if load_balancers is not None:
+        return dict(load_balancers=load_balancers, cached=True)
+
+    load_balancers = describe_load_balancers(module)
+    save_cached_facts(cache_path, load_balancers)
+    return dict(load_balancers=load_balancers, cached=False)
+
+
+def find_text(element, tag, default=None):
+    child = element.find(tag)
+    if child is None or child.text is None:
+        return default
+    return child.text
+
+
+def find_int(element, tag, default=None):
+    text = find_text(element, tag)
+    if text is None:
+        return default
+    return int(text)
+
+
+def calculate_signature(secret_access_key, method, endpoint, path, params):
+    payload = ''
+    for v in sorted(params.items()):
+        payload += '&{0}={1}'.format(v[0], quote(str(v[1]), ''))
+    payload = payload[1:]
+
+    string_to_sign = [method, endpoint, path, payload]
+    digest = hmac.new(
+        secret_access_key.encode('utf-8'),
+        '\n'.join(string_to_sign).encode('utf-8'),
+        hashlib.sha256
+    ).digest()
+
+    return base64.b64encode(digest)
+
+
+def request_to_api(module, method, action, params):
+    # the body is returned as it is to be parsed incrementally
+    params['Action'] = action
+    params['AccessKeyId'] = module.params['access_key']
+    params['SignatureMethod'] = 'HmacSHA256'
+    params['SignatureVersion'] = '2'
+    params['Timestamp'] = time.strftime(ISO8601, time.gmtime())
+
+    path = '/api/'
+    endpoint = module.params['endpoint']
+
+    params['Signature'] = calculate_signature(
+        module.params['secret_access_key'],
+        method,
+        endpoint,
+        path,
+        params
+    )
+
+    r = None
+    if method == 'GET':
+        url = 'https://{0}{1}?{2}'.format(endpoint, path,
+                                          urlencode(params))
+        r = requests.get(url)
+    else:
+        module.fail_json(
+            status=-1,
+            msg='describe failed (un-supported http method)'
+        )
+
+    if r is not None:
+        return dict(
+            status=r.status_code,
+            body=r.text.encode('utf-8'),
+        )
+    else:
+        module.fail_json(status=-1,
+                         msg='describe failed (http request failed)')
+
+
+def get_api_error(xml_body):
+    info = dict(
+        code=xml_body.find('.//Errors/Error/Code').text,
+        message=xml_body.find('.//Errors/Error/Message').text
+    )
+    return info
+
+
+def main():
+    module = AnsibleModule(  # noqa
+        argument_spec=dict(
+            access_key=dict(required=True,  type='str'),
+            secret_access_key=dict(required=True,  type='str', no_log=True),
+            endpoint=dict(required=True,  type='str'),
+            loadbalancer_names=dict(required=False, type='list',
+                                    default=list()),
+            cache=dict(required=False, type='bool', default=False),
+            cache_dir=dict(required=False, type='path', default=None),
+            cache_max_age=dict(required=False, type='int',
+                               default=CACHE_MAX_AGE),
+        ),
+        supports_check_mode=True
+    )
+
+    facts = get_load_balancer_facts(module)
+
+    module.exit_json(
+        changed=False,
+        cached=facts['cached'],
+        ansible_facts=dict(nifcloud_load_balancers=facts['load_balancers']),
+    )
+
+
+if __name__ == '__main__':
+    main()
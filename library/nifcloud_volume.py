@@ -18,8 +18,10 @@
 import base64
 import hashlib
 import hmac
+import threading
 import time
 import xml.etree.ElementTree as etree
+from multiprocessing.pool import ThreadPool
 
 import requests
 from ansible.module_utils.basic import *  # noqa
@@ -37,6 +39,7 @@ module: nifcloud_volume
 short_description: Attach the volume to an instance in NIFCLOUD
 description:
     - Attach the volume an instance of NIFCLOUD.
+    - Detach and delete the volume for "absent".
 version_added: "0.1"
 options:
     access_key:
@@ -54,10 +57,12 @@ options:
     size:
         description:
             - Volume size.
-        required: true
+            - Required for "present" unless volumes is given
+        required: false
     volume_id:
         description:
             - Volume name.
+            - Required for "absent" unless volumes is given
         required: false
         default: null
     disk_type:
@@ -68,15 +73,45 @@ options:
     instance_id:
         description:
             - Instance ID
-        required: true
+            - Required for "present" unless volumes is given
+        required: false
     accounting_type:
         description:
             - Accounting type (1: monthly, 2: pay per use)
         required: false
         default: null
+    wait_timeout:
+        description:
+            - Seconds to wait until the volume is attached, detached or deleted
+        required: false
+        default: 1800
+    wait_interval:
+        description:
+            - The first interval seconds to poll the volume. The interval is doubled at each poll
+        required: false
+        default: 5
+    wait_max_interval:
+        description:
+            - The upper limit seconds of the interval to poll the volume
+        required: false
+        default: 60
+    volumes:
+        description:
+            - List of volumes attached or deleted at once with one DescribeVolumes instead of volume_id and instance_id
+            - Each item takes instance_id, and optionally volume_id, size, disk_type and accounting_type for "present"
+            - Each item takes volume_id for "absent"
+            - Options not given in an item default to the module options
+        required: false
+        default: null
+    volumes_max_workers:
+        description:
+            - Number of CreateVolume, AttachVolume, DetachVolume and DeleteVolume requests of volumes sent concurrently
+        required: false
+        default: 10
     state:
         description:
-            - Goal status ("present" or "absent")  * "absent" is not implemented
+            - Goal status ("present" or "absent")
+            - The volume is detached and deleted for "absent"
         required: true
 '''  # noqa
 
@@ -84,6 +119,57 @@ EXAMPLES = '''
 - action: nifcloud_lb access_key="YOUR_ACCESS_KEY" secret_access_key="YOUR_SECRET_ACCESS_KEY" endpoint="west-1.cp.cloud.nifty.com" size="100" volume_id="testdisk001" disk_type="3" instance_id="test001" accounting_type="2" state="present"
 '''  # noqa
 
+WAIT_TIMEOUT = 1800
+WAIT_INTERVAL = 5
+WAIT_MAX_INTERVAL = 60
+WAIT_BACKOFF_FACTOR = 2
+
+# the wait for each goal state finishes at these states, because the
+# volume never becomes the goal state from the other states in the list
+WAIT_FINISHED_STATES = dict(
+    attached=('attached', 'error', 'deleting', 'detaching'),
+    available=('available', 'absent', 'error', 'deleting'),
+    absent=('absent', 'error'),
+)
+
+# the volume is detached and deleted from these states for "absent"
+DETACHABLE_STATES = ('attached', 'detaching', 'available', 'deleting')
+
+VOLUMES_MAX_WORKERS = 10
+
+ERROR_VOLUME_NOT_FOUND = 'Client.InvalidParameterNotFound.Volume'
+
+# number of requests of each action in this run, returned as api_calls
+API_CALLS = dict()
+API_CALLS_LOCK = threading.Lock()
+
+
+class VolumeError(Exception):
+    """Failure of one volume in the volumes mode"""
+
+    def __init__(self, **kwargs):
+        super(VolumeError, self).__init__(kwargs.get('msg'))
+        self.kwargs = kwargs
+
+
+class VolumeModule(object):
+    """Module with parameters of one volume in the volumes mode
+
+    fail_json() raises VolumeError instead of exiting, so that
+    the failure is reported once by the main thread.
+    """
+
+    def __init__(self, module, spec):
+        self.check_mode = module.check_mode
+        self.params = dict(
+            (key, value) for (key, value) in module.params.items()
+            if key != 'volumes'
+        )
+        self.params.update(spec)
+
+    def fail_json(self, **kwargs):
+        raise VolumeError(**kwargs)
+
 
 def calculate_signature(secret_access_key, method, endpoint, path, params):
     payload = ""
@@ -101,7 +187,18 @@ def calculate_signature(secret_access_key, method, endpoint, path, params):
     return base64.b64encode(digest)
 
 
+def count_api_call(action):
+    with API_CALLS_LOCK:
+        API_CALLS[action] = API_CALLS.get(action, 0) + 1
+
+
+def fail(module, **kwargs):
+    # the requests sent before the failure are reported as on success
+    module.fail_json(**dict(kwargs, api_calls=dict(API_CALLS)))
+
+
 def request_to_api(module, method, action, params):
+    count_api_call(action)
     params['Action'] = action
     params['AccessKeyId'] = module.params['access_key']
     params['SignatureMethod'] = 'HmacSHA256'
@@ -127,7 +224,8 @@ def request_to_api(module, method, action, params):
         url = 'https://{0}{1}'.format(endpoint, path)
         r = requests.post(url, urlencode(params))
     else:
-        module.fail_json(
+        fail(
+            module,
             status=-1,
             msg='changes failed (un-supported http method)'
         )
@@ -142,7 +240,7 @@ def request_to_api(module, method, action, params):
         )
         return info
     else:
-        module.fail_json(status=-1, msg='changes failed (http request failed)')
+        fail(module, status=-1, msg='changes failed (http request failed)')
 
 
 def get_api_error(xml_body):
@@ -153,43 +251,201 @@ def get_api_error(xml_body):
     return info
 
 
-def get_volume_state(module):
+def get_param(module, name, default):
+    value = module.params.get(name)
+    return default if value is None else value
+
+
+def get_volume_state(module, volume_id=None):
     params = dict()
 
-    if module.params['volume_id'] is not None:
-        params['VolumeId.1'] = module.params['volume_id']
+    if volume_id is None:
+        volume_id = module.params['volume_id']
+
+    if volume_id is not None:
+        params['VolumeId.1'] = volume_id
     else:
         return ('absent', None)
 
     res = request_to_api(module, 'GET', 'DescribeVolumes', params)
 
     if res['status'] == 200:
-        status = res['xml_body'].find(
-            './/{{{nc}}}volumeSet/{{{nc}}}item/{{{nc}}}status'
-            .format(**res['xml_namespace'])
-        ).text
+        nc = '{{{nc}}}'.format(**res['xml_namespace'])
+        for item in iter_volume_items(res['xml_body'], nc):
+            return parse_volume_item(item, nc)[1]
+    return ('absent', None)
 
-        if status == 'in-use':
-            conn_instance_id = res['xml_body'].find(
-                './/{{{nc}}}attachmentSet/{{{nc}}}item/{{{nc}}}instanceId'
-                .format(**res['xml_namespace'])
-            ).text
-            conn_status = res['xml_body'].find(
-                './/{{{nc}}}attachmentSet/{{{nc}}}item/{{{nc}}}status'
-                .format(**res['xml_namespace'])
-            ).text
-            return (conn_status, conn_instance_id)
-        else:
-            return (status, None)
+
+def describe_volumes(module, volume_ids):
+    # one DescribeVolumes for all the volume ids (all the volumes if some of
+    # them do not exist yet), indexed by the volume id
+    params = dict()
+    for index, volume_id in enumerate(volume_ids):
+        params['VolumeId.{0}'.format(index + 1)] = volume_id
+    res = request_to_api(module, 'GET', 'DescribeVolumes', params)
+
+    # only the volume not found falls back, the other errors fail below
+    if res['status'] != 200:
+        error_info = get_api_error(res['xml_body'])
+        if error_info.get('code') == ERROR_VOLUME_NOT_FOUND:
+            res = request_to_api(module, 'GET', 'DescribeVolumes', dict())
+
+    if res['status'] != 200:
+        error_info = get_api_error(res['xml_body'])
+        fail(
+            module,
+            status=-1,
+            msg='check current state failed',
+            error_code=error_info.get('code'),
+            error_message=error_info.get('message')
+        )
+
+    nc = '{{{nc}}}'.format(**res['xml_namespace'])
+    target_volume_ids = set(volume_ids)
+    states = dict()
+    for item in iter_volume_items(res['xml_body'], nc):
+        (volume_id, state) = parse_volume_item(item, nc)
+        if volume_id in target_volume_ids:
+            states[volume_id] = state
+
+    return states
+
+
+def iter_volume_items(xml_body, nc):
+    volume_set = xml_body.find(nc + 'volumeSet')
+    if volume_set is None:
+        return iter(())
+    return volume_set.iterfind(nc + 'item')
+
+
+def parse_volume_item(item, nc):
+    # the children of the item are visited once instead of searching
+    # each of the status, the instance id and the attachment status
+    volume_id = None
+    status = None
+    attachment = None
+    for child in item:
+        if child.tag == nc + 'volumeId':
+            volume_id = child.text
+        elif child.tag == nc + 'status':
+            status = child.text
+        elif child.tag == nc + 'attachmentSet':
+            attachment = child.find(nc + 'item')
+
+    if status == 'in-use' and attachment is not None:
+        conn_instance_id = None
+        conn_status = None
+        for child in attachment:
+            if child.tag == nc + 'instanceId':
+                conn_instance_id = child.text
+            elif child.tag == nc + 'status':
+                conn_status = child.text
+        return (volume_id, (conn_status, conn_instance_id))
     else:
-        return ('absent', None)
+        return (volume_id, (status, None))
+
+
+def get_response_status(res):
+    # the state in the response of CreateVolume, AttachVolume and
+    # DetachVolume saves DescribeVolumes just after the request. None is
+    # returned without the state, and then the volume is polled.
+    status = res['xml_body'].find(
+        '{{{nc}}}status'.format(**res['xml_namespace']))
+    if status is None:
+        return None
+    return status.text
+
+
+def wait_with_backoff(module, poll):
+    # the callers know the current state by the last response, so the first
+    # poll is sent after the first interval, and the interval is backed off
+    # exponentially until the deadline. the elapsed time also counts the
+    # requested sleeps so that the deadline is kept even if the clock does
+    # not advance.
+    timeout = get_param(module, 'wait_timeout', WAIT_TIMEOUT)
+    max_interval = get_param(module, 'wait_max_interval', WAIT_MAX_INTERVAL)
+    start = time.time()
+    slept = 0
+    delay = get_param(module, 'wait_interval', WAIT_INTERVAL)
+    elapsed = 0
+
+    while True:
+        delay = min(delay, max(timeout - elapsed, 0))
+        time.sleep(delay)
+        slept += delay
+
+        finished = poll()
+        elapsed = max(time.time() - start, slept)
+        if finished or elapsed >= timeout:
+            break
+
+        delay = min(delay * WAIT_BACKOFF_FACTOR, max_interval)
+
+    return round(elapsed, 3)
+
+
+def wait_for_volume(module, volume_id=None, goal_state='attached'):
+    states = []
+
+    def poll():
+        states.append(get_volume_state(module, volume_id))
+        return states[-1][0] in WAIT_FINISHED_STATES[goal_state]
+
+    elapsed = wait_with_backoff(module, poll)
+    (current_state, instance_id) = states[-1]
+    return (current_state, instance_id, elapsed)
+
+
+def wait_for_volumes(module, volume_ids, goal_state='attached'):
+    # all the volumes not finished yet are polled with one DescribeVolumes
+    states = dict()
+    pending = list(volume_ids)
+
+    def poll():
+        described = describe_volumes(module, pending)
+        for volume_id in pending:
+            states[volume_id] = described.get(volume_id, ('absent', None))
+        pending[:] = [
+            volume_id for volume_id in pending
+            if states[volume_id][0] not in WAIT_FINISHED_STATES[goal_state]
+        ]
+        return len(pending) == 0
+
+    elapsed = 0
+    if len(pending) != 0:
+        elapsed = wait_with_backoff(module, poll)
+    return (states, elapsed)
 
 
-def create_volume(module):
+def create_volume(module, result=None):
 
     if module.check_mode:
         return (True, 'absent')
 
+    # the volume is polled by the id given by the response
+    # even if volume_id is not set.
+    (volume_id, current_state) = request_create_volume(module)
+    elapsed = 0
+    if current_state != 'attached':
+        (current_state, instance_id, elapsed) = \
+            wait_for_volume(module, volume_id)
+    if result is not None:
+        result['seconds_to_attached'] = elapsed
+
+    if current_state == 'attached':
+        return (True, 'created')
+    else:
+        fail(
+            module,
+            status=-1,
+            instance_id=module.params['instance_id'],
+            msg='changes failed (create_volume)',
+            current_state=current_state,
+            seconds_to_attached=elapsed
+        )
+
+
+def request_create_volume(module):
     params = dict(
         Size=module.params['size'],
         InstanceId=module.params['instance_id']
@@ -207,22 +463,14 @@ def create_volume(module):
     res = request_to_api(module, 'GET', 'CreateVolume', params)
 
     if res['status'] == 200:
-        (current_state, instance_id) = get_volume_state(module)
-        while 'attached' != current_state:
-            time.sleep(60)
-            (current_state, instance_id) = get_volume_state(module)
-
-        if current_state == 'attached':
-            return (True, 'created')
-        else:
-            module.fail_json(
-                status=-1,
-                instance_id=module.params['instance_id'],
-                msg='changes failed (create_volume)'
-            )
+        volume_id = res['xml_body'].find(
+            '{{{nc}}}volumeId'.format(**res['xml_namespace'])
+        ).text
+        return (volume_id, get_response_status(res))
     else:
         error_info = get_api_error(res['xml_body'])
-        module.fail_json(
+        fail(
+            module,
             status=-1,
             instance_id=module.params['instance_id'],
             msg='changes failed (create_volume)',
@@ -231,59 +479,443 @@ def create_volume(module):
         )
 
 
-def attach_volume(module):
+def attach_volume(module, result=None):
     (current_state, instance_id) = get_volume_state(module)
 
     if current_state == 'absent':
-        return create_volume(module)
+        return create_volume(module, result)
     elif current_state == 'available':
         if module.check_mode:
             return (True, current_state)
 
-        params = dict(
-            VolumeId=module.params['volume_id'],
-            InstanceId=module.params['instance_id']
-        )
-        res = request_to_api(module, 'GET', 'AttachVolume', params)
-
-        if res['status'] == 200:
-            current_state = res['xml_body'].find(
-                './/{{{nc}}}status'.format(**res['xml_namespace'])
-            ).text
-            while 'attached' != current_state:
-                time.sleep(60)
-                (current_state, instance_id) = get_volume_state(module)
-
-            if current_state == 'attached':
-                return (True, current_state)
-            else:
-                module.fail_json(
-                    status=-1,
-                    instance_id=module.params['instance_id'],
-                    msg='changes failed (attach_volume)'
-                )
+        current_state = request_attach_volume(module)
+        elapsed = 0
+        if current_state != 'attached':
+            (current_state, instance_id, elapsed) = \
+                wait_for_volume(module)
+        if result is not None:
+            result['seconds_to_attached'] = elapsed
+
+        if current_state == 'attached':
+            return (True, current_state)
         else:
-            error_info = get_api_error(res['xml_body'])
-            module.fail_json(
+            fail(
+                module,
                 status=-1,
                 instance_id=module.params['instance_id'],
                 msg='changes failed (attach_volume)',
-                error_code=error_info.get('code'),
-                error_message=error_info.get('message')
+                current_state=current_state,
+                seconds_to_attached=elapsed
             )
     elif (current_state == 'attached' and
           instance_id == module.params['instance_id']):
         return (False, current_state)
     else:
-        module.fail_json(
+        fail(
+            module,
             status=-1,
             instance_id=module.params['instance_id'],
             msg='invalid state (current state = "{0}")'.format(current_state)
         )
 
 
-def detach_volume(module):
-    module.fail_json(status=-1, msg='"absent" is not implemented.')
+def request_attach_volume(module):
+    params = dict(
+        VolumeId=module.params['volume_id'],
+        InstanceId=module.params['instance_id']
+    )
+    res = request_to_api(module, 'GET', 'AttachVolume', params)
+
+    if res['status'] == 200:
+        return get_response_status(res)
+    else:
+        error_info = get_api_error(res['xml_body'])
+        fail(
+            module,
+            status=-1,
+            instance_id=module.params['instance_id'],
+            msg='changes failed (attach_volume)',
+            error_code=error_info.get('code'),
+            error_message=error_info.get('message')
+        )
+
+
+def _request_volume_in_pool(request, volume_module, result):
+    try:
+        return request(volume_module, result)
+    except VolumeError as e:
+        e.kwargs.setdefault('volume_id', volume_module.params['volume_id'])
+        raise
+
+
+def request_volumes_in_pool(module, changes, request):
+    # the failed requests are returned as None with their errors, so that
+    # the volumes changed by the other requests are reported together.
+    responses = []
+    errors = []
+    if len(changes) == 0:
+        return (responses, errors)
+
+    max_workers = module.params.get('volumes_max_workers') or \
+        VOLUMES_MAX_WORKERS
+    pool = ThreadPool(max(1, min(max_workers, len(changes))))
+    try:
+        requested = [
+            pool.apply_async(_request_volume_in_pool, (
+                request, volume_module, result))
+            for (volume_module, result) in changes
+        ]
+        for response in requested:
+            try:
+                responses.append(response.get())
+            except VolumeError as e:
+                errors.append(e)
+                responses.append(None)
+    finally:
+        pool.close()
+        pool.join()
+
+    return (responses, errors)
+
+
+def fail_volume_requests(module, results, errors):
+    if len(errors) != 0:
+        fail(module, **dict(
+            errors[0].kwargs,
+            changed=any(result['changed'] for result in results),
+            volumes=results,
+        ))
+
+
+def _request_create_or_attach_volume(volume_module, result):
+    if result['status'] == 'absent':
+        return request_create_volume(volume_module)
+    return (volume_module.params['volume_id'],
+            request_attach_volume(volume_module))
+
+
+def attach_volumes(module):
+    specs = module.params['volumes']
+    volume_modules = [VolumeModule(module, spec) for spec in specs
+                      if isinstance(spec, dict)]
+    if len(volume_modules) != len(specs) or any(
+            not volume_module.params.get('instance_id')
+            or volume_module.params.get('size') is None
+            for volume_module in volume_modules):
+        fail(
+            module,
+            status=-1,
+            msg='instance_id and size are required for each of volumes'
+        )
+
+    volume_ids = [volume_module.params['volume_id']
+                  for volume_module in volume_modules
+                  if volume_module.params.get('volume_id') is not None]
+    if len(set(volume_ids)) != len(volume_ids):
+        fail(module, status=-1, msg='volume_id of volumes is duplicated')
+
+    states = dict()
+    if len(volume_ids) != 0:
+        states = describe_volumes(module, volume_ids)
+
+    # the current states are checked before any changes
+    results = []
+    for volume_module in volume_modules:
+        params = volume_module.params
+        (current_state, instance_id) = states.get(params.get('volume_id'),
+                                                  ('absent', None))
+        if current_state not in ('absent', 'available') \
+           and not (current_state == 'attached'
+                    and instance_id == params['instance_id']):
+            fail(
+                module,
+                status=-1,
+                volume_id=params.get('volume_id'),
+                instance_id=params['instance_id'],
+                msg='invalid state (current state = "{0}")'.format(
+                    current_state)
+            )
+        results.append(dict(
+            volume_id=params.get('volume_id'),
+            instance_id=params['instance_id'],
+            changed=current_state != 'attached',
+            status=current_state,
+        ))
+
+    changes = [(volume_module, result) for (volume_module, result)
+               in zip(volume_modules, results) if result['changed']]
+    if module.check_mode or len(changes) == 0:
+        return dict(
+            changed=len(changes) != 0,
+            volumes=results,
+            seconds_to_attached=0,
+        )
+
+    (responses, errors) = request_volumes_in_pool(
+        module, changes, _request_create_or_attach_volume)
+    for ((volume_module, result), response) in zip(changes, responses):
+        if response is None:
+            result['changed'] = False
+            continue
+        if result['status'] == 'absent':
+            result['created'] = True
+        (result['volume_id'], result['status']) = response
+    fail_volume_requests(module, results, errors)
+
+    # the volumes created or attached above are waited at once
+    (states, elapsed) = wait_for_volumes(
+        module,
+        [result['volume_id'] for (volume_module, result) in changes
+         if result['status'] != 'attached'])
+    for (volume_module, result) in changes:
+        if result['volume_id'] in states:
+            result['status'] = states[result['volume_id']][0]
+
+    unattached = [result['volume_id'] for (volume_module, result) in changes
+                  if result['status'] != 'attached']
+    if len(unattached) != 0:
+        fail(
+            module,
+            status=-1,
+            msg='changes failed (attach_volumes)',
+            changed=True,
+            volumes=results,
+            seconds_to_attached=elapsed
+        )
+
+    for (volume_module, result) in changes:
+        if result.pop('created', False):
+            result['status'] = 'created'
+
+    return dict(
+        changed=True,
+        volumes=results,
+        seconds_to_attached=elapsed,
+    )
+
+
+def detach_volume(module, result=None):
+    (current_state, instance_id) = get_volume_state(module)
+
+    if current_state == 'absent':
+        return (False, current_state)
+    elif current_state not in DETACHABLE_STATES:
+        fail(
+            module,
+            status=-1,
+            volume_id=module.params['volume_id'],
+            msg='invalid state (current state = "{0}")'.format(current_state)
+        )
+
+    if module.check_mode:
+        return (True, current_state)
+
+    elapsed = 0
+    if current_state == 'attached':
+        current_state = request_detach_volume(module, instance_id)
+    if current_state not in WAIT_FINISHED_STATES['available']:
+        (current_state, instance_id, elapsed) = \
+            wait_for_volume(module, goal_state='available')
+        if current_state not in ('available', 'deleting', 'absent'):
+            fail(
+                module,
+                status=-1,
+                volume_id=module.params['volume_id'],
+                msg='changes failed (detach_volume)',
+                current_state=current_state,
+                seconds_to_absent=elapsed
+            )
+
+    if current_state == 'available':
+        current_state = request_delete_volume(module)
+    if current_state != 'absent':
+        (current_state, instance_id, waited) = \
+            wait_for_volume(module, goal_state='absent')
+        elapsed += waited
+    if result is not None:
+        result['seconds_to_absent'] = elapsed
+
+    if current_state == 'absent':
+        return (True, current_state)
+    else:
+        fail(
+            module,
+            status=-1,
+            volume_id=module.params['volume_id'],
+            msg='changes failed (delete_volume)',
+            current_state=current_state,
+            seconds_to_absent=elapsed
+        )
+
+
+def request_detach_volume(module, instance_id):
+    params = dict(
+        VolumeId=module.params['volume_id'],
+        InstanceId=instance_id
+    )
+    res = request_to_api(module, 'GET', 'DetachVolume', params)
+
+    if res['status'] == 200:
+        return get_response_status(res)
+    else:
+        error_info = get_api_error(res['xml_body'])
+        fail(
+            module,
+            status=-1,
+            volume_id=module.params['volume_id'],
+            msg='changes failed (detach_volume)',
+            error_code=error_info.get('code'),
+            error_message=error_info.get('message')
+        )
+
+
+def request_delete_volume(module):
+    params = dict(
+        VolumeId=module.params['volume_id']
+    )
+    res = request_to_api(module, 'GET', 'DeleteVolume', params)
+
+    if res['status'] == 200:
+        return 'deleting'
+    else:
+        error_info = get_api_error(res['xml_body'])
+        fail(
+            module,
+            status=-1,
+            volume_id=module.params['volume_id'],
+            msg='changes failed (delete_volume)',
+            error_code=error_info.get('code'),
+            error_message=error_info.get('message')
+        )
+
+
+def _request_detach_volume(volume_module, result):
+    return request_detach_volume(volume_module, result['instance_id'])
+
+
+def _request_delete_volume(volume_module, result):
+    return request_delete_volume(volume_module)
+
+
+def detach_volumes(module):
+    specs = module.params['volumes']
+    volume_modules = [VolumeModule(module, spec) for spec in specs
+                      if isinstance(spec, dict)]
+    if len(volume_modules) != len(specs) or any(
+            not volume_module.params.get('volume_id')
+            for volume_module in volume_modules):
+        fail(
+            module,
+            status=-1,
+            msg='volume_id is required for each of volumes'
+        )
+
+    volume_ids = [volume_module.params['volume_id']
+                  for volume_module in volume_modules]
+    if len(set(volume_ids)) != len(volume_ids):
+        fail(module, status=-1, msg='volume_id of volumes is duplicated')
+
+    states = describe_volumes(module, volume_ids)
+
+    # the current states are checked before any changes
+    results = []
+    for volume_module in volume_modules:
+        volume_id = volume_module.params['volume_id']
+        (current_state, instance_id) = states.get(volume_id,
+                                                  ('absent', None))
+        if current_state != 'absent' \
+           and current_state not in DETACHABLE_STATES:
+            fail(
+                module,
+                status=-1,
+                volume_id=volume_id,
+                msg='invalid state (current state = "{0}")'.format(
+                    current_state)
+            )
+        results.append(dict(
+            volume_id=volume_id,
+            instance_id=instance_id,
+            changed=current_state != 'absent',
+            status=current_state,
+        ))
+
+    changes = [(volume_module, result) for (volume_module, result)
+               in zip(volume_modules, results) if result['changed']]
+    if module.check_mode or len(changes) == 0:
+        return dict(
+            changed=len(changes) != 0,
+            volumes=results,
+            seconds_to_absent=0,
+        )
+
+    # all the attached volumes are detached and waited at once,
+    # and then all the detached volumes are deleted in the same way
+    attached = [(volume_module, result) for (volume_module, result)
+                in changes if result['status'] == 'attached']
+    (responses, errors) = request_volumes_in_pool(module, attached,
+                                                  _request_detach_volume)
+    for ((volume_module, result), response) in zip(attached, responses):
+        if response is None:
+            result['changed'] = False
+        else:
+            result['status'] = response
+    fail_volume_requests(module, results, errors)
+
+    (states, elapsed) = wait_for_volumes(
+        module,
+        [result['volume_id'] for (volume_module, result) in changes
+         if result['status'] not in WAIT_FINISHED_STATES['available']],
+        'available')
+    for (volume_module, result) in changes:
+        if result['volume_id'] in states:
+            result['status'] = states[result['volume_id']][0]
+
+    if any(result['status'] not in ('available', 'deleting', 'absent')
+           for (volume_module, result) in changes):
+        fail(
+            module,
+            status=-1,
+            msg='changes failed (detach_volumes)',
+            changed=True,
+            volumes=results,
+            seconds_to_absent=elapsed
+        )
+
+    available = [(volume_module, result) for (volume_module, result)
+                 in changes if result['status'] == 'available']
+    (responses, errors) = request_volumes_in_pool(module, available,
+                                                  _request_delete_volume)
+    for ((volume_module, result), response) in zip(available, responses):
+        if response is not None:
+            result['status'] = response
+    fail_volume_requests(module, results, errors)
+
+    (states, waited) = wait_for_volumes(
+        module,
+        [result['volume_id'] for (volume_module, result) in changes
+         if result['status'] != 'absent'],
+        'absent')
+    elapsed += waited
+    for (volume_module, result) in changes:
+        if result['volume_id'] in states:
+            result['status'] = states[result['volume_id']][0]
+
+    if any(result['status'] != 'absent'
+           for (volume_module, result) in changes):
+        fail(
+            module,
+            status=-1,
+            msg='changes failed (delete_volumes)',
+            changed=True,
+            volumes=results,
+            seconds_to_absent=elapsed
+        )
+
+    return dict(
+        changed=True,
+        volumes=results,
+        seconds_to_absent=elapsed,
+    )
 
 
 def main():
@@ -292,34 +924,63 @@ def main():
             access_key=dict(required=True,  type='str'),
             secret_access_key=dict(required=True,  type='str', no_log=True),
             endpoint=dict(required=True,  type='str'),
-            size=dict(required=True,  type='str'),
+            size=dict(required=False, type='str', default=None),
             volume_id=dict(required=False, type='str', default=None),
             disk_type=dict(required=False, type='str', default=None),
-            instance_id=dict(required=True,  type='str'),
+            instance_id=dict(required=False, type='str', default=None),
             accounting_type=dict(required=False, type='str', default=None),
+            wait_timeout=dict(required=False, type='int',
+                              default=WAIT_TIMEOUT),
+            wait_interval=dict(required=False, type='int',
+                               default=WAIT_INTERVAL),
+            wait_max_interval=dict(required=False, type='int',
+                                   default=WAIT_MAX_INTERVAL),
+            volumes=dict(required=False, type='list', default=None),
+            volumes_max_workers=dict(required=False, type='int',
+                                     default=VOLUMES_MAX_WORKERS),
             state=dict(required=True,  type='str'),
         ),
+        mutually_exclusive=[['instance_id', 'volumes'],
+                            ['volume_id', 'volumes']],
         supports_check_mode=True
     )
 
     goal_state = module.params['state']
     instance_id = module.params['instance_id']
-
-    if goal_state == 'present':
-        (changed, current_state) = attach_volume(module)
+    result = dict()
+
+    if goal_state == 'present' and module.params.get('volumes'):
+        result = attach_volumes(module)
+    elif goal_state == 'absent' and module.params.get('volumes'):
+        result = detach_volumes(module)
+    elif goal_state == 'present':
+        if instance_id is None or module.params['size'] is None:
+            fail(
+                module,
+                status=-1,
+                msg='instance_id and size are required for "present"'
+            )
+        (changed, current_state) = attach_volume(module, result)
+        result.update(changed=changed, instance_id=instance_id,
+                      status=current_state)
     elif goal_state == 'absent':
-        (changed, current_state) = detach_volume(module)
+        if module.params['volume_id'] is None:
+            fail(
+                module,
+                status=-1,
+                msg='volume_id is required for "absent"'
+            )
+        (changed, current_state) = detach_volume(module, result)
+        result.update(changed=changed, instance_id=instance_id,
+                      status=current_state)
     else:
-        module.fail_json(
+        fail(
+            module,
             status=-1,
             msg='invalid state (goal state = "{0}")'.format(goal_state)
         )
 
-    module.exit_json(
-        changed=changed,
-        instance_id=instance_id,
-        status=current_state
-    )
+    module.exit_json(api_calls=dict(API_CALLS), **result)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+
+# Copyright Fujitsu
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Benchmark of nifcloud_fw with synthetic firewall groups.
+#
+# This file is not collected with the unit tests. Run it from library/:
+#
+#     python tests/benchmark_nifcloud_fw.py
+#
+# NIFCLOUD_BENCHMARK_SIZES  numbers of rules (default: 10,100,1000,10000)
+# NIFCLOUD_BENCHMARK_FACTOR multiplier of the time budgets (default: 1)
+
+import os
+import sys
+import time
+import unittest
+
+import mock
+
+sys.path.append('.')
+sys.path.append('..')
+
+import nifcloud_fw  # noqa
+
+from ansible.module_utils.six.moves.urllib.parse import parse_qs  # noqa
+
+
+SIZES = [int(size) for size in os.environ.get(
+    'NIFCLOUD_BENCHMARK_SIZES', '10,100,1000,10000').split(',')]
+FACTOR = float(os.environ.get('NIFCLOUD_BENCHMARK_FACTOR', '1'))
+
+# time budgets (fixed seconds, seconds per rule). they are about ten times
+# the measured time, so that only real regressions fail.
+BUDGETS = dict(
+    describe=(0.05, 0.0002),
+    except_ip_permissions=(0.01, 0.00005),
+    build_params=(0.01, 0.0003),
+    run=(0.5, 0.002),
+)
+
+# the time per rule of a larger group must be less than this ratio of
+# the one of a smaller group (linear is about 1, quadratic grows with size)
+MAX_SCALING_RATIO = 3
+
+# ratio of the rules replaced in the desired ip_permissions
+CHANGED_RULES_RATIO = 0.1
+
+XML_NAMESPACE = 'https://cp.cloud.nifty.com/api/'
+
+IP_PERMISSION_XML = '''
+    <item>
+     <ipProtocol>{ip_protocol}</ipProtocol>
+     <fromPort>{from_port}</fromPort>
+     <toPort>{to_port}</toPort>
+     <inOut>{in_out}</inOut>
+     <ipRanges>
+      <item>
+       <cidrIp>{cidr_ip}</cidrIp>
+      </item>
+     </ipRanges>
+     <description>{description}</description>
+     <addDatetime>2001-02-03T04:05:06.007Z</addDatetime>
+    </item>'''
+
+DESCRIBE_XML = '''
+<DescribeSecurityGroupsResponse xmlns="{namespace}">
+ <RequestID>5ec8da0a-6e23-4343-b474-ca0bb5c22a51</RequestID>
+ <securityGroupInfo>
+  <item>
+   <ownerId></ownerId>
+   <groupName>{group_name}</groupName>
+   <groupDescription>benchmark</groupDescription>
+   <groupStatus>applied</groupStatus>
+   <ipPermissions>{ip_permissions}
+   </ipPermissions>
+   <groupRuleLimit>{rule_limit}</groupRuleLimit>
+   <groupLogLimit>1000</groupLogLimit>
+  </item>
+ </securityGroupInfo>
+</DescribeSecurityGroupsResponse>
+'''
+
+ACTION_XML = '''
+<{action}Response xmlns="{namespace}">
+ <requestId>320fc738-a1c7-4a2f-abcb-20813a4e997c</requestId>
+ <return>true</return>
+</{action}Response>
+'''
+
+
+def build_ip_permissions(size, cidr_ip='10.0.0.0/24'):
+    return [
+        dict(
+            in_out='IN',
+            ip_protocol='TCP',
+            from_port=port,
+            to_port=port,
+            cidr_ip=cidr_ip,
+            description='TCP ({0})'.format(port),
+        )
+        for port in range(size)
+    ]
+
+
+def build_desired_ip_permissions(size):
+    # the last rules are replaced with ones of another cidr block
+    changed_size = int(size * CHANGED_RULES_RATIO)
+    ip_permissions = build_ip_permissions(size)
+    ip_permissions[size - changed_size:] = build_ip_permissions(
+        size, '10.0.1.0/24')[size - changed_size:]
+    return ip_permissions
+
+
+class FakeNifcloudApi(object):
+    """In-memory firewall group behind requests.get/requests.post"""
+
+    def __init__(self, group_name, ip_permissions):
+        self.group_name = group_name
+        self.ip_permissions = list(ip_permissions)
+        self.calls = dict()
+
+    def response(self, text, status_code=200):
+        return mock.MagicMock(status_code=status_code, text=text)
+
+    def get(self, url):
+        return self.handle(parse_qs(url.split('?', 1)[1]))
+
+    def post(self, url, data):
+        return self.handle(parse_qs(data))
+
+    def handle(self, query):
+        params = dict((key, values[0]) for (key, values) in query.items())
+        action = params['Action']
+        self.calls[action] = self.calls.get(action, 0) + 1
+
+        if action == 'DescribeSecurityGroups':
+            return self.response(self.describe())
+        if action == 'AuthorizeSecurityGroupIngress':
+            self.ip_permissions.extend(self.parse_ip_permissions(params))
+        elif action == 'RevokeSecurityGroupIngress':
+            self.ip_permissions = nifcloud_fw.except_ip_permissions(
+                self.ip_permissions, self.parse_ip_permissions(params))
+        return self.response(ACTION_XML.format(action=action,
+                                               namespace=XML_NAMESPACE))
+
+    def describe(self):
+        return DESCRIBE_XML.format(
+            namespace=XML_NAMESPACE,
+            group_name=self.group_name,
+            rule_limit=len(self.ip_permissions) * 2,
+            ip_permissions=''.join([
+                IP_PERMISSION_XML.format(**dict(
+                    dict(description=''), **ip_permission))
+                for ip_permission in self.ip_permissions
+            ]),
+        )
+
+    def parse_ip_permissions(self, params):
+        ip_permissions = []
+        index = 1
+        while 'IpPermissions.{0}.InOut'.format(index) in params:
+            prefix = 'IpPermissions.{0}.'.format(index)
+            ip_permissions.append(dict(
+                in_out=params[prefix + 'InOut'],
+                ip_protocol=params[prefix + 'IpProtocol'],
+                from_port=int(params[prefix + 'FromPort']),
+                to_port=int(params[prefix + 'ToPort']),
+                cidr_ip=params[prefix + 'IpRanges.1.CidrIp'],
+                description=params.get(prefix + 'Description', ''),
+            ))
+            index += 1
+        return ip_permissions
+
+
+class TestNifcloudFwBenchmark(unittest.TestCase):
+    def setUp(self):
+        self.module = mock.MagicMock(
+            params=dict(
+                access_key='ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789',
+                secret_access_key='ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789',
+                endpoint='west-1.cp.cloud.nifty.com',
+                group_name='fw001',
+                description=None,
+                availability_zone=None,
+                log_limit=None,
+                state='present',
+                purge_ip_permissions=True,
+                authorize_in_bulk=True,
+                ip_permissions=[],
+                ip_permissions_strategy='incremental',
+            ),
+            fail_json=mock.MagicMock(side_effect=Exception('failed')),
+            check_mode=False,
+        )
+        self.timings = dict()
+
+        patcher = mock.patch('time.sleep')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def measure(self, name, size, function):
+        start = time.time()
+        value = function()
+        elapsed = time.time() - start
+        self.timings.setdefault(name, dict())[size] = elapsed
+        sys.stderr.write('\n{0:<24}{1:>6} rules {2:10.4f}s'.format(
+            name, size, elapsed))
+        return value
+
+    def assertWithinBudget(self, name):
+        (fixed, per_rule) = BUDGETS[name]
+        timings = self.timings[name]
+        for size in sorted(timings):
+            budget = (fixed + per_rule * size) * FACTOR
+            self.assertLess(
+                timings[size], budget,
+                '{0} of {1} rules took {2:.4f}s (budget {3:.4f}s)'.format(
+                    name, size, timings[size], budget))
+
+        # fixed costs dominate small sizes, so only large ones are compared
+        sizes = [size for size in sorted(timings) if size >= 1000]
+        for (small, large) in zip(sizes, sizes[1:]):
+            ratio = ((timings[large] / large) /
+                     max(timings[small] / small, 1e-9))
+            self.assertLess(
+                ratio, MAX_SCALING_RATIO,
+                '{0} does not scale from {1} to {2} rules'.format(
+                    name, small, large))
+
+    # parse of DescribeSecurityGroups
+    def test_describe_security_group(self):
+        for size in SIZES:
+            api = FakeNifcloudApi('fw001', build_ip_permissions(size))
+            with mock.patch('requests.get', api.get):
+                (result, info) = self.measure(
+                    'describe', size,
+                    lambda: nifcloud_fw.describe_security_group(
+                        self.module, dict(created=False,
+                                          changed_attributes=dict(),
+                                          state='absent')))
+            self.assertEqual(len(info['ip_permissions']), size)
+        self.assertWithinBudget('describe')
+
+    # diff of desired and current rules
+    def test_except_ip_permissions(self):
+        for size in SIZES:
+            current = build_ip_permissions(size)
+            desired = build_desired_ip_permissions(size)
+            authorize_rules = self.measure(
+                'except_ip_permissions', size,
+                lambda: nifcloud_fw.except_ip_permissions(desired, current))
+            self.assertEqual(len(authorize_rules),
+                             int(size * CHANGED_RULES_RATIO))
+        self.assertWithinBudget('except_ip_permissions')
+
+    # parameters of AuthorizeSecurityGroupIngress/RevokeSecurityGroupIngress
+    def test_build_params(self):
+        for size in SIZES:
+            rules = build_ip_permissions(size)
+
+            def build():
+                for params in (
+                        nifcloud_fw.build_authorize_params('fw001', rules),
+                        nifcloud_fw.build_revoke_params('fw001', rules),
+                ):
+                    nifcloud_fw.calculate_signature(
+                        'ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789', 'POST',
+                        'west-1.cp.cloud.nifty.com', '/api/', params)
+            self.measure('build_params', size, build)
+        self.assertWithinBudget('build_params')
+
+    # whole module run (replace some rules in bulk)
+    def test_run(self):
+        for size in SIZES:
+            api = FakeNifcloudApi('fw001', build_ip_permissions(size))
+            self.module.params['ip_permissions'] = \
+                build_desired_ip_permissions(size)
+            self.module.exit_json = mock.MagicMock()
+            with mock.patch('requests.get', api.get):
+                with mock.patch('requests.post', api.post):
+                    self.measure('run', size,
+                                 lambda: nifcloud_fw.run(self.module))
+
+            result = self.module.exit_json.call_args[1]
+            changed_size = int(size * CHANGED_RULES_RATIO)
+            self.assertEqual(
+                result['changed'], changed_size != 0)
+            self.assertEqual(
+                nifcloud_fw.except_ip_permissions(
+                    self.module.params['ip_permissions'],
+                    api.ip_permissions),
+                [])
+            self.assertEqual(len(api.ip_permissions), size)
+        self.assertWithinBudget('run')
+
+
+if __name__ == '__main__':
+    unittest.main()
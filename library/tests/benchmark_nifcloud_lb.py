@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+
+# Copyright Fujitsu
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Benchmark of nifcloud_lb with large backend pools.
+#
+# This file is not collected with the unit tests. Run it from library/:
+#
+#     python tests/benchmark_nifcloud_lb.py
+#
+# NIFCLOUD_BENCHMARK_INSTANCES number of instances (default: 500)
+# NIFCLOUD_BENCHMARK_LATENCY   seconds of each fake API request (default: 0.01)
+# NIFCLOUD_BENCHMARK_ADDRESSES numbers of filter ip addresses
+#                              (default: 100,1000,10000)
+# NIFCLOUD_BENCHMARK_MEMBERS   numbers of instances and filter ip addresses
+#                              in DescribeLoadBalancers (default: 100,500,1000)
+# NIFCLOUD_BENCHMARK_FACTOR    multiplier of the time budgets (default: 1)
+
+import os
+import sys
+import threading
+import time
+import unittest
+import xml.etree.ElementTree as etree
+
+import mock
+
+sys.path.append('.')
+sys.path.append('..')
+
+import nifcloud_lb  # noqa
+
+from ansible.module_utils.six.moves.urllib.parse import parse_qs  # noqa
+
+
+INSTANCES = int(os.environ.get('NIFCLOUD_BENCHMARK_INSTANCES', '500'))
+LATENCY = float(os.environ.get('NIFCLOUD_BENCHMARK_LATENCY', '0.01'))
+ADDRESSES = [int(size) for size in os.environ.get(
+    'NIFCLOUD_BENCHMARK_ADDRESSES', '100,1000,10000').split(',')]
+MEMBERS = [int(size) for size in os.environ.get(
+    'NIFCLOUD_BENCHMARK_MEMBERS', '100,500,1000').split(',')]
+FACTOR = float(os.environ.get('NIFCLOUD_BENCHMARK_FACTOR', '1'))
+
+# time budgets of filter ip addresses (fixed seconds, seconds per address).
+# they are about ten times the measured time.
+FILTER_BUDGETS = dict(
+    filter_diff=(0.01, 0.0001),
+    filter_build=(0.01, 0.0001),
+)
+
+# time budgets of DescribeLoadBalancers (fixed seconds, seconds per member)
+SNAPSHOT_BUDGETS = dict(
+    snapshot_parse=(0.01, 0.00005),
+    snapshot_diff=(0.01, 0.0001),
+)
+
+# ratio of the filter ip addresses replaced in the desired ones
+CHANGED_ADDRESSES_RATIO = 0.1
+
+# filter ip addresses sent with one SetFilterForLoadBalancer request
+FILTER_IP_ADDRESSES_PER_REQUEST = 100
+
+# (instance_ids_per_request, max_workers)
+SETTINGS = [(None, 1), (10, 1), (10, 4), (10, 8), (50, 8)]
+
+# the parallel requests must be at least this times faster than
+# the sequential ones of the same chunk size
+MIN_PARALLEL_SPEEDUP = 2
+
+XML_NAMESPACE = 'https://cp.cloud.nifty.com/api/'
+
+ACTION_XML = '''
+<{action}Response xmlns="{namespace}">
+  <ResponseMetadata>
+    <RequestId>ac501097-4c8d-475b-b06b-a90048ec181c</RequestId>
+  </ResponseMetadata>
+</{action}Response>
+'''
+
+DESCRIBE_XML = '''
+<DescribeLoadBalancersResponse xmlns="{namespace}">
+ <DescribeLoadBalancersResult>
+  <LoadBalancerDescriptions>
+   <member>
+    <LoadBalancerName>lb001</LoadBalancerName>
+    <ListenerDescriptions>
+     <member>
+      <Listener>
+       <Protocol>HTTP</Protocol>
+       <LoadBalancerPort>80</LoadBalancerPort>
+       <InstancePort>80</InstancePort>
+       <BalancingType>1</BalancingType>
+      </Listener>
+     </member>
+    </ListenerDescriptions>
+    <Instances>{instances}
+    </Instances>
+    <HealthCheck>
+     <Target>ICMP</Target>
+     <Interval>5</Interval>
+     <UnhealthyThreshold>1</UnhealthyThreshold>
+     <InstanceStates>{instance_states}
+     </InstanceStates>
+    </HealthCheck>
+    <Filter>
+     <FilterType>1</FilterType>
+     <IPAddresses>
+      <member>{ip_addresses}
+      </member>
+     </IPAddresses>
+    </Filter>
+   </member>
+  </LoadBalancerDescriptions>
+ </DescribeLoadBalancersResult>
+</DescribeLoadBalancersResponse>
+'''
+
+INSTANCE_XML = '''
+     <member>
+      <InstanceId>{0}</InstanceId>
+      <InstanceUniqueId>i-{0}</InstanceUniqueId>
+     </member>'''
+
+INSTANCE_STATE_XML = '''
+      <member>
+       <InstanceId>{0}</InstanceId>
+       <State>InService</State>
+      </member>'''
+
+ERROR_XML = '''
+<Response>
+ <Errors>
+  <Error>
+   <Code>Client.InvalidParameterLimitExceeded.Instances</Code>
+   <Message>Too many instances.</Message>
+  </Error>
+ </Errors>
+ <RequestID>5ec8da0a-6e23-4343-b474-ca0bb5c22a51</RequestID>
+</Response>
+'''
+
+
+def build_ip_addresses(size, prefix='10'):
+    # equivalent notations are mixed so that normalization is measured
+    return [
+        '{0}.{1}.{2}.{3}{4}'.format(prefix, i // 65536, i // 256 % 256,
+                                    i % 256, '/32' if i % 2 else '')
+        for i in range(size)
+    ]
+
+
+def build_desired_ip_addresses(size):
+    changed_size = int(size * CHANGED_ADDRESSES_RATIO)
+    ip_addresses = build_ip_addresses(size)
+    ip_addresses[size - changed_size:] = build_ip_addresses(
+        size, '172')[size - changed_size:]
+    return ip_addresses
+
+
+def build_describe(size):
+    instance_ids = ['server{0:04d}'.format(i) for i in range(size)]
+    text = DESCRIBE_XML.format(
+        namespace=XML_NAMESPACE,
+        instances=''.join(INSTANCE_XML.format(instance_id)
+                          for instance_id in instance_ids),
+        instance_states=''.join(INSTANCE_STATE_XML.format(instance_id)
+                                for instance_id in instance_ids),
+        ip_addresses=''.join('<IPAddress>{0}</IPAddress>'.format(ip)
+                             for ip in build_ip_addresses(size)),
+    )
+    return dict(
+        status=200,
+        xml_body=etree.fromstring(text),
+        xml_namespace=dict(nc=XML_NAMESPACE),
+    )
+
+
+class FakeLoadBalancerApi(object):
+    """In-memory load balancer behind requests.post with a fixed latency"""
+
+    def __init__(self, latency, max_instances_per_request=None):
+        self.latency = latency
+        self.max_instances_per_request = max_instances_per_request
+        self.instance_ids = set()
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def post(self, url, data):
+        time.sleep(self.latency)
+        params = dict((key, values[0])
+                      for (key, values) in parse_qs(data).items())
+        instance_ids = [value for (key, value) in params.items()
+                        if key.startswith('Instances.member.')]
+
+        with self.lock:
+            self.requests += 1
+            if self.max_instances_per_request is not None and \
+               len(instance_ids) > self.max_instances_per_request:
+                return mock.MagicMock(status_code=400, text=ERROR_XML)
+
+            if params['Action'] == 'RegisterInstancesWithLoadBalancer':
+                self.instance_ids.update(instance_ids)
+            else:
+                self.instance_ids.difference_update(instance_ids)
+
+        return mock.MagicMock(
+            status_code=200,
+            text=ACTION_XML.format(action=params['Action'],
+                                   namespace=XML_NAMESPACE))
+
+
+class TestNifcloudLbBenchmark(unittest.TestCase):
+    def build_module(self, instance_ids_per_request, max_workers):
+        return mock.MagicMock(
+            params=dict(
+                access_key='ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789',
+                secret_access_key='ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789',
+                endpoint='west-1.cp.cloud.nifty.com',
+                loadbalancer_name='lb001',
+                loadbalancer_port=80,
+                instance_port=80,
+                balancing_type=1,
+                network_volume=10,
+                ip_version='v4',
+                accounting_type='1',
+                policy_type='standard',
+                instance_ids=[],
+                purge_instance_ids=True,
+                filter_ip_addresses=[],
+                filter_type=1,
+                purge_filter_ip_addresses=True,
+                health_check_target='ICMP',
+                health_check_interval=5,
+                health_check_unhealthy_threshold=1,
+                ssl_policy_name='',
+                state='present',
+                instance_ids_per_request=instance_ids_per_request,
+                max_workers=max_workers,
+            ),
+            fail_json=mock.MagicMock(side_effect=Exception('failed')),
+            check_mode=False,
+        )
+
+    def measure(self, api, instance_ids_per_request, max_workers):
+        instance_ids = ['server{0:04d}'.format(i) for i in range(INSTANCES)]
+        manager = nifcloud_lb.LoadBalancerManager(
+            self.build_module(instance_ids_per_request, max_workers))
+
+        with mock.patch('requests.post', api.post):
+            start = time.time()
+            manager._register_instances(instance_ids)
+            elapsed = time.time() - start
+
+        sys.stderr.write(
+            '\nregister {0} instances per_request={1} workers={2}: '
+            '{3} requests {4:.4f}s'.format(INSTANCES, instance_ids_per_request,
+                                           max_workers, api.requests,
+                                           elapsed))
+        self.assertEqual(api.instance_ids, set(instance_ids))
+        return elapsed
+
+    # register instances with chunk sizes and workers
+    def test_register_instances(self):
+        timings = dict()
+        for (instance_ids_per_request, max_workers) in SETTINGS:
+            api = FakeLoadBalancerApi(LATENCY)
+            timings[(instance_ids_per_request, max_workers)] = self.measure(
+                api, instance_ids_per_request, max_workers)
+
+        self.assertLess(timings[(10, 8)] * MIN_PARALLEL_SPEEDUP,
+                        timings[(10, 1)])
+
+    # register instances over the limit of the API
+    def test_register_instances_partial_failure(self):
+        api = FakeLoadBalancerApi(LATENCY, max_instances_per_request=10)
+        module = self.build_module(None, 4)
+        instance_ids = ['server{0:04d}'.format(i) for i in range(INSTANCES)]
+        # the last chunk is too large
+        chunks = nifcloud_lb.split_into_chunks(instance_ids, 10)
+        chunks[-2:] = [chunks[-2] + chunks[-1]]
+
+        manager = nifcloud_lb.LoadBalancerManager(module)
+        with mock.patch('requests.post', api.post):
+            with mock.patch('nifcloud_lb.split_into_chunks',
+                            mock.MagicMock(return_value=chunks)):
+                self.assertRaises(Exception, manager._register_instances,
+                                  instance_ids)
+
+        kwargs = module.fail_json.call_args[1]
+        self.assertEqual(sorted(kwargs['failed_instance_ids']),
+                         sorted(chunks[-1]))
+        self.assertEqual(len(kwargs['succeeded_instance_ids']),
+                         INSTANCES - len(chunks[-1]))
+
+    def measure_members(self, timings, name, size, function):
+        start = time.time()
+        value = function()
+        elapsed = time.time() - start
+        timings.setdefault(name, dict())[size] = elapsed
+        sys.stderr.write('\n{0:<16}{1:>6} members {2:10.4f}s'.format(
+            name, size, elapsed))
+        return value
+
+    def assertWithinBudgets(self, budgets, timings):
+        for (name, sizes) in timings.items():
+            (fixed, per_member) = budgets[name]
+            for size in sorted(sizes):
+                budget = (fixed + per_member * size) * FACTOR
+                self.assertLess(
+                    sizes[size], budget,
+                    '{0} of {1} members took {2:.4f}s '
+                    '(budget {3:.4f}s)'.format(name, size, sizes[size],
+                                               budget))
+
+    # parse of DescribeLoadBalancers and diff of the snapshot
+    def test_snapshot(self):
+        timings = dict()
+        for size in MEMBERS:
+            res = build_describe(size)
+            snapshot = nifcloud_lb.LoadBalancerSnapshot()
+            self.measure_members(timings, 'snapshot_parse', size,
+                                 lambda: snapshot.parse_describe(res))
+            self.assertEqual(len(snapshot.instances.instance_ids), size)
+            self.assertEqual(len(snapshot.filter.ip_addresses), size)
+
+            module = self.build_module(None, 1)
+            module.params['instance_ids'] = [
+                'server{0:04d}'.format(i) for i in range(1, size + 1)]
+            module.params['filter_ip_addresses'] = \
+                build_desired_ip_addresses(size)
+            manager = nifcloud_lb.LoadBalancerManager(module)
+
+            def diff():
+                return (manager._extract_instance_ids_diff(snapshot),
+                        manager._build_sync_requests(snapshot))
+            ((deregister_instance_ids, register_instance_ids),
+             requests) = self.measure_members(timings, 'snapshot_diff',
+                                              size, diff)
+            self.assertEqual(deregister_instance_ids, ['server0000'])
+            self.assertEqual(len(register_instance_ids), 1)
+
+        self.assertWithinBudgets(SNAPSHOT_BUDGETS, timings)
+
+    # diff and SetFilterForLoadBalancer parameters of filter ip addresses
+    def test_filter_ip_addresses(self):
+        timings = dict()
+        for size in ADDRESSES:
+            module = self.build_module(None, 1)
+            module.params['filter_ip_addresses'] = \
+                build_desired_ip_addresses(size)
+            module.params['filter_ip_addresses_per_request'] = \
+                FILTER_IP_ADDRESSES_PER_REQUEST
+            manager = nifcloud_lb.LoadBalancerManager(module)
+            snapshot = nifcloud_lb.LoadBalancerSnapshot()
+            snapshot.filter = nifcloud_lb.LoadBalancerFilter(
+                1, build_ip_addresses(size))
+
+            (purge_ip_list, merge_ip_list) = self.measure_members(
+                timings, 'filter_diff', size,
+                lambda: manager._extract_filter_ip_diff(snapshot))
+            changed_size = int(size * CHANGED_ADDRESSES_RATIO)
+            self.assertEqual(len(purge_ip_list), changed_size)
+            self.assertEqual(len(merge_ip_list), changed_size)
+
+            request = self.measure_members(
+                timings, 'filter_build', size,
+                lambda: manager._build_filter_request(snapshot))
+            if changed_size != 0:
+                self.assertEqual(
+                    len(request['params_list']),
+                    -(-changed_size * 2 // FILTER_IP_ADDRESSES_PER_REQUEST))
+
+        self.assertWithinBudgets(FILTER_BUDGETS, timings)
+
+
+if __name__ == '__main__':
+    unittest.main()
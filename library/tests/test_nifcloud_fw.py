@@ -15,7 +15,13 @@
 # limitations under the License.
 
 import copy
+import fcntl
+import json
+import os
+import shutil
 import sys
+import tempfile
+import threading
 import unittest
 import xml.etree.ElementTree as etree
 
@@ -771,6 +777,161 @@ class TestNifcloud(unittest.TestCase):
             []
         )
 
+    # compact_port_ranges
+    def test_compact_port_ranges(self):
+        ip_permissions = [
+            dict(in_out='IN', ip_protocol='TCP', from_port=20000,
+                 to_port=20099, group_name='admin'),
+            dict(in_out='IN', ip_protocol='ICMP', cidr_ip='10.0.0.11'),
+            dict(in_out='IN', ip_protocol='TCP', from_port=20050,
+                 to_port=20199, group_name='admin'),
+            dict(in_out='IN', ip_protocol='TCP', from_port=20200,
+                 group_name='admin'),
+            dict(in_out='OUT', ip_protocol='TCP', from_port=20201,
+                 group_name='admin'),
+            dict(in_out='IN', ip_protocol='TCP', from_port=30000,
+                 group_name='admin'),
+        ]
+
+        self.assertEqual(
+            nifcloud_fw.compact_port_ranges(ip_permissions),
+            [
+                dict(in_out='IN', ip_protocol='TCP', from_port=20000,
+                     to_port=20200, group_name='admin'),
+                dict(in_out='IN', ip_protocol='ICMP', cidr_ip='10.0.0.11'),
+                dict(in_out='OUT', ip_protocol='TCP', from_port=20201,
+                     group_name='admin'),
+                dict(in_out='IN', ip_protocol='TCP', from_port=30000,
+                     group_name='admin'),
+            ]
+        )
+
+    # compact_cidr_blocks
+    def test_compact_cidr_blocks(self):
+        ip_permissions = [
+            dict(in_out='IN', ip_protocol='SSH', cidr_ip='10.0.0.0/25',
+                 description='first'),
+            dict(in_out='IN', ip_protocol='SSH', group_name='admin'),
+            dict(in_out='IN', ip_protocol='SSH', cidr_ip='10.0.0.128/25'),
+            dict(in_out='IN', ip_protocol='SSH', cidr_ip='10.0.2.11'),
+            dict(in_out='IN', ip_protocol='HTTP', cidr_ip='10.0.1.0/24'),
+            dict(in_out='IN', ip_protocol='SSH', cidr_ip='10.0.2.0/24'),
+            dict(in_out='IN', ip_protocol='SSH', cidr_ip='invalid'),
+        ]
+
+        self.assertEqual(
+            nifcloud_fw.compact_cidr_blocks(ip_permissions),
+            [
+                dict(in_out='IN', ip_protocol='SSH', cidr_ip='10.0.0.0/24',
+                     description='first'),
+                dict(in_out='IN', ip_protocol='SSH', group_name='admin'),
+                dict(in_out='IN', ip_protocol='SSH', cidr_ip='10.0.2.0/24'),
+                dict(in_out='IN', ip_protocol='HTTP', cidr_ip='10.0.1.0/24'),
+                dict(in_out='IN', ip_protocol='SSH', cidr_ip='invalid'),
+            ]
+        )
+
+    # compact_ip_permissions
+    def test_compact_ip_permissions(self):
+        ip_permissions = [
+            dict(in_out='IN', ip_protocol='TCP', from_port=80,
+                 cidr_ip='10.0.0.0/25'),
+            dict(in_out='IN', ip_protocol='TCP', from_port=80,
+                 cidr_ip='10.0.0.128/25'),
+            dict(in_out='IN', ip_protocol='TCP', from_port=81, to_port=90,
+                 cidr_ip='10.0.0.0/24'),
+        ]
+
+        self.assertEqual(
+            nifcloud_fw.compact_ip_permissions(ip_permissions),
+            [
+                dict(in_out='IN', ip_protocol='TCP', from_port=80,
+                     to_port=90, cidr_ip='10.0.0.0/24'),
+            ]
+        )
+
+    # compact_ip_permissions no change
+    def test_compact_ip_permissions_no_change(self):
+        ip_permissions = self.mockModule.params['ip_permissions']
+
+        self.assertEqual(
+            nifcloud_fw.compact_ip_permissions(ip_permissions),
+            ip_permissions
+        )
+
+    # normalize_ip_permission
+    def test_normalize_ip_permission(self):
+        self.assertEqual(
+            nifcloud_fw.normalize_ip_permission(dict(
+                in_out=' in ',
+                ip_protocol='tcp',
+                from_port='20000',
+                to_port='',
+                cidr_ip=None,
+                group_name='admin',
+                unknown='ignored',
+            )),
+            dict(
+                in_out='IN',
+                ip_protocol='TCP',
+                from_port=20000,
+                group_name='admin',
+            )
+        )
+
+    # normalize_ip_permission not mapping
+    def test_normalize_ip_permission_invalid(self):
+        self.assertRaises(
+            ValueError,
+            nifcloud_fw.normalize_ip_permission,
+            ['IN', 'TCP']
+        )
+
+    # load_ip_permissions_file csv, jsonl and yaml
+    def test_load_ip_permissions_file(self):
+        expected = [
+            dict(
+                in_out='OUT',
+                ip_protocol='ANY',
+                cidr_ip='0.0.0.0/0',
+                description='all outgoing protocols are allow',
+            ),
+            dict(
+                in_out='IN',
+                ip_protocol='ICMP',
+                cidr_ip='192.168.0.0/24',
+            ),
+            dict(
+                in_out='IN',
+                ip_protocol='TCP',
+                from_port=20000,
+                to_port=29999,
+                group_name='admin',
+            ),
+        ]
+
+        for extension in ['csv', 'jsonl', 'yml']:
+            path = '{0}/files/ip_permissions.{1}'.format(
+                os.path.dirname(__file__), extension)
+            self.assertEqual(
+                list(nifcloud_fw.load_ip_permissions_file(path)),
+                expected
+            )
+
+    # get_ip_permissions_file_format
+    def test_get_ip_permissions_file_format(self):
+        self.assertEqual(
+            nifcloud_fw.get_ip_permissions_file_format('rules.YAML'),
+            'yaml'
+        )
+        self.assertEqual(
+            nifcloud_fw.get_ip_permissions_file_format('rules.txt', 'csv'),
+            'csv'
+        )
+        self.assertIsNone(
+            nifcloud_fw.get_ip_permissions_file_format('rules.txt')
+        )
+
     # describe present
     def test_describe_security_group_present(self):
         with mock.patch('requests.get',
@@ -900,6 +1061,84 @@ class TestNifcloud(unittest.TestCase):
         ))
         self.assertIsNone(info)
 
+    # describe present with multiple ipRanges/groups in one item
+    def test_describe_security_group_multiple_sources(self):
+        mock_requests = mock.MagicMock(
+            return_value=mock.MagicMock(
+                status_code=200,
+                text=self.xml['describeSecurityGroupsMultipleSources']
+            ))
+
+        with mock.patch('requests.get', mock_requests):
+            (result, info) = nifcloud_fw.describe_security_group(
+                self.mockModule,
+                self.result['absent']
+            )
+
+        self.assertEqual(result['state'], 'present')
+        self.assertEqual(info['group_name'], 'fw001')
+        self.assertEqual(info['ip_permissions'], [
+            dict(
+                ip_protocol='TCP',
+                in_out='IN',
+                from_port=443,
+                to_port=None,
+                cidr_ip='10.0.0.0/24',
+                group_name=None,
+            ),
+            dict(
+                ip_protocol='TCP',
+                in_out='IN',
+                from_port=443,
+                to_port=None,
+                cidr_ip='10.0.1.0/24',
+                group_name=None,
+            ),
+            dict(
+                ip_protocol='TCP',
+                in_out='IN',
+                from_port=443,
+                to_port=None,
+                cidr_ip=None,
+                group_name='fw002',
+            ),
+            dict(
+                ip_protocol='TCP',
+                in_out='IN',
+                from_port=443,
+                to_port=None,
+                cidr_ip=None,
+                group_name='fw003',
+            ),
+        ])
+
+    # describe present with large ip_permissions
+    def test_describe_security_group_large_response(self):
+        rule_size = 10000
+        mock_requests = mock.MagicMock(
+            return_value=mock.MagicMock(
+                status_code=200,
+                text=build_describe_security_groups_response(rule_size)
+            ))
+
+        with mock.patch('requests.get', mock_requests):
+            (result, info) = nifcloud_fw.describe_security_group(
+                self.mockModule,
+                self.result['absent']
+            )
+
+        self.assertEqual(result['state'], 'present')
+        self.assertEqual(info['group_name'], 'fw001')
+        self.assertEqual(len(info['ip_permissions']), rule_size)
+        self.assertEqual(info['ip_permissions'][-1], dict(
+            ip_protocol='TCP',
+            in_out='IN',
+            from_port=rule_size - 1,
+            to_port=rule_size - 1,
+            cidr_ip='10.0.0.0/24',
+            group_name=None,
+        ))
+
     # wait_for_processing success absent
     def test_wait_for_processing_success_absent(self):
         with mock.patch(
@@ -960,6 +1199,98 @@ class TestNifcloud(unittest.TestCase):
 
         self.assertEqual(str(cm.exception), 'failed')
 
+    # wait_for_processing polls immediately after short operations
+    def test_wait_for_processing_immediate(self):
+        with mock.patch(
+                'nifcloud_fw.describe_security_group',
+                self.mockDescribeSecurityGroup
+        ):
+            nifcloud_fw.wait_for_processing(
+                self.mockModule,
+                self.result['absent'],
+                'present'
+            )
+
+        self.assertEqual(self.mock_time_sleep.call_count, 0)
+        self.assertEqual(self.mockDescribeSecurityGroup.call_count, 1)
+
+    # wait_for_processing waits first after bulk operations
+    def test_wait_for_processing_bulk(self):
+        with mock.patch(
+                'nifcloud_fw.describe_security_group',
+                self.mockDescribeSecurityGroup
+        ):
+            nifcloud_fw.wait_for_processing(
+                self.mockModule,
+                self.result['absent'],
+                'present',
+                100
+            )
+
+        self.assertEqual(self.mock_time_sleep.call_args_list,
+                         [mock.call(nifcloud_fw.WAIT_INTERVAL)])
+
+    # wait_for_processing backs off exponentially until the deadline
+    def test_wait_for_processing_backoff(self):
+        mock_module = mock.MagicMock(
+            params=dict(
+                copy.deepcopy(self.mockModule.params),
+                wait_timeout=30,
+                wait_interval=1,
+                wait_max_interval=8,
+            ),
+            fail_json=mock.MagicMock(side_effect=Exception('failed')),
+        )
+        mock_describe_security_group = mock.MagicMock(
+            side_effect=[(self.result['absent'], None)] * 6 + [(
+                self.result['present'],
+                self.security_group_info,
+            )])
+
+        with mock.patch(
+                'nifcloud_fw.describe_security_group',
+                mock_describe_security_group
+        ):
+            (result, info) = nifcloud_fw.wait_for_processing(
+                mock_module,
+                self.result['absent'],
+                'present'
+            )
+
+        self.assertEqual(result, self.result['present'])
+        self.assertEqual(
+            self.mock_time_sleep.call_args_list,
+            [mock.call(x) for x in [1, 2, 4, 8, 8, 7]]
+        )
+        self.assertEqual(mock_describe_security_group.call_count, 7)
+
+    # wait_for_processing deadline exceeded
+    def test_wait_for_processing_timeout(self):
+        mock_module = mock.MagicMock(
+            params=dict(
+                copy.deepcopy(self.mockModule.params),
+                wait_timeout=10,
+            ),
+            fail_json=mock.MagicMock(side_effect=Exception('failed')),
+        )
+
+        with mock.patch(
+                'nifcloud_fw.describe_security_group',
+                self.mockNotFoundSecurityGroup
+        ):
+            with self.assertRaises(Exception) as cm:
+                nifcloud_fw.wait_for_processing(
+                    mock_module,
+                    self.result['absent'],
+                    'present'
+                )
+
+        self.assertEqual(str(cm.exception), 'failed')
+        self.assertEqual(
+            self.mock_time_sleep.call_args_list,
+            [mock.call(x) for x in [1, 2, 4, 3]]
+        )
+
     # create present  * do nothing
     def test_create_security_group_skip(self):
         (result, info) = nifcloud_fw.create_security_group(
@@ -1712,79 +2043,1155 @@ class TestNifcloud(unittest.TestCase):
                 )
         self.assertEqual(str(cm.exception), 'failed')
 
-    # run success (absent - create -> present - other action -> present)
-    def test_run_success_absent(self):
-        with mock.patch(
-                'nifcloud_fw.describe_security_group',
-                self.mockNotFoundSecurityGroup
-        ):
-            with mock.patch(
-                    'nifcloud_fw.create_security_group',
-                    self.mockDescribeSecurityGroup
-            ):
-                with mock.patch(
-                        'nifcloud_fw.update_security_group',
-                        self.mockDescribeSecurityGroup):
-                    with mock.patch(
-                            'nifcloud_fw.authorize_security_group',
-                            self.mockDescribeSecurityGroup
-                    ):
-                        with mock.patch(
-                                'nifcloud_fw.revoke_security_group',
-                                self.mockDescribeSecurityGroup
-                        ):
-                            with self.assertRaises(Exception) as cm:
-                                nifcloud_fw.run(self.mockModule)
-        self.assertEqual(str(cm.exception), 'success')
+    # estimate_ip_permissions_plan
+    def test_estimate_ip_permissions_plan(self):
+        plans = dict(
+            (strategy, nifcloud_fw.estimate_ip_permissions_plan(
+                strategy, 90, 20, 15, True, 10, 100))
+            for strategy in ['incremental', 'replace', 'chunked']
+        )
+
+        self.assertEqual(plans['incremental'], dict(
+            strategy='incremental',
+            estimated_requests=2,
+            estimated_waits=2,
+            estimated_seconds=22,
+            peak_rules=110,
+            safe=False,
+        ))
+        self.assertEqual(plans['replace']['peak_rules'], 95)
+        self.assertFalse(plans['replace']['safe'])
+        self.assertEqual(plans['chunked'], dict(
+            strategy='chunked',
+            estimated_requests=4,
+            estimated_waits=4,
+            estimated_seconds=44,
+            peak_rules=100,
+            safe=True,
+        ))
 
-    # run success (present - create skip -> present - other action -> present)
-    def test_run_success_present(self):
-        with mock.patch(
-                'nifcloud_fw.describe_security_group',
-                self.mockDescribeSecurityGroup
-        ):
-            with mock.patch(
-                    'nifcloud_fw.update_security_group',
-                    self.mockDescribeSecurityGroup
-            ):
-                with mock.patch(
-                        'nifcloud_fw.authorize_security_group',
-                        self.mockDescribeSecurityGroup
-                ):
-                    with mock.patch(
-                            'nifcloud_fw.revoke_security_group',
-                            self.mockDescribeSecurityGroup
-                    ):
-                        with self.assertRaises(Exception) as cm:
-                            nifcloud_fw.run(self.mockModule)
-        self.assertEqual(str(cm.exception), 'success')
+    # estimate_ip_permissions_plan (authorize one by one)
+    def test_estimate_ip_permissions_plan_one_by_one(self):
+        plan = nifcloud_fw.estimate_ip_permissions_plan(
+            'incremental', 10, 5, 3, False, None, None)
 
-    # run failed (absent - create -> absent - skip other action -> absent)
-    def test_run_failed(self):
-        with mock.patch(
-                'nifcloud_fw.describe_security_group',
-                self.mockNotFoundSecurityGroup
-        ):
-            with mock.patch(
-                    'nifcloud_fw.create_security_group',
-                    self.mockNotFoundSecurityGroup
-            ):
-                with self.assertRaises(Exception) as cm:
-                    nifcloud_fw.run(self.mockModule)
-        self.assertEqual(str(cm.exception), 'failed')
+        self.assertEqual(plan['estimated_requests'], 6)
+        self.assertEqual(plan['peak_rules'], 15)
+        self.assertTrue(plan['safe'])
 
+    # plan_ip_permissions default strategy
+    def test_plan_ip_permissions_default(self):
+        plan = nifcloud_fw.plan_ip_permissions(
+            self.mockModule,
+            self.security_group_info
+        )
 
-nifcloud_api_response_sample = dict(
-    describeSecurityGroups='''
-<DescribeSecurityGroupsResponse xmlns="https://cp.cloud.nifty.com/api/">
- <RequestID>5ec8da0a-6e23-4343-b474-ca0bb5c22a51</RequestID>
- <securityGroupInfo>
-  <item>
-   <ownerId></ownerId>
-   <groupName>fw001</groupName>
-   <groupDescription>sample fw</groupDescription>
-   <groupStatus>applied</groupStatus>
-   <ipPermissions>
+        self.assertEqual(plan['strategy'], 'incremental')
+        self.assertEqual(plan['number_of_authorize_rules'], 5)
+        self.assertEqual(plan['number_of_revoke_rules'], 2)
+
+    # plan_ip_permissions absent
+    def test_plan_ip_permissions_absent(self):
+        plan = nifcloud_fw.plan_ip_permissions(self.mockModule, None)
+
+        self.assertEqual(plan, dict(
+            strategy='incremental',
+            number_of_authorize_rules=0,
+            number_of_revoke_rules=0,
+        ))
+
+    # plan_ip_permissions auto (nothing is kept)
+    def test_plan_ip_permissions_auto_replace(self):
+        mock_module = mock.MagicMock(
+            params=dict(
+                copy.deepcopy(self.mockModule.params),
+                authorize_in_bulk=True,
+                ip_permissions_strategy='auto',
+            ),
+        )
+        security_group_info = dict(
+            copy.deepcopy(self.security_group_info),
+            rule_limit=6,
+        )
+
+        plan = nifcloud_fw.plan_ip_permissions(
+            mock_module,
+            security_group_info
+        )
+
+        self.assertEqual(plan['strategy'], 'replace')
+        self.assertEqual(plan['peak_rules'], 5)
+        self.assertTrue(plan['safe'])
+
+    # plan_ip_permissions auto (current rules are kept)
+    def test_plan_ip_permissions_auto_chunked(self):
+        mock_module = mock.MagicMock(
+            params=dict(
+                copy.deepcopy(self.mockModule.params),
+                authorize_in_bulk=True,
+                ip_permissions_strategy='auto',
+                ip_permissions_per_request=2,
+            ),
+        )
+        mock_module.params['ip_permissions'].append(
+            self.security_group_info['ip_permissions'][0])
+
+        plan = nifcloud_fw.plan_ip_permissions(
+            mock_module,
+            self.security_group_info
+        )
+
+        self.assertEqual(plan['strategy'], 'chunked')
+        self.assertEqual(plan['estimated_requests'], 4)
+        self.assertEqual(plan['number_of_authorize_rules'], 5)
+        self.assertEqual(plan['number_of_revoke_rules'], 1)
+
+    # plan_ip_permissions replace falls back when rules are kept
+    def test_plan_ip_permissions_replace_fallback(self):
+        mock_module = mock.MagicMock(
+            params=dict(
+                copy.deepcopy(self.mockModule.params),
+                ip_permissions_strategy='replace',
+            ),
+        )
+        mock_module.params['ip_permissions'].append(
+            self.security_group_info['ip_permissions'][0])
+
+        plan = nifcloud_fw.plan_ip_permissions(
+            mock_module,
+            self.security_group_info
+        )
+
+        self.assertEqual(plan['strategy'], 'incremental')
+        self.assertEqual(plan['number_of_revoke_rules'], 1)
+
+    # plan_ip_permissions replace without purge (nothing to revoke)
+    def test_plan_ip_permissions_replace_no_purge(self):
+        mock_module = mock.MagicMock(
+            params=dict(
+                copy.deepcopy(self.mockModule.params),
+                ip_permissions_strategy='replace',
+                purge_ip_permissions=False,
+            ),
+        )
+
+        plan = nifcloud_fw.plan_ip_permissions(
+            mock_module,
+            self.security_group_info
+        )
+
+        self.assertEqual(plan['strategy'], 'replace')
+        self.assertEqual(plan['number_of_revoke_rules'], 0)
+        self.assertEqual(plan['peak_rules'], 7)
+
+    # plan_ip_permissions replace on the group already in sync
+    def test_plan_ip_permissions_replace_in_sync(self):
+        mock_module = mock.MagicMock(
+            params=dict(
+                copy.deepcopy(self.mockModule.params),
+                ip_permissions_strategy='replace',
+            ),
+        )
+        security_group_info = dict(
+            copy.deepcopy(self.security_group_info),
+            ip_permissions=mock_module.params['ip_permissions'],
+        )
+
+        plan = nifcloud_fw.plan_ip_permissions(
+            mock_module,
+            security_group_info
+        )
+
+        self.assertEqual(plan['strategy'], 'replace')
+        self.assertEqual(plan['estimated_requests'], 0)
+        self.assertEqual(plan['number_of_authorize_rules'], 0)
+        self.assertEqual(plan['number_of_revoke_rules'], 0)
+
+    # plan_ip_permissions unknown strategy
+    def test_plan_ip_permissions_invalid(self):
+        mock_module = mock.MagicMock(
+            params=dict(
+                copy.deepcopy(self.mockModule.params),
+                ip_permissions_strategy='unknown',
+            ),
+            fail_json=mock.MagicMock(side_effect=Exception('failed')),
+        )
+
+        with self.assertRaises(Exception) as cm:
+            nifcloud_fw.plan_ip_permissions(
+                mock_module,
+                self.security_group_info
+            )
+        self.assertEqual(str(cm.exception), 'failed')
+
+    # authorize and revoke in chunks success
+    def test_authorize_and_revoke_security_group_in_chunks_success(self):
+        mock_module = mock.MagicMock(
+            params=dict(
+                copy.deepcopy(self.mockModule.params),
+                authorize_in_bulk=True,
+                ip_permissions_per_request=2,
+            ),
+            check_mode=False,
+        )
+        changed_security_group_info = dict(
+            copy.deepcopy(self.security_group_info),
+            ip_permissions=self.mockModule.params['ip_permissions'],
+        )
+        mock_describe_security_group = mock.MagicMock(
+            return_value=(
+                self.result['present'],
+                changed_security_group_info,
+            ))
+        mock_requests_post = mock.MagicMock(
+            return_value=mock.MagicMock(
+                status_code=200,
+                text=self.xml['authorizeSecurityGroup']
+            ))
+
+        with mock.patch('requests.post', mock_requests_post):
+            with mock.patch(
+                    'nifcloud_fw.describe_security_group',
+                    mock_describe_security_group
+            ):
+                (result, info) = \
+                    nifcloud_fw.authorize_and_revoke_security_group_in_chunks(
+                        mock_module,
+                        self.result['present'],
+                        self.security_group_info
+                    )
+
+        self.assertEqual(result, dict(
+            created=False,
+            changed_attributes=dict(
+                number_of_authorize_rules=5,
+                number_of_revoke_rules=2,
+            ),
+            state='present',
+        ))
+        self.assertEqual(info, changed_security_group_info)
+        # authorize 2 + 2 + 1 rules, revoke 2 rules
+        self.assertEqual(mock_requests_post.call_count, 4)
+
+    # authorize and revoke in chunks (check_mode)
+    def test_authorize_and_revoke_security_group_in_chunks_check_mode(self):
+        mock_module = mock.MagicMock(
+            params=copy.deepcopy(self.mockModule.params),
+            check_mode=True,
+        )
+
+        (result, info) = \
+            nifcloud_fw.authorize_and_revoke_security_group_in_chunks(
+                mock_module,
+                self.result['present'],
+                self.security_group_info
+            )
+
+        self.assertEqual(result['changed_attributes'], dict(
+            number_of_authorize_rules=5,
+            number_of_revoke_rules=2,
+        ))
+        self.assertEqual(info, self.security_group_info)
+
+    # authorize and revoke in chunks failed
+    def test_authorize_and_revoke_security_group_in_chunks_failed(self):
+        with mock.patch(
+                'requests.post',
+                self.mockRequestsPostAuthorizeSecurityGroup
+        ):
+            with mock.patch(
+                    'nifcloud_fw.describe_security_group',
+                    self.mockDescribeSecurityGroup
+            ):
+                with self.assertRaises(Exception) as cm:
+                    nifcloud_fw.authorize_and_revoke_security_group_in_chunks(
+                        self.mockModule,
+                        self.result['present'],
+                        self.security_group_info
+                    )
+        self.assertEqual(str(cm.exception), 'failed')
+
+    # estimate_ip_permissions_plan (pipelined)
+    def test_estimate_ip_permissions_plan_pipelined(self):
+        plan = nifcloud_fw.estimate_ip_permissions_plan(
+            'pipelined', 90, 20, 15, True, None, 200)
+
+        self.assertEqual(plan, dict(
+            strategy='pipelined',
+            estimated_requests=2,
+            estimated_waits=1,
+            estimated_seconds=12,
+            peak_rules=110,
+            safe=True,
+        ))
+
+    # authorize and revoke pipelined success
+    def test_authorize_and_revoke_security_group_pipelined_success(self):
+        mock_module = mock.MagicMock(
+            params=dict(
+                copy.deepcopy(self.mockModule.params),
+                authorize_in_bulk=True,
+            ),
+            check_mode=False,
+        )
+        changed_security_group_info = dict(
+            copy.deepcopy(self.security_group_info),
+            ip_permissions=self.mockModule.params['ip_permissions'],
+        )
+        mock_describe_security_group = mock.MagicMock(
+            return_value=(
+                self.result['present'],
+                changed_security_group_info,
+            ))
+        mock_requests_post = mock.MagicMock(
+            side_effect=[
+                self.mockRequestsPostAuthorizeSecurityGroup.return_value,
+                self.mockRequestsPostRevokeSecurityGroup.return_value,
+            ])
+
+        with mock.patch('requests.post', mock_requests_post):
+            with mock.patch(
+                    'nifcloud_fw.describe_security_group',
+                    mock_describe_security_group
+            ):
+                (result, info) = \
+                    nifcloud_fw.authorize_and_revoke_security_group_pipelined(
+                        mock_module,
+                        self.result['present'],
+                        self.security_group_info
+                    )
+
+        self.assertEqual(result, dict(
+            created=False,
+            changed_attributes=dict(
+                number_of_authorize_rules=5,
+                number_of_revoke_rules=2,
+            ),
+            state='present',
+        ))
+        self.assertEqual(info, changed_security_group_info)
+        self.assertEqual(mock_requests_post.call_count, 2)
+        # both requests are verified with one describe
+        self.assertEqual(mock_describe_security_group.call_count, 1)
+
+    # authorize and revoke pipelined (revoke is rejected while processing)
+    def test_authorize_and_revoke_security_group_pipelined_processing(self):
+        mock_module = mock.MagicMock(
+            params=copy.deepcopy(self.mockModule.params),
+            check_mode=False,
+        )
+        changed_security_group_info = dict(
+            copy.deepcopy(self.security_group_info),
+            ip_permissions=self.mockModule.params['ip_permissions'],
+        )
+        processing_result = dict(self.result['present'], state='processing')
+        mock_describe_security_group = mock.MagicMock(
+            side_effect=[
+                # authorized one by one but the last one
+                (self.result['present'], self.security_group_info),
+                (self.result['present'], self.security_group_info),
+                (self.result['present'], self.security_group_info),
+                (self.result['present'], self.security_group_info),
+                # revoke is rejected
+                (processing_result, None),
+                (self.result['present'], self.security_group_info),
+                # final wait
+                (self.result['present'], changed_security_group_info),
+            ])
+        authorized = self.mockRequestsPostAuthorizeSecurityGroup.return_value
+        mock_requests_post = mock.MagicMock(
+            side_effect=(
+                [authorized] * 5 +
+                [self.mockRequestsInternalServerError.return_value,
+                 self.mockRequestsPostRevokeSecurityGroup.return_value]
+            ))
+
+        with mock.patch('requests.post', mock_requests_post):
+            with mock.patch(
+                    'nifcloud_fw.describe_security_group',
+                    mock_describe_security_group
+            ):
+                (result, info) = \
+                    nifcloud_fw.authorize_and_revoke_security_group_pipelined(
+                        mock_module,
+                        self.result['present'],
+                        self.security_group_info
+                    )
+
+        self.assertEqual(info, changed_security_group_info)
+        self.assertEqual(mock_requests_post.call_count, 7)
+        self.assertEqual(mock_describe_security_group.call_count, 7)
+
+    # authorize and revoke pipelined failed
+    def test_authorize_and_revoke_security_group_pipelined_failed(self):
+        mock_module = mock.MagicMock(
+            params=dict(
+                copy.deepcopy(self.mockModule.params),
+                authorize_in_bulk=True,
+            ),
+            fail_json=mock.MagicMock(side_effect=Exception('failed')),
+            check_mode=False,
+        )
+
+        with mock.patch(
+                'requests.post',
+                self.mockRequestsInternalServerError
+        ):
+            with mock.patch(
+                    'nifcloud_fw.describe_security_group',
+                    self.mockDescribeSecurityGroup
+            ):
+                with self.assertRaises(Exception) as cm:
+                    nifcloud_fw.authorize_and_revoke_security_group_pipelined(
+                        mock_module,
+                        self.result['present'],
+                        self.security_group_info
+                    )
+        self.assertEqual(str(cm.exception), 'failed')
+
+    # run success with replace strategy (revoke -> authorize)
+    def test_run_success_replace(self):
+        mock_module = mock.MagicMock(
+            params=dict(
+                copy.deepcopy(self.mockModule.params),
+                ip_permissions_strategy='replace',
+            ),
+            exit_json=mock.MagicMock(side_effect=Exception('success')),
+            check_mode=False,
+        )
+        calls = []
+
+        def mock_step(name):
+            def step(module, result, security_group_info):
+                calls.append(name)
+                return (result, security_group_info)
+            return step
+
+        with mock.patch(
+                'nifcloud_fw.describe_security_group',
+                self.mockDescribeSecurityGroup
+        ):
+            with mock.patch(
+                    'nifcloud_fw.update_security_group',
+                    self.mockDescribeSecurityGroup
+            ):
+                with mock.patch(
+                        'nifcloud_fw.authorize_security_group',
+                        mock_step('authorize')
+                ):
+                    with mock.patch(
+                            'nifcloud_fw.revoke_security_group',
+                            mock_step('revoke')
+                    ):
+                        with self.assertRaises(Exception) as cm:
+                            nifcloud_fw.run(mock_module)
+        self.assertEqual(str(cm.exception), 'success')
+        self.assertEqual(calls, ['revoke', 'authorize'])
+        self.assertEqual(
+            mock_module.exit_json.call_args[1]['ip_permissions_plan']['strategy'],  # noqa
+            'replace'
+        )
+
+    # run success with chunked strategy
+    def test_run_success_chunked(self):
+        mock_module = mock.MagicMock(
+            params=dict(
+                copy.deepcopy(self.mockModule.params),
+                ip_permissions_strategy='chunked',
+            ),
+            exit_json=mock.MagicMock(side_effect=Exception('success')),
+            check_mode=False,
+        )
+
+        with mock.patch(
+                'nifcloud_fw.describe_security_group',
+                self.mockDescribeSecurityGroup
+        ):
+            with mock.patch(
+                    'nifcloud_fw.update_security_group',
+                    self.mockDescribeSecurityGroup
+            ):
+                with mock.patch(
+                        'nifcloud_fw.authorize_and_revoke_security_group_in_chunks',  # noqa
+                        self.mockDescribeSecurityGroup
+                ):
+                    with self.assertRaises(Exception) as cm:
+                        nifcloud_fw.run(mock_module)
+        self.assertEqual(str(cm.exception), 'success')
+        self.assertEqual(
+            mock_module.exit_json.call_args[1]['ip_permissions_plan']['strategy'],  # noqa
+            'chunked'
+        )
+
+    # reconcile coalesced (leader and follower)
+    def test_reconcile_security_group_coalesced(self):
+        coalesce_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, coalesce_dir)
+        mock_module = mock.MagicMock(
+            params=dict(
+                copy.deepcopy(self.mockModule.params),
+                coalesce=True,
+                coalesce_dir=coalesce_dir,
+            ),
+            check_mode=False,
+        )
+        reconciled = dict(
+            self.result['present'],
+            changed=True,
+            changed_attributes=dict(number_of_authorize_rules=5),
+        )
+        mock_reconcile = mock.MagicMock(return_value=reconciled)
+
+        with mock.patch(
+                'nifcloud_fw.reconcile_prepared_security_group',
+                mock_reconcile
+        ):
+            leader_result = \
+                nifcloud_fw.reconcile_security_group_coalesced(mock_module)
+            follower_result = \
+                nifcloud_fw.reconcile_security_group_coalesced(mock_module)
+
+        self.assertEqual(mock_reconcile.call_count, 1)
+        self.assertEqual(leader_result, dict(reconciled, coalesced=False))
+        self.assertEqual(follower_result, dict(reconciled, coalesced=True))
+
+    # reconcile coalesced with other parameters or expired result
+    def test_reconcile_security_group_coalesced_not_shared(self):
+        coalesce_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, coalesce_dir)
+        params = dict(
+            copy.deepcopy(self.mockModule.params),
+            coalesce=True,
+            coalesce_dir=coalesce_dir,
+        )
+        mock_reconcile = mock.MagicMock(
+            return_value=dict(self.result['present'], changed=False))
+
+        with mock.patch(
+                'nifcloud_fw.reconcile_prepared_security_group',
+                mock_reconcile
+        ):
+            nifcloud_fw.reconcile_security_group_coalesced(
+                mock.MagicMock(params=params, check_mode=False))
+            nifcloud_fw.reconcile_security_group_coalesced(
+                mock.MagicMock(params=dict(params, log_limit=1000),
+                               check_mode=False))
+            nifcloud_fw.reconcile_security_group_coalesced(
+                mock.MagicMock(params=params, check_mode=True))
+            nifcloud_fw.reconcile_security_group_coalesced(
+                mock.MagicMock(params=dict(params, coalesce_ttl=-1),
+                               check_mode=False))
+
+        self.assertEqual(mock_reconcile.call_count, 4)
+
+    # reconcile coalesced with the rules file changed at the same path
+    def test_reconcile_security_group_coalesced_file_changed(self):
+        coalesce_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, coalesce_dir)
+        path = os.path.join(coalesce_dir, 'rules.jsonl')
+        params = dict(
+            copy.deepcopy(self.mockModule.params),
+            ip_permissions=[],
+            ip_permissions_file=path,
+            coalesce=True,
+            coalesce_dir=coalesce_dir,
+        )
+        mock_reconcile = mock.MagicMock(
+            return_value=dict(self.result['present'], changed=False))
+
+        with mock.patch(
+                'nifcloud_fw.reconcile_prepared_security_group',
+                mock_reconcile
+        ):
+            for cidr_ip in ['10.0.0.0/8', '10.0.0.0/8', '172.16.0.0/12']:
+                with open(path, 'w') as fp:
+                    fp.write(json.dumps(dict(in_out='IN', ip_protocol='ANY',
+                                             cidr_ip=cidr_ip)) + '\n')
+                nifcloud_fw.reconcile_security_group_coalesced(
+                    mock.MagicMock(params=copy.deepcopy(params),
+                                   check_mode=False))
+
+        # the second run shares the first result, the third does not
+        self.assertEqual(mock_reconcile.call_count, 2)
+        self.assertEqual(
+            mock_reconcile.call_args[0][0].params['ip_permissions'],
+            [dict(in_out='IN', ip_protocol='ANY', cidr_ip='172.16.0.0/12')])
+
+    # reconcile coalesced failed (lock is held by other fork)
+    def test_reconcile_security_group_coalesced_timeout(self):
+        coalesce_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, coalesce_dir)
+        mock_module = mock.MagicMock(
+            params=dict(
+                copy.deepcopy(self.mockModule.params),
+                coalesce=True,
+                coalesce_dir=coalesce_dir,
+                coalesce_timeout=5,
+            ),
+            fail_json=mock.MagicMock(side_effect=Exception('failed')),
+            check_mode=False,
+        )
+        lock_path = os.path.join(
+            coalesce_dir,
+            nifcloud_fw.get_coalesce_key(mock_module) + '.lock'
+        )
+
+        with open(lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            with self.assertRaises(Exception) as cm:
+                nifcloud_fw.reconcile_security_group_coalesced(mock_module)
+        self.assertEqual(str(cm.exception), 'failed')
+        self.assertEqual(self.mock_time_sleep.call_count, 10)
+
+    # fingerprint of the firewall group
+    def test_get_security_group_fingerprint(self):
+        with mock.patch('requests.get',
+                        self.mockRequestsGetDescribeSecurityGroups):
+            (state, fingerprint, rules) = \
+                nifcloud_fw.get_security_group_fingerprint(self.mockModule)
+            self.assertEqual(state, 'present')
+            self.assertEqual(
+                nifcloud_fw.get_security_group_fingerprint(self.mockModule),
+                (state, fingerprint, rules)
+            )
+            (_, security_group_info) = nifcloud_fw.describe_security_group(
+                self.mockModule, dict())
+        self.assertEqual(rules, dict(
+            number_of_rules=len(security_group_info['ip_permissions']),
+            rule_limit=security_group_info['rule_limit'],
+        ))
+        with mock.patch(
+                'requests.get',
+                self.mockRequestsGetDescribeSecurityGroupsDescriptionNone
+        ):
+            (_, other_fingerprint, _) = \
+                nifcloud_fw.get_security_group_fingerprint(self.mockModule)
+        self.assertNotEqual(fingerprint, other_fingerprint)
+
+        with mock.patch('requests.get',
+                        self.mockRequestsGetDescribeSecurityGroupsProcessing):
+            self.assertEqual(
+                nifcloud_fw.get_security_group_fingerprint(self.mockModule),
+                ('processing', None, None)
+            )
+        with mock.patch('requests.get',
+                        self.mockRequestsGetDescribeSecurityGroupsNotFound):
+            self.assertEqual(
+                nifcloud_fw.get_security_group_fingerprint(self.mockModule),
+                ('absent', None, None)
+            )
+
+    # reconcile with fingerprint cache
+    def test_reconcile_security_group_cached(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        mock_module = mock.MagicMock(
+            params=dict(
+                copy.deepcopy(self.mockModule.params),
+                fingerprint_cache=True,
+                fingerprint_cache_dir=cache_dir,
+                fingerprint_cache_max_age=300,
+            ),
+            check_mode=False,
+        )
+        mock_ensure = mock.MagicMock(
+            return_value=(self.result['present'], self.security_group_info))
+        mock_apply = mock.MagicMock(
+            return_value=dict(self.result['present'], changed=False))
+        rules = dict(number_of_rules=7, rule_limit=100)
+        mock_fingerprint = mock.MagicMock(
+            return_value=('present', 'fingerprint', rules))
+
+        with mock.patch('nifcloud_fw.ensure_security_group', mock_ensure):
+            with mock.patch('nifcloud_fw.apply_ip_permissions', mock_apply):
+                with mock.patch('nifcloud_fw.get_security_group_fingerprint',
+                                mock_fingerprint):
+                    first = nifcloud_fw.reconcile_security_group(mock_module)
+                    second = nifcloud_fw.reconcile_security_group(mock_module)
+
+                    # the firewall group is changed by others
+                    mock_fingerprint.return_value = ('present', 'changed',
+                                                     rules)
+                    third = nifcloud_fw.reconcile_security_group(mock_module)
+
+                    # the desired spec is changed
+                    mock_module.params['log_limit'] = 1000
+                    fourth = nifcloud_fw.reconcile_security_group(mock_module)
+
+        self.assertEqual(first['fingerprint_cache'], 'miss')
+        self.assertEqual(second['fingerprint_cache'], 'hit')
+        self.assertEqual(second['changed'], False)
+        self.assertEqual(second['state'], 'present')
+        self.assertEqual(second['created'], False)
+        self.assertEqual(second['changed_attributes'], dict())
+        self.assertEqual(second['ip_permissions_plan'], dict(
+            strategy='incremental',
+            estimated_requests=0,
+            estimated_waits=0,
+            estimated_seconds=0,
+            peak_rules=7,
+            safe=True,
+            number_of_authorize_rules=0,
+            number_of_revoke_rules=0,
+        ))
+        self.assertEqual(third['fingerprint_cache'], 'miss')
+        self.assertEqual(fourth['fingerprint_cache'], 'miss')
+        self.assertEqual(mock_apply.call_count, 3)
+
+    # reconcile with expired fingerprint cache
+    def test_reconcile_security_group_cached_expired(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        mock_module = mock.MagicMock(
+            params=dict(
+                copy.deepcopy(self.mockModule.params),
+                fingerprint_cache=True,
+                fingerprint_cache_dir=cache_dir,
+                fingerprint_cache_max_age=0,
+            ),
+            check_mode=False,
+        )
+        mock_apply = mock.MagicMock(
+            return_value=dict(self.result['present'], changed=False))
+
+        with mock.patch(
+                'nifcloud_fw.ensure_security_group',
+                mock.MagicMock(return_value=(self.result['present'],
+                                             self.security_group_info))
+        ):
+            with mock.patch('nifcloud_fw.apply_ip_permissions', mock_apply):
+                with mock.patch(
+                        'nifcloud_fw.get_security_group_fingerprint',
+                        mock.MagicMock(return_value=('present', 'fp', None))
+                ):
+                    with mock.patch('time.time',
+                                    mock.MagicMock(return_value=100)):
+                        nifcloud_fw.reconcile_security_group(mock_module)
+                    with mock.patch('time.time',
+                                    mock.MagicMock(return_value=101)):
+                        result = nifcloud_fw.reconcile_security_group(
+                            mock_module)
+
+        self.assertEqual(result['fingerprint_cache'], 'miss')
+        self.assertEqual(mock_apply.call_count, 2)
+
+    # run success with coalesce
+    def test_run_success_coalesce(self):
+        mock_module = mock.MagicMock(
+            params=dict(
+                copy.deepcopy(self.mockModule.params),
+                coalesce=True,
+            ),
+            exit_json=mock.MagicMock(side_effect=Exception('success')),
+            check_mode=False,
+        )
+        mock_reconcile = mock.MagicMock(
+            return_value=dict(self.result['present'], changed=False,
+                              coalesced=True))
+
+        with mock.patch('nifcloud_fw.reconcile_security_group_coalesced',
+                        mock_reconcile):
+            with self.assertRaises(Exception) as cm:
+                nifcloud_fw.run(mock_module)
+        self.assertEqual(str(cm.exception), 'success')
+        self.assertTrue(mock_module.exit_json.call_args[1]['coalesced'])
+
+    # run success (absent - create -> present - other action -> present)
+    def test_run_success_absent(self):
+        with mock.patch(
+                'nifcloud_fw.describe_security_group',
+                self.mockNotFoundSecurityGroup
+        ):
+            with mock.patch(
+                    'nifcloud_fw.create_security_group',
+                    self.mockDescribeSecurityGroup
+            ):
+                with mock.patch(
+                        'nifcloud_fw.update_security_group',
+                        self.mockDescribeSecurityGroup):
+                    with mock.patch(
+                            'nifcloud_fw.authorize_security_group',
+                            self.mockDescribeSecurityGroup
+                    ):
+                        with mock.patch(
+                                'nifcloud_fw.revoke_security_group',
+                                self.mockDescribeSecurityGroup
+                        ):
+                            with self.assertRaises(Exception) as cm:
+                                nifcloud_fw.run(self.mockModule)
+        self.assertEqual(str(cm.exception), 'success')
+
+    # run success (present - create skip -> present - other action -> present)
+    def test_run_success_present(self):
+        with mock.patch(
+                'nifcloud_fw.describe_security_group',
+                self.mockDescribeSecurityGroup
+        ):
+            with mock.patch(
+                    'nifcloud_fw.update_security_group',
+                    self.mockDescribeSecurityGroup
+            ):
+                with mock.patch(
+                        'nifcloud_fw.authorize_security_group',
+                        self.mockDescribeSecurityGroup
+                ):
+                    with mock.patch(
+                            'nifcloud_fw.revoke_security_group',
+                            self.mockDescribeSecurityGroup
+                    ):
+                        with self.assertRaises(Exception) as cm:
+                            nifcloud_fw.run(self.mockModule)
+        self.assertEqual(str(cm.exception), 'success')
+
+    # run success with compact_ip_permissions
+    def test_run_success_compact_ip_permissions(self):
+        mock_module = mock.MagicMock(
+            params=dict(
+                copy.deepcopy(self.mockModule.params),
+                compact_ip_permissions=True,
+            ),
+            exit_json=mock.MagicMock(side_effect=Exception('success')),
+            check_mode=False,
+        )
+        mock_module.params['ip_permissions'].append(dict(
+            in_out='IN',
+            ip_protocol='TCP',
+            from_port=30000,
+            group_name='admin',
+        ))
+
+        with mock.patch(
+                'nifcloud_fw.describe_security_group',
+                self.mockDescribeSecurityGroup
+        ):
+            with mock.patch(
+                    'nifcloud_fw.update_security_group',
+                    self.mockDescribeSecurityGroup
+            ):
+                with mock.patch(
+                        'nifcloud_fw.authorize_security_group',
+                        self.mockDescribeSecurityGroup
+                ):
+                    with mock.patch(
+                            'nifcloud_fw.revoke_security_group',
+                            self.mockDescribeSecurityGroup
+                    ):
+                        with self.assertRaises(Exception) as cm:
+                            nifcloud_fw.run(mock_module)
+        self.assertEqual(str(cm.exception), 'success')
+        self.assertEqual(len(mock_module.params['ip_permissions']), 5)
+        self.assertEqual(
+            mock_module.exit_json.call_args[1]['ip_permissions_compaction'],
+            dict(number_of_rules_before=6, number_of_rules_after=5)
+        )
+
+    # run success with ip_permissions_file
+    def test_run_success_ip_permissions_file(self):
+        mock_module = mock.MagicMock(
+            params=dict(
+                copy.deepcopy(self.mockModule.params),
+                ip_permissions_file='{0}/files/ip_permissions.jsonl'.format(
+                    os.path.dirname(__file__)),
+            ),
+            exit_json=mock.MagicMock(side_effect=Exception('success')),
+            check_mode=False,
+        )
+
+        with mock.patch(
+                'nifcloud_fw.describe_security_group',
+                self.mockDescribeSecurityGroup
+        ):
+            with mock.patch(
+                    'nifcloud_fw.update_security_group',
+                    self.mockDescribeSecurityGroup
+            ):
+                with mock.patch(
+                        'nifcloud_fw.authorize_security_group',
+                        self.mockDescribeSecurityGroup
+                ):
+                    with mock.patch(
+                            'nifcloud_fw.revoke_security_group',
+                            self.mockDescribeSecurityGroup
+                    ):
+                        with self.assertRaises(Exception) as cm:
+                            nifcloud_fw.run(mock_module)
+        self.assertEqual(str(cm.exception), 'success')
+        self.assertEqual(len(mock_module.params['ip_permissions']), 8)
+        self.assertEqual(
+            mock_module.params['ip_permissions'][:5],
+            self.mockModule.params['ip_permissions']
+        )
+
+    # run failed with invalid ip_permissions_file
+    def test_run_failed_ip_permissions_file_invalid(self):
+        for name in ['ip_permissions_invalid.csv', 'not_found.csv',
+                     'startup_script']:
+            mock_module = mock.MagicMock(
+                params=dict(
+                    copy.deepcopy(self.mockModule.params),
+                    ip_permissions_file='{0}/files/{1}'.format(
+                        os.path.dirname(__file__), name),
+                ),
+                fail_json=mock.MagicMock(side_effect=Exception('failed')),
+                check_mode=False,
+            )
+
+            with self.assertRaises(Exception) as cm:
+                nifcloud_fw.run(mock_module)
+            self.assertEqual(str(cm.exception), 'failed')
+
+    # run failed (absent - create -> absent - skip other action -> absent)
+    def test_run_failed(self):
+        with mock.patch(
+                'nifcloud_fw.describe_security_group',
+                self.mockNotFoundSecurityGroup
+        ):
+            with mock.patch(
+                    'nifcloud_fw.create_security_group',
+                    self.mockNotFoundSecurityGroup
+            ):
+                with self.assertRaises(Exception) as cm:
+                    nifcloud_fw.run(self.mockModule)
+        self.assertEqual(str(cm.exception), 'failed')
+
+    # security group references
+    def test_get_security_group_references(self):
+        specs = [
+            dict(group_name='db', ip_permissions=[
+                dict(in_out='IN', ip_protocol='TCP', group_name='web'),
+                dict(in_out='IN', ip_protocol='TCP', group_name='admin'),
+            ]),
+            dict(group_name='web', ip_permissions=[
+                dict(in_out='IN', ip_protocol='HTTPS', cidr_ip='0.0.0.0/0'),
+                dict(in_out='IN', ip_protocol='ANY', group_name='web'),
+            ]),
+            dict(group_name='a', ip_permissions=[
+                dict(in_out='IN', ip_protocol='ANY', group_name='b'),
+            ]),
+            dict(group_name='b', ip_permissions=[
+                dict(in_out='IN', ip_protocol='ANY', group_name='a'),
+            ]),
+        ]
+        references = nifcloud_fw.get_security_group_references(specs)
+        self.assertEqual(references, dict(db=['web'], web=[], a=['b'],
+                                          b=['a']))
+
+    # parameters of each security group
+    def test_security_group_module(self):
+        group_module = nifcloud_fw.SecurityGroupModule(
+            mock.MagicMock(
+                params=dict(self.mockModule.params, security_groups=[]),
+                check_mode=True,
+            ),
+            dict(group_name='web'),
+        )
+        self.assertEqual(group_module.params['group_name'], 'web')
+        self.assertEqual(group_module.params['ip_permissions'], [])
+        self.assertIsNone(group_module.params['description'])
+        self.assertEqual(group_module.params['endpoint'],
+                         'west-1.cp.cloud.nifty.com')
+        self.assertNotIn('security_groups', group_module.params)
+        self.assertTrue(group_module.check_mode)
+        with self.assertRaises(nifcloud_fw.SecurityGroupError) as cm:
+            group_module.fail_json(msg='failed', group_name='web')
+        self.assertEqual(cm.exception.kwargs,
+                         dict(msg='failed', group_name='web'))
+
+    # run success with security_groups
+    def test_run_success_security_groups(self):
+        mock_module = mock.MagicMock(
+            params=dict(
+                copy.deepcopy(self.mockModule.params),
+                group_name=None,
+                security_groups=[
+                    dict(group_name='db', ip_permissions=[
+                        dict(in_out='IN', ip_protocol='TCP',
+                             group_name='web'),
+                    ]),
+                    dict(group_name='web'),
+                ],
+                max_workers=2,
+            ),
+            exit_json=mock.MagicMock(side_effect=Exception('success')),
+            check_mode=False,
+        )
+        events = []
+        db_ensured = threading.Event()
+
+        def mock_ensure(module, result):
+            group_name = module.params['group_name']
+            if group_name == 'web':
+                # creation of the referenced group finishes later
+                db_ensured.wait(10)
+            events.append(('ensure', group_name))
+            if group_name == 'db':
+                db_ensured.set()
+            return (dict(result, state='present',
+                         created=(group_name == 'web')), dict())
+
+        def mock_apply(module, result, security_group_info, compaction):
+            events.append(('apply', module.params['group_name']))
+            return dict(result, changed=result['created'])
+
+        with mock.patch('nifcloud_fw.ensure_security_group', mock_ensure):
+            with mock.patch('nifcloud_fw.apply_ip_permissions', mock_apply):
+                with self.assertRaises(Exception) as cm:
+                    nifcloud_fw.run(mock_module)
+        self.assertEqual(str(cm.exception), 'success')
+        self.assertLess(events.index(('ensure', 'web')),
+                        events.index(('apply', 'db')))
+        kwargs = mock_module.exit_json.call_args[1]
+        self.assertTrue(kwargs['changed'])
+        self.assertEqual(
+            [r['group_name'] for r in kwargs['security_groups']],
+            ['db', 'web']
+        )
+        self.assertEqual(
+            [r['changed'] for r in kwargs['security_groups']],
+            [False, True]
+        )
+
+    # run success with security_groups referenced by ip_permissions_file
+    def test_run_success_security_groups_file(self):
+        mock_module = mock.MagicMock(
+            params=dict(
+                copy.deepcopy(self.mockModule.params),
+                group_name=None,
+                security_groups=[
+                    dict(group_name='web',
+                         ip_permissions_file=(
+                             '{0}/files/ip_permissions.jsonl'.format(
+                                 os.path.dirname(__file__)))),
+                    dict(group_name='admin'),
+                ],
+                max_workers=2,
+            ),
+            exit_json=mock.MagicMock(side_effect=Exception('success')),
+            check_mode=False,
+        )
+        events = []
+        web_ensured = threading.Event()
+
+        def mock_ensure(module, result):
+            group_name = module.params['group_name']
+            if group_name == 'admin':
+                # creation of the referenced group finishes later
+                web_ensured.wait(10)
+            events.append(('ensure', group_name))
+            if group_name == 'web':
+                web_ensured.set()
+            return (dict(result, state='present'), dict())
+
+        def mock_apply(module, result, security_group_info, compaction):
+            events.append(('apply', module.params['group_name']))
+            return dict(result, changed=False)
+
+        with mock.patch('nifcloud_fw.ensure_security_group', mock_ensure):
+            with mock.patch('nifcloud_fw.apply_ip_permissions', mock_apply):
+                with self.assertRaises(Exception) as cm:
+                    nifcloud_fw.run(mock_module)
+        self.assertEqual(str(cm.exception), 'success')
+        self.assertLess(events.index(('ensure', 'admin')),
+                        events.index(('apply', 'web')))
+
+    # run failed with security_groups and coalesce
+    def test_run_failed_security_groups_coalesce(self):
+        for option in ['coalesce', 'fingerprint_cache']:
+            mock_module = mock.MagicMock(
+                params=dict(
+                    copy.deepcopy(self.mockModule.params),
+                    group_name=None,
+                    security_groups=[dict(group_name='web')],
+                    **{option: True}
+                ),
+                fail_json=mock.MagicMock(side_effect=Exception('failed')),
+                check_mode=False,
+            )
+
+            with mock.patch('nifcloud_fw.ensure_security_group') as ensure:
+                with self.assertRaises(Exception) as cm:
+                    nifcloud_fw.run(mock_module)
+            self.assertEqual(str(cm.exception), 'failed')
+            self.assertEqual(ensure.call_count, 0)
+
+    # run failed with security_groups
+    def test_run_failed_security_groups(self):
+        mock_module = mock.MagicMock(
+            params=dict(
+                copy.deepcopy(self.mockModule.params),
+                group_name=None,
+                security_groups=[dict(group_name='db'),
+                                 dict(group_name='web')],
+                max_workers=2,
+            ),
+            fail_json=mock.MagicMock(side_effect=Exception('failed')),
+            check_mode=False,
+        )
+
+        def mock_ensure(module, result):
+            if module.params['group_name'] == 'web':
+                module.fail_json(msg='changes failed', group_name='web')
+            return (dict(result, state='present'), dict())
+
+        with mock.patch('nifcloud_fw.ensure_security_group', mock_ensure):
+            with mock.patch('nifcloud_fw.apply_ip_permissions',
+                            mock.MagicMock(return_value=dict(changed=False))):
+                with self.assertRaises(Exception) as cm:
+                    nifcloud_fw.run(mock_module)
+        self.assertEqual(str(cm.exception), 'failed')
+        self.assertEqual(mock_module.fail_json.call_count, 1)
+        self.assertEqual(mock_module.fail_json.call_args[1]['group_name'],
+                         'web')
+
+
+def build_describe_security_groups_response(rule_size):
+    ip_permission = '''
+    <item>
+     <ipProtocol>TCP</ipProtocol>
+     <fromPort>{0}</fromPort>
+     <toPort>{0}</toPort>
+     <inOut>IN</inOut>
+     <ipRanges>
+      <item>
+       <cidrIp>10.0.0.0/24</cidrIp>
+      </item>
+     </ipRanges>
+     <description>TCP ({0})</description>
+     <addDatetime>2001-02-03T04:05:06.007Z</addDatetime>
+    </item>'''
+    ip_permissions = ''.join(
+        [ip_permission.format(port) for port in range(rule_size)]
+    )
+    return '''
+<DescribeSecurityGroupsResponse xmlns="https://cp.cloud.nifty.com/api/">
+ <RequestID>5ec8da0a-6e23-4343-b474-ca0bb5c22a51</RequestID>
+ <securityGroupInfo>
+  <item>
+   <ownerId></ownerId>
+   <groupName>fw001</groupName>
+   <groupDescription>sample fw</groupDescription>
+   <groupStatus>applied</groupStatus>
+   <ipPermissions>{0}
+   </ipPermissions>
+   <groupRuleLimit>{1}</groupRuleLimit>
+   <groupLogLimit>100000</groupLogLimit>
+  </item>
+ </securityGroupInfo>
+</DescribeSecurityGroupsResponse>
+'''.format(ip_permissions, rule_size)
+
+
+nifcloud_api_response_sample = dict(
+    describeSecurityGroups='''
+<DescribeSecurityGroupsResponse xmlns="https://cp.cloud.nifty.com/api/">
+ <RequestID>5ec8da0a-6e23-4343-b474-ca0bb5c22a51</RequestID>
+ <securityGroupInfo>
+  <item>
+   <ownerId></ownerId>
+   <groupName>fw001</groupName>
+   <groupDescription>sample fw</groupDescription>
+   <groupStatus>applied</groupStatus>
+   <ipPermissions>
     <item>
      <ipProtocol>TCP</ipProtocol>
      <fromPort>10000</fromPort>
@@ -1834,6 +3241,46 @@ nifcloud_api_response_sample = dict(
   </item>
  </securityGroupInfo>
 </DescribeSecurityGroupsResponse>
+''',
+    describeSecurityGroupsMultipleSources='''
+<DescribeSecurityGroupsResponse xmlns="https://cp.cloud.nifty.com/api/">
+ <RequestID>5ec8da0a-6e23-4343-b474-ca0bb5c22a51</RequestID>
+ <securityGroupInfo>
+  <item>
+   <ownerId></ownerId>
+   <groupName>fw001</groupName>
+   <groupDescription>sample fw</groupDescription>
+   <groupStatus>applied</groupStatus>
+   <ipPermissions>
+    <item>
+     <ipProtocol>TCP</ipProtocol>
+     <fromPort>443</fromPort>
+     <inOut>IN</inOut>
+     <ipRanges>
+      <item>
+       <cidrIp>10.0.0.0/24</cidrIp>
+      </item>
+      <item>
+       <cidrIp>10.0.1.0/24</cidrIp>
+      </item>
+     </ipRanges>
+     <groups>
+      <item>
+       <groupName>fw002</groupName>
+      </item>
+      <item>
+       <groupName>fw003</groupName>
+      </item>
+     </groups>
+     <description>HTTPS</description>
+     <addDatetime>2001-02-03T04:05:06.007Z</addDatetime>
+    </item>
+   </ipPermissions>
+   <groupRuleLimit>100</groupRuleLimit>
+   <groupLogLimit>1000</groupLogLimit>
+  </item>
+ </securityGroupInfo>
+</DescribeSecurityGroupsResponse>
 ''',
     describeSecurityGroupsDescriptionUnicode=u'''
 <DescribeSecurityGroupsResponse xmlns="https://cp.cloud.nifty.com/api/">
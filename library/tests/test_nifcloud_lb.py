@@ -13,13 +13,19 @@
 # limitations under the License.
 
 import copy
+import fcntl
+import json
+import os
+import shutil
 import sys
+import tempfile
 import time
 import unittest
 import xml.etree.ElementTree as etree
 
 import mock
 import nifcloud_lb
+from ansible.module_utils.six.moves.urllib.parse import parse_qsl
 
 sys.path.append('.')
 sys.path.append('..')
@@ -31,6 +37,7 @@ class TestNifcloud(unittest.TestCase):
     TARGET_DESCRIBE_CURRENT = 'nifcloud_lb.LoadBalancerManager._describe_current_load_balancers'  # noqa
     TARGET_REGISTER_INSTANCES = 'nifcloud_lb.LoadBalancerManager._register_instances'  # noqa
     TARGET_DEREGISTER_INSTANCES = 'nifcloud_lb.LoadBalancerManager._deregister_instances'  # noqa
+    TARGET_DESCRIBE_LB = 'nifcloud_lb.LoadBalancerManager._describe_load_balancers'  # noqa
 
     def setUp(self):
         self.mockModule = mock.MagicMock(
@@ -450,6 +457,64 @@ class TestNifcloud(unittest.TestCase):
                     manager._register_port,
                 )
 
+    # _wait_for_loadbalancer_status ready at the first poll
+    def test_wait_for_loadbalancer_status_immediate(self):
+        with mock.patch(self.TARGET_DESCRIBE_CURRENT,
+                        self.mockDescribeLoadBalancers):
+            manager = nifcloud_lb.LoadBalancerManager(self.mockModule)
+            self.assertEqual(
+                True, manager._wait_for_loadbalancer_status('present'))
+
+        self.assertEqual(self.mock_time_sleep.call_count, 0)
+        self.assertEqual(self.mockDescribeLoadBalancers.call_count, 1)
+
+    # _wait_for_loadbalancer_status backs off until ready
+    def test_wait_for_loadbalancer_status_backoff(self):
+        mockDescribe = mock.MagicMock(side_effect=[
+            dict(status=500,
+                 xml_body=etree.fromstring(
+                     self.xml['describeLoadBalancersPortNotFound'])),
+        ] * 3 + [self.mockDescribeLoadBalancers()])
+
+        with mock.patch(self.TARGET_DESCRIBE_CURRENT, mockDescribe):
+            manager = nifcloud_lb.LoadBalancerManager(self.mockModule)
+            with mock.patch('requests.post',
+                            self.mockRequestsPostRegisterPortWithLoadBalancer):
+                manager._register_port()
+
+        self.assertEqual(True, manager.changed)
+        self.assertEqual(
+            [args[0][0] for args in self.mock_time_sleep.call_args_list],
+            [2, 4, 8])
+        self.assertEqual(
+            manager.result['register_port']['seconds_to_ready'], 14)
+
+    # _wait_for_loadbalancer_status gives up at the deadline
+    def test_wait_for_loadbalancer_status_timeout(self):
+        mockModule = mock.MagicMock(
+            params=copy.deepcopy(self.mockModule.params),
+            fail_json=self.mockModule.fail_json,
+            check_mode=False,
+        )
+        mockModule.params['wait_timeout'] = 100
+        mockModule.params['wait_interval'] = 10
+        mockModule.params['wait_max_interval'] = 30
+        mockDescribe = mock.MagicMock(return_value=dict(
+            status=500,
+            xml_body=etree.fromstring(
+                self.xml['describeLoadBalancersPortNotFound'])))
+
+        with mock.patch(self.TARGET_DESCRIBE_CURRENT, mockDescribe):
+            manager = nifcloud_lb.LoadBalancerManager(mockModule)
+            self.assertEqual(
+                False, manager._wait_for_loadbalancer_status('present'))
+
+        self.assertEqual(
+            [args[0][0] for args in self.mock_time_sleep.call_args_list],
+            [10, 20, 30, 30, 10])
+        self.assertEqual(manager.seconds_to_ready, 100)
+        self.assertEqual(manager.current_state, 'port-not-found')
+
     # _sync_filter no change
     def test_sync_filter_no_change(self):
         with mock.patch('requests.post',
@@ -539,6 +604,287 @@ class TestNifcloud(unittest.TestCase):
                     manager._sync_filter,
                 )
 
+    def build_load_balancers_module(self, specs):
+        mockModule = mock.MagicMock(
+            params=copy.deepcopy(self.mockModule.params),
+            fail_json=self.mockModule.fail_json,
+            check_mode=False,
+        )
+        mockModule.params['loadbalancer_name'] = None
+        mockModule.params['loadbalancer_port'] = None
+        mockModule.params['instance_port'] = None
+        mockModule.params['load_balancers'] = specs
+        mockModule.params['load_balancers_max_workers'] = 2
+        return mockModule
+
+    # load_balancers are described once and reconciled with the states
+    def test_ensure_load_balancers_present(self):
+        mockModule = self.build_load_balancers_module([
+            dict(loadbalancer_name='lb000', loadbalancer_port=80,
+                 instance_port=80, instance_ids=[],
+                 filter_ip_addresses=['192.168.0.1', '192.168.0.2']),
+            dict(loadbalancer_name='lb001', loadbalancer_port=80,
+                 instance_port=80,
+                 filter_ip_addresses=['111.111.111.111', '111.111.111.112']),
+            dict(loadbalancer_name='lb001', loadbalancer_port=443,
+                 instance_port=443,
+                 filter_ip_addresses=['111.111.111.111', '111.111.111.112']),
+            dict(loadbalancer_name='lb002', loadbalancer_port=80,
+                 instance_port=80, instance_ids=[], filter_type=2,
+                 filter_ip_addresses=['192.168.0.1', '192.168.0.2']),
+        ])
+        mockCreate = mock.MagicMock()
+        mockRegisterPort = mock.MagicMock()
+
+        with mock.patch('requests.get',
+                        self.mockRequestsGetDescribeLoadBalancers):
+            with mock.patch(self.TARGET_DESCRIBE_CURRENT,
+                            self.mockDescribeLoadBalancers):
+                with mock.patch(
+                        'nifcloud_lb.LoadBalancerManager._create_load_balancer',  # noqa
+                        mockCreate):
+                    with mock.patch(
+                            'nifcloud_lb.LoadBalancerManager._register_port',  # noqa
+                            mockRegisterPort):
+                        with mock.patch(
+                                'requests.post',
+                                self.mockRequestsPostSetFilterForLoadBalancer):  # noqa
+                            result = nifcloud_lb.ensure_load_balancers_present(  # noqa
+                                mockModule)
+
+        # described again only for the registered load balancers
+        mockGet = self.mockRequestsGetDescribeLoadBalancers
+        self.assertEqual(mockGet.call_count, 2)
+        params = dict(parse_qsl(
+            mockGet.call_args_list[0][0][0].split('?')[1]))
+        self.assertEqual(params['LoadBalancerNames.member.1'], 'lb000')
+        self.assertEqual(params['LoadBalancerNames.member.2'], 'lb001')
+        self.assertEqual(params['LoadBalancerNames.member.3'], 'lb002')
+        params = dict(parse_qsl(mockGet.call_args[0][0].split('?')[1]))
+        self.assertEqual(params['LoadBalancerNames.member.1'], 'lb001')
+        self.assertEqual(params['LoadBalancerNames.member.2'], 'lb002')
+
+        self.assertEqual(
+            [(lb['loadbalancer_name'], lb['loadbalancer_port'], lb['status'])
+             for lb in result['load_balancers']],
+            [('lb000', 80, 'present'), ('lb001', 80, 'present'),
+             ('lb001', 443, 'present'), ('lb002', 80, 'present')])
+        self.assertEqual(
+            [lb['changed'] for lb in result['load_balancers']],
+            [False, False, True, True])
+        self.assertEqual(True, result['changed'])
+        self.assertEqual(mockCreate.call_count, 1)
+        self.assertEqual(mockRegisterPort.call_count, 1)
+
+    # listeners of one new load balancer are created with one request
+    def test_ensure_load_balancers_present_create_once(self):
+        mockModule = self.build_load_balancers_module([
+            dict(loadbalancer_name='lb009', loadbalancer_port=80,
+                 instance_port=80, instance_ids=[]),
+            dict(loadbalancer_name='lb009', loadbalancer_port=443,
+                 instance_port=443, instance_ids=[]),
+        ])
+        mockGet = mock.MagicMock(side_effect=[
+            self.mockRequestsGetDescribeLoadBalancersNameNotFound(),
+            self.mockRequestsGetDescribeLoadBalancers(),
+            self.mockRequestsGetDescribeLoadBalancersNameNotFound(),
+            self.mockRequestsGetDescribeLoadBalancers(),
+        ])
+        mockPost = mock.MagicMock(
+            return_value=self.mockRequestsPostCreateLoadBalancer())
+
+        with mock.patch('requests.get', mockGet):
+            with mock.patch(self.TARGET_DESCRIBE_CURRENT,
+                            self.mockDescribeLoadBalancers):
+                with mock.patch('requests.post', mockPost):
+                    result = nifcloud_lb.ensure_load_balancers_present(
+                        mockModule)
+
+        posted = [dict(parse_qsl(call[0][1]))
+                  for call in mockPost.call_args_list]
+        creates = [params for params in posted
+                   if params['Action'] == 'CreateLoadBalancer']
+        self.assertEqual(len(creates), 1)
+        self.assertEqual(creates[0]['Listeners.member.1.LoadBalancerPort'],
+                         '80')
+        self.assertEqual(creates[0]['Listeners.member.2.LoadBalancerPort'],
+                         '443')
+        self.assertEqual(
+            [lb['create_load_balancer']['loadbalancer_name']
+             for lb in result['load_balancers']],
+            ['lb009', 'lb009'])
+        self.assertEqual(True, result['changed'])
+
+    # load_balancers in sync are not described again
+    def test_ensure_load_balancers_present_no_change(self):
+        mockModule = self.build_load_balancers_module([
+            dict(loadbalancer_name='lb000', loadbalancer_port=80,
+                 instance_port=80, instance_ids=[],
+                 filter_ip_addresses=['192.168.0.1', '192.168.0.2']),
+            dict(loadbalancer_name='lb001', loadbalancer_port=80,
+                 instance_port=80,
+                 filter_ip_addresses=['111.111.111.111', '111.111.111.112']),
+        ])
+
+        with mock.patch('requests.get',
+                        self.mockRequestsGetDescribeLoadBalancers):
+            with mock.patch(self.TARGET_DESCRIBE_CURRENT,
+                            self.mockDescribeLoadBalancers):
+                result = nifcloud_lb.ensure_load_balancers_present(mockModule)
+
+        self.assertEqual(False, result['changed'])
+        self.assertEqual(
+            self.mockRequestsGetDescribeLoadBalancers.call_count, 1)
+        self.assertEqual(self.mockDescribeLoadBalancers.call_count, 0)
+
+    # load_balancers are described all when some of them do not exist
+    def test_describe_load_balancers_by_key_not_found(self):
+        mockGet = mock.MagicMock(side_effect=[
+            self.mockRequestsGetDescribeLoadBalancersNameNotFound(),
+            self.mockRequestsGetDescribeLoadBalancers(),
+        ])
+
+        with mock.patch('requests.get', mockGet):
+            snapshots = nifcloud_lb.describe_load_balancers_by_key(
+                self.mockModule, ['lb001', 'lb002'])
+
+        self.assertEqual(mockGet.call_count, 2)
+        params = dict(parse_qsl(mockGet.call_args[0][0].split('?')[1]))
+        self.assertNotIn('LoadBalancerNames.member.1', params)
+        self.assertEqual(list(snapshots.keys()), [('lb001', 80, 80)])
+        self.assertEqual(
+            snapshots[('lb001', 80, 80)].instances.instance_ids, ['test001'])
+
+    # load_balancers report the failed load balancer
+    def test_ensure_load_balancers_present_internal_error(self):
+        mockModule = self.build_load_balancers_module([
+            dict(loadbalancer_name='lb001', loadbalancer_port=80,
+                 instance_port=80, filter_ip_addresses=['192.168.0.3']),
+        ])
+
+        with mock.patch('requests.get',
+                        self.mockRequestsGetDescribeLoadBalancers):
+            with mock.patch('requests.post',
+                            self.mockRequestsInternalServerError):
+                self.assertRaises(
+                    Exception,
+                    nifcloud_lb.ensure_load_balancers_present,
+                    mockModule,
+                )
+
+        kwargs = mockModule.fail_json.call_args[1]
+        self.assertEqual(kwargs['msg'], 'changes failed (set_filter)')
+        self.assertEqual(kwargs['loadbalancer_name'], 'lb001')
+
+    # load_balancers without ports
+    def test_ensure_load_balancers_present_invalid(self):
+        mockModule = self.build_load_balancers_module([
+            dict(loadbalancer_name='lb001', loadbalancer_port=80),
+        ])
+
+        self.assertRaises(
+            Exception,
+            nifcloud_lb.ensure_load_balancers_present,
+            mockModule,
+        )
+
+    # normalize filter ip addresses
+    def test_normalize_ip_address(self):
+        for (ip_address, normalized) in (
+                ('192.168.0.1', '192.168.0.1'),
+                (' 192.168.0.1/32 ', '192.168.0.1'),
+                ('192.168.0.1/24', '192.168.0.0/24'),
+                ('2001:0db8::0001/128', '2001:db8::1'),
+                ('invalid', 'invalid'),
+        ):
+            self.assertEqual(nifcloud_lb.normalize_ip_address(ip_address),
+                             normalized)
+
+    # _sync_filter no change with equivalent notations
+    def test_sync_filter_normalized_no_change(self):
+        mockModule = mock.MagicMock(
+            params=copy.deepcopy(self.mockModule.params),
+            fail_json=self.mockModule.fail_json,
+            check_mode=False,
+        )
+        mockModule.params['filter_ip_addresses'] = [
+            '192.168.0.2/32', '192.168.0.1']
+
+        with mock.patch('requests.post', self.mockRequestsError):
+            with mock.patch(self.TARGET_DESCRIBE_CURRENT,
+                            self.mockDescribeLoadBalancers):
+                manager = nifcloud_lb.LoadBalancerManager(mockModule)
+                manager._sync_filter()
+
+        self.assertEqual(False, manager.changed)
+        self.assertEqual(self.mockRequestsError.call_count, 0)
+
+    # _sync_filter in chunks
+    def test_sync_filter_chunked(self):
+        mockModule = mock.MagicMock(
+            params=copy.deepcopy(self.mockModule.params),
+            fail_json=self.mockModule.fail_json,
+            check_mode=False,
+        )
+        mockModule.params['filter_ip_addresses'] = [
+            '192.168.1.{0}'.format(i) for i in range(5)]
+        mockModule.params['filter_ip_addresses_per_request'] = 3
+
+        with mock.patch('requests.post',
+                        self.mockRequestsPostSetFilterForLoadBalancer):
+            with mock.patch(self.TARGET_DESCRIBE_CURRENT,
+                            self.mockDescribeLoadBalancers):
+                manager = nifcloud_lb.LoadBalancerManager(mockModule)
+                manager._sync_filter()
+
+        self.assertEqual(True, manager.changed)
+        mock_post = self.mockRequestsPostSetFilterForLoadBalancer
+        self.assertEqual(mock_post.call_count, 3)
+
+        sent = []
+        filter_types = []
+        for call in mock_post.call_args_list:
+            params = dict(parse_qsl(call[0][1]))
+            filter_types.append(params.get('FilterType'))
+            for ip_no in range(1, 4):
+                key = 'IPAddresses.member.{0}.'.format(ip_no)
+                if key + 'IPAddress' in params:
+                    sent.append((params[key + 'IPAddress'],
+                                 params[key + 'AddOnFilter']))
+
+        # merged first and purged last, and the filter type is set at last
+        self.assertEqual(
+            [add_on_filter for (ip, add_on_filter) in sent],
+            ['true'] * 5 + ['false'] * 2)
+        self.assertEqual(dict(sent), dict(
+            [('192.168.0.1', 'false'), ('192.168.0.2', 'false')] +
+            [('192.168.1.{0}'.format(i), 'true') for i in range(5)]))
+        self.assertEqual(filter_types, [None, None, '1'])
+
+    # _sync_filter stops at a failed chunk
+    def test_sync_filter_chunked_internal_error(self):
+        mockModule = mock.MagicMock(
+            params=copy.deepcopy(self.mockModule.params),
+            fail_json=self.mockModule.fail_json,
+            check_mode=False,
+        )
+        mockModule.params['filter_ip_addresses'] = [
+            '192.168.1.{0}'.format(i) for i in range(5)]
+        mockModule.params['filter_ip_addresses_per_request'] = 3
+        mock_post = mock.MagicMock(side_effect=[
+            self.mockRequestsPostSetFilterForLoadBalancer(),
+            self.mockRequestsInternalServerError(),
+        ])
+
+        with mock.patch('requests.post', mock_post):
+            with mock.patch(self.TARGET_DESCRIBE_CURRENT,
+                            self.mockDescribeLoadBalancers):
+                manager = nifcloud_lb.LoadBalancerManager(mockModule)
+                self.assertRaises(Exception, manager._sync_filter)
+
+        self.assertEqual(True, manager.changed)
+        self.assertEqual(mock_post.call_count, 2)
+
     # _sync_instances no change
     def test_sync_instances_no_change(self):
         with mock.patch(self.TARGET_DESCRIBE_CURRENT,
@@ -636,6 +982,65 @@ class TestNifcloud(unittest.TestCase):
                 manager._deregister_instances,
             )
 
+    # _register_instances in chunks
+    def test_register_instances_chunked(self):
+        mockModule = mock.MagicMock(
+            params=copy.deepcopy(self.mockModule.params),
+            fail_json=self.mockModule.fail_json,
+            check_mode=False,
+        )
+        mockModule.params['instance_ids_per_request'] = 2
+        mockModule.params['max_workers'] = 3
+        instance_ids = ['test001', 'test002', 'test003', 'test004', 'test005']
+        mock_post = mock.MagicMock(
+            return_value=self.mockRequestsPostRegisterInstancesWithLoadBalancer.return_value)  # noqa
+
+        with mock.patch('requests.post', mock_post):
+            manager = nifcloud_lb.LoadBalancerManager(mockModule)
+            manager._register_instances(instance_ids)
+
+        self.assertEqual(True, manager.changed)
+        self.assertEqual(mock_post.call_count, 3)
+        sent = sorted(
+            value for call in mock_post.call_args_list
+            for (key, value) in parse_qsl(call[0][1])
+            if key.startswith('Instances.member.')
+        )
+        self.assertEqual(sent, instance_ids)
+
+    # _deregister_instances in chunks with a failed chunk
+    def test_deregister_instances_chunked_partial_failure(self):
+        mockModule = mock.MagicMock(
+            params=copy.deepcopy(self.mockModule.params),
+            fail_json=mock.MagicMock(side_effect=Exception('failed')),
+            check_mode=False,
+        )
+        mockModule.params['instance_ids_per_request'] = 2
+        mock_post = mock.MagicMock(side_effect=[
+            self.mockRequestsPostDeregisterInstancesFromLoadBalancer.return_value,  # noqa
+            self.mockRequestsInternalServerError.return_value,
+            self.mockRequestsPostDeregisterInstancesFromLoadBalancer.return_value,  # noqa
+        ])
+
+        with mock.patch('requests.post', mock_post):
+            manager = nifcloud_lb.LoadBalancerManager(mockModule)
+            self.assertRaises(
+                Exception,
+                manager._deregister_instances,
+                ['test001', 'test002', 'test003', 'test004', 'test005'],
+            )
+
+        self.assertEqual(mock_post.call_count, 3)
+        self.assertEqual(True, manager.changed)
+        kwargs = mockModule.fail_json.call_args[1]
+        self.assertEqual(kwargs['msg'],
+                         'changes failed (deregister_instances)')
+        self.assertEqual(kwargs['succeeded_instance_ids'],
+                         ['test001', 'test002', 'test005'])
+        self.assertEqual(kwargs['failed_instance_ids'],
+                         ['test003', 'test004'])
+        self.assertEqual(len(kwargs['errors']), 1)
+
     # _health_check no change
     def test_sync_health_check_no_change(self):
         with mock.patch('requests.post',
@@ -737,6 +1142,524 @@ class TestNifcloud(unittest.TestCase):
                     manager._sync_ssl_policy,
                 )
 
+    # ensure_present describes the load balancer once without changes
+    def test_ensure_present_no_change(self):
+        with mock.patch(self.TARGET_DESCRIBE_CURRENT,
+                        self.mockDescribeLoadBalancers):
+            with mock.patch('requests.post',
+                            self.mockRequestsInternalServerError):
+                manager = nifcloud_lb.LoadBalancerManager(self.mockModule)
+                manager.ensure_present()
+
+        self.assertEqual(False, manager.changed)
+        self.assertEqual('present', manager.current_state)
+        self.assertEqual(self.mockDescribeLoadBalancers.call_count, 1)
+
+    # ensure_present describes the load balancer again after a change
+    def test_ensure_present_refresh_after_change(self):
+        mockModule = mock.MagicMock(
+            params=copy.deepcopy(self.mockModule.params),
+            fail_json=self.mockModule.fail_json,
+            check_mode=False,
+        )
+        mockModule.params['filter_ip_addresses'] = ['192.168.0.3']
+
+        with mock.patch(self.TARGET_DESCRIBE_CURRENT,
+                        self.mockDescribeLoadBalancers):
+            with mock.patch('requests.post',
+                            self.mockRequestsPostSetFilterForLoadBalancer):
+                manager = nifcloud_lb.LoadBalancerManager(mockModule)
+                manager.ensure_present()
+
+        self.assertEqual(True, manager.changed)
+        self.assertEqual(self.mockDescribeLoadBalancers.call_count, 2)
+
+    # snapshot of the target listener
+    def test_snapshot_parse_describe(self):
+        snapshot = nifcloud_lb.LoadBalancerSnapshot()
+        snapshot.parse_describe(self.mockDescribeLoadBalancers())
+
+        self.assertEqual(snapshot.listener.get_key(), (80, 80))
+        self.assertEqual(snapshot.listener.balancing_type, 1)
+        self.assertEqual(snapshot.filter.filter_type, 1)
+        self.assertEqual(sorted(snapshot.filter.ip_addresses),
+                         ['192.168.0.1', '192.168.0.2'])
+        self.assertEqual(snapshot.health_check,
+                         nifcloud_lb.LoadBalancerHealthCheck('TCP:80', 300, 3))
+        self.assertEqual(snapshot.ssl_policy_name, '')
+        self.assertEqual(snapshot.instances.instance_ids, ['test001'])
+
+    # snapshot models are slotted
+    def test_snapshot_slots(self):
+        snapshot = nifcloud_lb.LoadBalancerSnapshot()
+        for model in (snapshot, snapshot.listener, snapshot.filter,
+                      snapshot.health_check, snapshot.instances):
+            self.assertFalse(hasattr(model, '__dict__'))
+
+    # structural diff of the snapshot models
+    def test_snapshot_diff(self):
+        snapshot = nifcloud_lb.LoadBalancerSnapshot()
+        snapshot.parse_describe(self.mockDescribeLoadBalancers())
+
+        self.assertEqual(
+            snapshot.filter.diff(['192.168.0.2/32', '192.168.0.3'], True),
+            (['192.168.0.1'], ['192.168.0.3']))
+        self.assertEqual(
+            snapshot.filter.diff(['192.168.0.3'], False),
+            ([], ['192.168.0.3']))
+        self.assertEqual(
+            snapshot.instances.diff(['test003', 'test002'], True),
+            (['test001'], ['test002', 'test003']))
+        self.assertEqual(
+            snapshot.instances.diff(['test001'], True), ([], []))
+        self.assertIsNone(snapshot.health_check.diff(
+            nifcloud_lb.LoadBalancerHealthCheck('TCP:80', 300, 3)))
+        change = nifcloud_lb.LoadBalancerHealthCheck('ICMP', 300, 3)
+        self.assertIs(snapshot.health_check.diff(change), change)
+
+    # DescribeLoadBalancers of lb001 with the listeners of the ports
+    def build_describe_listeners(self, ports):
+        xml_body = etree.fromstring(self.xml['describeLoadBalancers'])
+        descriptions = xml_body.find(
+            './/{{{0}}}LoadBalancerDescriptions'.format(self.xmlnamespace))
+        template = descriptions.findall(
+            '{{{0}}}member'.format(self.xmlnamespace))[1]
+        descriptions.remove(template)
+        for (loadbalancer_port, instance_port) in ports:
+            member = copy.deepcopy(template)
+            member.find('.//{{{0}}}LoadBalancerPort'.format(
+                self.xmlnamespace)).text = str(loadbalancer_port)
+            member.find('.//{{{0}}}InstancePort'.format(
+                self.xmlnamespace)).text = str(instance_port)
+            descriptions.append(member)
+        return dict(
+            status=200,
+            xml_body=xml_body,
+            xml_namespace=dict(nc=self.xmlnamespace)
+        )
+
+    def build_listeners_module(self):
+        mockModule = mock.MagicMock(
+            params=copy.deepcopy(self.mockModule.params),
+            fail_json=self.mockModule.fail_json,
+            check_mode=False,
+        )
+        mockModule.params['loadbalancer_port'] = None
+        mockModule.params['instance_port'] = None
+        mockModule.params['filter_ip_addresses'] = ['111.111.111.111',
+                                                    '111.111.111.112']
+        mockModule.params['listeners'] = [
+            dict(loadbalancer_port=80, instance_port=80),
+            dict(loadbalancer_port=443, instance_port=443),
+        ]
+        return mockModule
+
+    # listeners without changes
+    def test_ensure_present_listeners_no_change(self):
+        mock_describe = mock.MagicMock(
+            return_value=self.build_describe_listeners([(80, 80),
+                                                        (443, 443)]))
+
+        with mock.patch(self.TARGET_DESCRIBE_LB, mock_describe):
+            with mock.patch('requests.post',
+                            self.mockRequestsInternalServerError):
+                manager = nifcloud_lb.LoadBalancerManager(
+                    self.build_listeners_module())
+                manager.ensure_present()
+
+        self.assertEqual(False, manager.changed)
+        self.assertEqual('present', manager.current_state)
+        self.assertEqual(mock_describe.call_count, 1)
+        self.assertEqual(manager.result, dict(listeners=[
+            dict(loadbalancer_port=80, instance_port=80),
+            dict(loadbalancer_port=443, instance_port=443),
+        ]))
+
+    # listeners with a port not registered and a changed listener
+    def test_ensure_present_listeners_register_port(self):
+        mockModule = self.build_listeners_module()
+        mockModule.params['listeners'][0]['health_check_interval'] = 5
+        mock_describe = mock.MagicMock(side_effect=[
+            self.build_describe_listeners([(80, 80)]),
+            self.build_describe_listeners([(80, 80), (443, 443)]),
+            # refreshed after the health check of port 80 is changed
+            self.build_describe_listeners([(80, 80)]),
+        ])
+        mock_post = mock.MagicMock(side_effect=[
+            self.mockRequestsPostRegisterPortWithLoadBalancer.return_value,
+            self.mockRequestsPostConfigureHealthCheck.return_value,
+        ])
+
+        with mock.patch(self.TARGET_DESCRIBE_LB, mock_describe):
+            with mock.patch(self.TARGET_WAIT_LB_STATUS,
+                            mock.MagicMock(return_value=True)):
+                with mock.patch('requests.post', mock_post):
+                    manager = nifcloud_lb.LoadBalancerManager(mockModule)
+                    manager.ensure_present()
+
+        self.assertEqual(True, manager.changed)
+        self.assertEqual(mock_describe.call_count, 3)
+        self.assertEqual(mock_post.call_count, 2)
+        self.assertIn(
+            'Listeners.member.1.LoadBalancerPort=443',
+            mock_post.call_args_list[0][0][1]
+        )
+        self.assertEqual(
+            manager.result['register_port']['listeners'],
+            [dict(loadbalancer_port=443, instance_port=443)]
+        )
+        self.assertIn('sync_health_check', manager.result['listeners'][0])
+        self.assertNotIn('sync_health_check', manager.result['listeners'][1])
+
+    # listeners with a new port after the existing one
+    def test_ensure_present_listeners_wait_new_port(self):
+        mockModule = self.build_listeners_module()
+        mock_describe = mock.MagicMock(side_effect=[
+            self.build_describe_listeners([(80, 80)]),
+            self.build_describe_listeners([(80, 80), (443, 443)]),
+        ])
+        waited_ports = []
+
+        def describe_current(manager):
+            waited_ports.append(manager.loadbalancer_port)
+            if len(waited_ports) == 1:
+                return dict(
+                    status=500,
+                    xml_body=etree.fromstring(
+                        self.xml['describeLoadBalancersPortNotFound']))
+            return self.build_describe_listeners([(443, 443)])
+
+        with mock.patch(self.TARGET_DESCRIBE_LB, mock_describe):
+            with mock.patch(self.TARGET_DESCRIBE_CURRENT, autospec=True,
+                            side_effect=describe_current):
+                with mock.patch('requests.post', mock.MagicMock(
+                        return_value=self.mockRequestsPostRegisterPortWithLoadBalancer.return_value)):  # noqa
+                    manager = nifcloud_lb.LoadBalancerManager(mockModule)
+                    manager.ensure_present()
+
+        # the new port is waited instead of the first listener
+        self.assertEqual(waited_ports, [443, 443])
+        self.assertEqual(self.mock_time_sleep.call_count, 1)
+        self.assertEqual(mock_describe.call_count, 2)
+        self.assertEqual(True, manager.changed)
+        self.assertEqual(len(manager.result['listeners']), 2)
+
+    # listeners of a load balancer not created (check mode)
+    def test_ensure_present_listeners_absent_check_mode(self):
+        mockModule = self.build_listeners_module()
+        mockModule.check_mode = True
+
+        with mock.patch('requests.get',
+                        self.mockRequestsGetDescribeLoadBalancersNameNotFound):
+            manager = nifcloud_lb.LoadBalancerManager(mockModule)
+            manager.ensure_present()
+
+        self.assertEqual(True, manager.changed)
+        self.assertEqual('absent', manager.current_state)
+        self.assertIn('create_load_balancer', manager.result)
+        self.assertEqual(len(manager.result['listeners']), 2)
+
+    # listeners without ports
+    def test_listeners_invalid(self):
+        mockModule = self.build_listeners_module()
+        mockModule.params['listeners'] = [dict(loadbalancer_port=80)]
+
+        self.assertRaises(
+            Exception,
+            nifcloud_lb.LoadBalancerManager,
+            mockModule,
+        )
+
+    # DescribeLoadBalancers with the health check of the changed params
+    def build_describe_health_check(self, target, interval, threshold):
+        xml_body = etree.fromstring(self.xml['describeLoadBalancers'])
+        health_check = xml_body.find(
+            './/{{{0}}}HealthCheck'.format(self.xmlnamespace))
+        for (tag, value) in (('Target', target), ('Interval', interval),
+                             ('UnhealthyThreshold', threshold)):
+            health_check.find('{{{0}}}{1}'.format(
+                self.xmlnamespace, tag)).text = str(value)
+
+        return dict(
+            status=200,
+            xml_body=xml_body,
+            xml_namespace=dict(nc=self.xmlnamespace)
+        )
+
+    def build_parallel_sync_module(self):
+        mockModule = mock.MagicMock(
+            params=copy.deepcopy(self.mockModule.params),
+            fail_json=self.mockModule.fail_json,
+            check_mode=False,
+        )
+        mockModule.params['parallel_sync'] = True
+        return mockModule
+
+    # parallel_sync sends the changes and verifies them with one describe
+    def test_ensure_present_parallel_sync(self):
+        mockModule = self.build_parallel_sync_module()
+        mockModule.params['health_check_target'] = 'ICMP'
+        mockModule.params['health_check_interval'] = 5
+        mockModule.params['health_check_unhealthy_threshold'] = 10
+
+        mockDescribe = mock.MagicMock(side_effect=[
+            self.mockDescribeLoadBalancers(),
+            self.build_describe_health_check('ICMP', 5, 10),
+        ])
+
+        with mock.patch(self.TARGET_DESCRIBE_CURRENT, mockDescribe):
+            with mock.patch('requests.post',
+                            self.mockRequestsPostConfigureHealthCheck):
+                manager = nifcloud_lb.LoadBalancerManager(mockModule)
+                manager.ensure_present()
+
+        self.assertEqual(True, manager.changed)
+        self.assertIn('sync_health_check', manager.result)
+        self.assertEqual(mockDescribe.call_count, 2)
+        self.assertEqual(
+            self.mockRequestsPostConfigureHealthCheck.call_count, 1)
+
+    # parallel_sync sends the independent writes at once
+    def test_ensure_present_parallel_sync_not_applied(self):
+        mockModule = self.build_parallel_sync_module()
+        mockModule.params['filter_ip_addresses'] = ['192.168.0.3']
+        mockModule.params['health_check_target'] = 'ICMP'
+        mockModule.params['ssl_policy_name'] = 'Standard Ciphers A ver1'
+
+        with mock.patch(self.TARGET_DESCRIBE_CURRENT,
+                        self.mockDescribeLoadBalancers):
+            with mock.patch('requests.post',
+                            self.mockRequestsPostConfigureHealthCheck):
+                manager = nifcloud_lb.LoadBalancerManager(mockModule)
+                self.assertRaises(Exception, manager.ensure_present)
+
+        self.assertEqual(
+            self.mockRequestsPostConfigureHealthCheck.call_count, 3)
+        self.assertEqual(self.mockDescribeLoadBalancers.call_count, 2)
+        self.assertEqual(
+            mockModule.fail_json.call_args[1]['msg'],
+            'changes not applied '
+            '(sync_filter, sync_health_check, sync_ssl_policy)')
+
+    # parallel_sync internal error
+    def test_ensure_present_parallel_sync_internal_error(self):
+        mockModule = self.build_parallel_sync_module()
+        mockModule.params['health_check_target'] = 'ICMP'
+
+        with mock.patch(self.TARGET_DESCRIBE_CURRENT,
+                        self.mockDescribeLoadBalancers):
+            with mock.patch('requests.post',
+                            self.mockRequestsInternalServerError):
+                manager = nifcloud_lb.LoadBalancerManager(mockModule)
+                self.assertRaises(Exception, manager.ensure_present)
+
+        self.assertEqual(
+            mockModule.fail_json.call_args[1]['msg'],
+            'changes failed (sync_health_check)')
+        self.assertEqual(self.mockDescribeLoadBalancers.call_count, 1)
+
+    # parallel_sync in check mode
+    def test_ensure_present_parallel_sync_check_mode(self):
+        mockModule = self.build_parallel_sync_module()
+        mockModule.check_mode = True
+        mockModule.params['health_check_target'] = 'ICMP'
+
+        with mock.patch(self.TARGET_DESCRIBE_CURRENT,
+                        self.mockDescribeLoadBalancers):
+            with mock.patch('requests.post', self.mockRequestsError):
+                manager = nifcloud_lb.LoadBalancerManager(mockModule)
+                manager.ensure_present()
+
+        self.assertEqual(True, manager.changed)
+        self.assertEqual(self.mockRequestsError.call_count, 0)
+        self.assertEqual(self.mockDescribeLoadBalancers.call_count, 1)
+
+    def build_rolling_module(self):
+        mockModule = mock.MagicMock(
+            params=copy.deepcopy(self.mockModule.params),
+            fail_json=self.mockModule.fail_json,
+            check_mode=False,
+        )
+        mockModule.params['instance_ids'] = ['test002', 'test003']
+        mockModule.params['rolling'] = True
+        mockModule.params['rolling_wave_size'] = 1
+        mockModule.params['rolling_timeout'] = 60
+        return mockModule
+
+    # rolling registers waves and deregisters old instances after InService
+    def test_sync_instances_rolling(self):
+        mockModule = self.build_rolling_module()
+        mockRequestsGet = mock.MagicMock(side_effect=[
+            mock.MagicMock(status_code=200,
+                           text=self.xml['describeInstanceHealthOutOfService']),  # noqa
+            mock.MagicMock(status_code=200,
+                           text=self.xml['describeInstanceHealth']),
+            mock.MagicMock(status_code=200,
+                           text=self.xml['describeInstanceHealth']),
+        ])
+        calls = mock.MagicMock()
+
+        with mock.patch(self.TARGET_DESCRIBE_CURRENT,
+                        self.mockDescribeLoadBalancers):
+            with mock.patch(self.TARGET_REGISTER_INSTANCES,
+                            calls.register):
+                with mock.patch(self.TARGET_DEREGISTER_INSTANCES,
+                                calls.deregister):
+                    with mock.patch('requests.get', mockRequestsGet):
+                        manager = nifcloud_lb.LoadBalancerManager(mockModule)
+                        manager._sync_instances()
+
+        self.assertEqual(calls.mock_calls, [
+            mock.call.register(['test002']),
+            mock.call.deregister(['test001']),
+            mock.call.register(['test003']),
+        ])
+        self.assertEqual(mockRequestsGet.call_count, 3)
+        self.assertEqual(self.mock_time_sleep.call_count, 1)
+        self.assertEqual(manager.result['sync_instances']['waves'], [
+            dict(register_instance_ids=['test002'],
+                 deregister_instance_ids=['test001']),
+            dict(register_instance_ids=['test003'],
+                 deregister_instance_ids=[]),
+        ])
+
+    # rolling keeps old instances if a wave does not become InService
+    def test_sync_instances_rolling_timeout(self):
+        mockModule = self.build_rolling_module()
+        mockModule.params['wait_interval'] = 5
+        mockModule.params['wait_max_interval'] = 20
+        mockRequestsGet = mock.MagicMock(return_value=mock.MagicMock(
+            status_code=200,
+            text=self.xml['describeInstanceHealthOutOfService']))
+        calls = mock.MagicMock()
+
+        with mock.patch(self.TARGET_DESCRIBE_CURRENT,
+                        self.mockDescribeLoadBalancers):
+            with mock.patch(self.TARGET_REGISTER_INSTANCES,
+                            calls.register):
+                with mock.patch(self.TARGET_DEREGISTER_INSTANCES,
+                                calls.deregister):
+                    with mock.patch('requests.get', mockRequestsGet):
+                        manager = nifcloud_lb.LoadBalancerManager(mockModule)
+                        self.assertRaises(Exception, manager._sync_instances)
+
+        self.assertEqual(calls.mock_calls, [mock.call.register(['test002'])])
+        self.assertEqual(
+            [args[0][0] for args in self.mock_time_sleep.call_args_list],
+            [5, 10, 20, 20, 5])
+        self.assertEqual(
+            mockModule.fail_json.call_args[1]['instance_states'],
+            dict(test002='OutOfService'))
+
+    def build_coalesce_module(self, instance_ids):
+        coalesce_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, coalesce_dir)
+
+        mockModule = mock.MagicMock(
+            params=copy.deepcopy(self.mockModule.params),
+            fail_json=self.mockModule.fail_json,
+            check_mode=False,
+        )
+        mockModule.params['instance_ids'] = instance_ids
+        mockModule.params['coalesce'] = True
+        mockModule.params['coalesce_dir'] = coalesce_dir
+        mockModule.params['coalesce_window'] = 2
+        mockModule.params['coalesce_timeout'] = 5
+        return (mockModule, coalesce_dir)
+
+    # the leader registers the queued instance ids of the other forks
+    def test_ensure_present_coalesced_leader(self):
+        (mockModule, coalesce_dir) = self.build_coalesce_module(['test002'])
+        key = nifcloud_lb.get_coalesce_key(mockModule)
+        nifcloud_lb.enqueue_coalesce_entry(
+            os.path.join(coalesce_dir, key + '.queue'),
+            dict(id='follower', instance_ids=['test003', 'test002']))
+
+        registered = dict()
+
+        def ensure_present(module):
+            registered.update(module.params)
+            return dict(changed=True, status='present')
+
+        with mock.patch('nifcloud_lb.ensure_present', ensure_present):
+            result = nifcloud_lb.ensure_present_coalesced(mockModule)
+
+        self.assertEqual(registered['instance_ids'], ['test003', 'test002'])
+        self.assertEqual(registered['purge_instance_ids'], False)
+        self.assertEqual(result, dict(
+            changed=True, status='present', coalesced=False,
+            coalesced_instance_ids=['test003', 'test002']))
+        self.mock_time_sleep.assert_called_once_with(2)
+
+        with open(os.path.join(coalesce_dir,
+                               key + '.follower.json')) as fp:
+            self.assertEqual(json.load(fp), dict(
+                changed=True, status='present',
+                coalesced_instance_ids=['test003', 'test002']))
+
+    # the follower returns the result of the leader
+    def test_ensure_present_coalesced_follower(self):
+        (mockModule, coalesce_dir) = self.build_coalesce_module(['test003'])
+        key = nifcloud_lb.get_coalesce_key(mockModule)
+        result_path = os.path.join(coalesce_dir, key + '.follower.json')
+        nifcloud_lb.save_coalesced_result(result_path, dict(
+            changed=True, status='present',
+            coalesced_instance_ids=['test003', 'test002']))
+        mockEnsurePresent = mock.MagicMock()
+
+        with mock.patch('uuid.uuid4',
+                        mock.MagicMock(return_value=mock.MagicMock(
+                            hex='follower'))):
+            with mock.patch('nifcloud_lb.ensure_present',
+                            mockEnsurePresent):
+                result = nifcloud_lb.ensure_present_coalesced(mockModule)
+
+        self.assertEqual(result, dict(
+            changed=True, status='present', coalesced=True,
+            coalesced_instance_ids=['test003', 'test002']))
+        self.assertEqual(mockEnsurePresent.call_count, 0)
+        self.assertFalse(os.path.exists(result_path))
+
+    # the lock is held by the other fork
+    def test_ensure_present_coalesced_timeout(self):
+        (mockModule, coalesce_dir) = self.build_coalesce_module(['test002'])
+        lock_path = os.path.join(
+            coalesce_dir, nifcloud_lb.get_coalesce_key(mockModule) + '.lock')
+
+        with open(lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            with mock.patch('nifcloud_lb.ensure_present') as mockEnsure:
+                self.assertRaises(Exception,
+                                  nifcloud_lb.ensure_present_coalesced,
+                                  mockModule)
+                self.assertEqual(mockEnsure.call_count, 0)
+
+    # coalesce with listeners
+    def test_main_coalesce_listeners(self):
+        mockModule = self.build_listeners_module()
+        mockModule.params['coalesce'] = True
+
+        with mock.patch('nifcloud_lb.AnsibleModule',
+                        mock.MagicMock(return_value=mockModule)):
+            with mock.patch('nifcloud_lb.ensure_present') as mockEnsure:
+                self.assertRaises(Exception, nifcloud_lb.main)
+                self.assertEqual(mockEnsure.call_count, 0)
+
+    # coalesce: false with listeners
+    def test_main_no_coalesce_listeners(self):
+        mockModule = self.build_listeners_module()
+        mockModule.params['coalesce'] = False
+
+        with mock.patch('nifcloud_lb.AnsibleModule',
+                        mock.MagicMock(return_value=mockModule)):
+            with mock.patch('nifcloud_lb.ensure_present',
+                            mock.MagicMock(return_value=dict(
+                                changed=False))) as mockEnsure:
+                nifcloud_lb.main()
+
+        self.assertEqual(mockEnsure.call_count, 1)
+        mockModule.exit_json.assert_called_once_with(changed=False)
+
 nifcloud_api_response_sample = dict(
     describeLoadBalancers='''
 <DescribeLoadBalancersResponse xmlns="https://cp.cloud.nifty.com/api/">
@@ -1002,6 +1925,49 @@ nifcloud_api_response_sample = dict(
     <RequestId>ac501097-4c8d-475b-b06b-a90048ec181c</RequestId>
   </ResponseMetadata>
 </ConfigureHealthCheckResponse>
+''',  # noqa
+    describeInstanceHealth='''
+<DescribeInstanceHealthResponse xmlns="https://cp.cloud.nifty.com/api/">
+  <DescribeInstanceHealthResult>
+    <InstanceStates>
+      <member>
+        <InstanceId>test002</InstanceId>
+        <State>InService</State>
+        <ReasonCode>N/A</ReasonCode>
+        <Description>N/A</Description>
+        <instanceUniqueId>i-abvf1235</instanceUniqueId>
+      </member>
+      <member>
+        <InstanceId>test003</InstanceId>
+        <State>InService</State>
+        <ReasonCode>N/A</ReasonCode>
+        <Description>N/A</Description>
+        <instanceUniqueId>i-abvf1236</instanceUniqueId>
+      </member>
+    </InstanceStates>
+  </DescribeInstanceHealthResult>
+  <ResponseMetadata>
+    <RequestId>ac501097-4c8d-475b-b06b-a90048ec181c</RequestId>
+  </ResponseMetadata>
+</DescribeInstanceHealthResponse>
+''',  # noqa
+    describeInstanceHealthOutOfService='''
+<DescribeInstanceHealthResponse xmlns="https://cp.cloud.nifty.com/api/">
+  <DescribeInstanceHealthResult>
+    <InstanceStates>
+      <member>
+        <InstanceId>test002</InstanceId>
+        <State>OutOfService</State>
+        <ReasonCode>Instance</ReasonCode>
+        <Description>Instance has failed at least the UnhealthyThreshold number of health checks consecutively.</Description>
+        <instanceUniqueId>i-abvf1235</instanceUniqueId>
+      </member>
+    </InstanceStates>
+  </DescribeInstanceHealthResult>
+  <ResponseMetadata>
+    <RequestId>ac501097-4c8d-475b-b06b-a90048ec181c</RequestId>
+  </ResponseMetadata>
+</DescribeInstanceHealthResponse>
 ''',  # noqa
     internalServerError='''
 <Response>
@@ -0,0 +1,478 @@
+# Copyright Fujitsu
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import types
+import unittest
+
+import mock
+import nifcloud_lb_facts
+from ansible.module_utils.six.moves.urllib.parse import parse_qsl
+
+sys.path.append('.')
+sys.path.append('..')
+
+
+class TestNifcloud(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.cache_dir)
+
+        self.mockModule = mock.MagicMock(
+            params=dict(
+                access_key='ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789',
+                secret_access_key='ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789',
+                endpoint='west-1.cp.cloud.nifty.com',
+                loadbalancer_names=[],
+                cache=False,
+                cache_dir=self.cache_dir,
+                cache_max_age=300,
+            ),
+            fail_json=mock.MagicMock(side_effect=Exception('failed')),
+            check_mode=False,
+        )
+
+        self.xml = nifcloud_api_response_sample
+
+        self.mockRequestsGetDescribeLoadBalancers = mock.MagicMock(
+            return_value=mock.MagicMock(
+                status_code=200,
+                text=self.xml['describeLoadBalancers']
+            ))
+
+        self.mockRequestsGetDescribeLoadBalancersNameNotFound = mock.MagicMock(
+            return_value=mock.MagicMock(
+                status_code=500,
+                text=self.xml['describeLoadBalancersNameNotFound']
+            ))
+
+        self.mockRequestsInternalServerError = mock.MagicMock(
+            return_value=mock.MagicMock(
+                status_code=500,
+                text=self.xml['internalServerError']
+            ))
+
+        self.mockRequestsError = mock.MagicMock(return_value=None)
+
+    # calculate signature
+    def test_calculate_signature(self):
+        params = dict(
+            Action='DescribeLoadBalancers',
+            AccessKeyId=self.mockModule.params['access_key'],
+            SignatureMethod='HmacSHA256',
+            SignatureVersion='2',
+        )
+
+        signature = nifcloud_lb_facts.calculate_signature(
+            self.mockModule.params['secret_access_key'],
+            'GET',
+            self.mockModule.params['endpoint'],
+            '/api/',
+            params
+        )
+        self.assertEqual(signature,
+                         b'spq6n8gdx5j17CnUXsR2U5OdehAHs1jJMJ42kiGnZMw=')
+
+    # method get
+    def test_request_to_api_get(self):
+        with mock.patch('requests.get',
+                        self.mockRequestsGetDescribeLoadBalancers):
+            info = nifcloud_lb_facts.request_to_api(
+                self.mockModule, 'GET', 'DescribeLoadBalancers', dict())
+
+        self.assertEqual(info['status'], 200)
+        self.assertEqual(info['body'],
+                         self.xml['describeLoadBalancers'].encode('utf-8'))
+
+    # method failed
+    def test_request_to_api_unknown(self):
+        self.assertRaises(
+            Exception,
+            nifcloud_lb_facts.request_to_api,
+            self.mockModule, 'POST', 'DescribeLoadBalancers', dict()
+        )
+
+    # network error
+    def test_request_to_api_request_error(self):
+        with mock.patch('requests.get', self.mockRequestsError):
+            self.assertRaises(
+                Exception,
+                nifcloud_lb_facts.request_to_api,
+                self.mockModule, 'GET', 'DescribeLoadBalancers', dict()
+            )
+
+    # describe all the load balancers
+    def test_describe_load_balancers(self):
+        with mock.patch('requests.get',
+                        self.mockRequestsGetDescribeLoadBalancers):
+            load_balancers = nifcloud_lb_facts.describe_load_balancers(
+                self.mockModule)
+
+        self.assertEqual(
+            self.mockRequestsGetDescribeLoadBalancers.call_count, 1)
+        self.assertEqual(
+            [lb['loadbalancer_name'] for lb in load_balancers],
+            ['lb000', 'lb001'])
+
+        lb000 = load_balancers[0]
+        self.assertEqual(lb000['dns_name'], '111.171.200.1')
+        self.assertEqual(lb000['network_volume'], 10)
+        self.assertEqual(lb000['accounting_type'], '1')
+        self.assertEqual(lb000['listeners'], [dict(
+            loadbalancer_port=80,
+            instance_port=80,
+            protocol='HTTP',
+            balancing_type=1,
+            ssl_policy_name='',
+            instance_ids=[],
+            health_check=dict(target='TCP:80', interval=300,
+                              unhealthy_threshold=3, instance_states=[]),
+            filter=dict(filter_type=1, ip_addresses=[]),
+        )])
+
+        # the listeners of a load balancer are grouped
+        lb001 = load_balancers[1]
+        self.assertEqual(
+            [(listener['loadbalancer_port'], listener['instance_port'])
+             for listener in lb001['listeners']],
+            [(80, 80), (443, 443)])
+        self.assertEqual(lb001['listeners'][0]['instance_ids'],
+                         ['test001', 'test002'])
+        self.assertEqual(
+            lb001['listeners'][0]['health_check']['instance_states'],
+            [dict(instance_id='test001', state='InService'),
+             dict(instance_id='test002', state='OutOfService')])
+        self.assertEqual(lb001['listeners'][0]['filter'],
+                         dict(filter_type=1,
+                              ip_addresses=['111.111.111.111',
+                                            '111.111.111.112']))
+        self.assertEqual(lb001['listeners'][1]['ssl_policy_name'],
+                         'Standard Ciphers A ver1')
+        self.assertEqual(lb001['listeners'][1]['balancing_type'], 2)
+
+    # describe the named load balancers
+    def test_describe_load_balancers_names(self):
+        self.mockModule.params['loadbalancer_names'] = ['lb001']
+
+        with mock.patch('requests.get',
+                        self.mockRequestsGetDescribeLoadBalancers):
+            load_balancers = nifcloud_lb_facts.describe_load_balancers(
+                self.mockModule)
+
+        url = self.mockRequestsGetDescribeLoadBalancers.call_args[0][0]
+        params = dict(parse_qsl(url.split('?')[1]))
+        self.assertEqual(params['LoadBalancerNames.member.1'], 'lb001')
+        self.assertEqual(
+            [lb['loadbalancer_name'] for lb in load_balancers], ['lb001'])
+
+    # describe all when some of the named load balancers do not exist
+    def test_describe_load_balancers_name_not_found(self):
+        self.mockModule.params['loadbalancer_names'] = ['lb001', 'lb002']
+        mockGet = mock.MagicMock(side_effect=[
+            self.mockRequestsGetDescribeLoadBalancersNameNotFound(),
+            self.mockRequestsGetDescribeLoadBalancers(),
+        ])
+
+        with mock.patch('requests.get', mockGet):
+            load_balancers = nifcloud_lb_facts.describe_load_balancers(
+                self.mockModule)
+
+        self.assertEqual(mockGet.call_count, 2)
+        params = dict(parse_qsl(mockGet.call_args[0][0].split('?')[1]))
+        self.assertNotIn('LoadBalancerNames.member.1', params)
+        self.assertEqual(
+            [lb['loadbalancer_name'] for lb in load_balancers], ['lb001'])
+
+    # describe failed
+    def test_describe_load_balancers_error(self):
+        with mock.patch('requests.get', self.mockRequestsInternalServerError):
+            self.assertRaises(
+                Exception,
+                nifcloud_lb_facts.describe_load_balancers,
+                self.mockModule
+            )
+
+        kwargs = self.mockModule.fail_json.call_args[1]
+        self.assertEqual(kwargs['msg'], 'describe load balancers failed')
+        self.assertEqual(kwargs['error_code'], 'Server.InternalError')
+
+    # the response is parsed member by member
+    def test_parse_load_balancer_descriptions(self):
+        listeners = nifcloud_lb_facts.parse_load_balancer_descriptions(
+            self.xml['describeLoadBalancers'].encode('utf-8'))
+
+        self.assertTrue(isinstance(listeners, types.GeneratorType))
+        self.assertEqual(next(listeners)['loadbalancer_name'], 'lb000')
+        self.assertEqual(
+            [listener['loadbalancer_name'] for listener in listeners],
+            ['lb001', 'lb001'])
+
+    # facts without cache
+    def test_get_load_balancer_facts(self):
+        with mock.patch('requests.get',
+                        self.mockRequestsGetDescribeLoadBalancers):
+            facts = nifcloud_lb_facts.get_load_balancer_facts(self.mockModule)
+            facts = nifcloud_lb_facts.get_load_balancer_facts(self.mockModule)
+
+        self.assertEqual(False, facts['cached'])
+        self.assertEqual(len(facts['load_balancers']), 2)
+        self.assertEqual(
+            self.mockRequestsGetDescribeLoadBalancers.call_count, 2)
+        self.assertEqual(os.listdir(self.cache_dir), [])
+
+    # facts are reused from cache
+    def test_get_load_balancer_facts_cache_hit(self):
+        self.mockModule.params['cache'] = True
+
+        with mock.patch('requests.get',
+                        self.mockRequestsGetDescribeLoadBalancers):
+            miss = nifcloud_lb_facts.get_load_balancer_facts(self.mockModule)
+            hit = nifcloud_lb_facts.get_load_balancer_facts(self.mockModule)
+
+        self.assertEqual(False, miss['cached'])
+        self.assertEqual(True, hit['cached'])
+        self.assertEqual(miss['load_balancers'], hit['load_balancers'])
+        self.assertEqual(
+            self.mockRequestsGetDescribeLoadBalancers.call_count, 1)
+
+        # the secret access key is not saved
+        (cache_file,) = os.listdir(self.cache_dir)
+        with open(os.path.join(self.cache_dir, cache_file)) as fp:
+            saved = fp.read()
+        self.assertNotIn(self.mockModule.params['secret_access_key'], saved)
+        self.assertEqual(json.loads(saved)['load_balancers'],
+                         miss['load_balancers'])
+
+    # facts are described again when the cache is expired
+    def test_get_load_balancer_facts_cache_expired(self):
+        self.mockModule.params['cache'] = True
+
+        with mock.patch('requests.get',
+                        self.mockRequestsGetDescribeLoadBalancers):
+            nifcloud_lb_facts.get_load_balancer_facts(self.mockModule)
+            with mock.patch('time.time',
+                            mock.MagicMock(return_value=time.time() + 301)):
+                facts = nifcloud_lb_facts.get_load_balancer_facts(
+                    self.mockModule)
+
+        self.assertEqual(False, facts['cached'])
+        self.assertEqual(
+            self.mockRequestsGetDescribeLoadBalancers.call_count, 2)
+
+    # facts of the other load balancers are cached separately
+    def test_get_load_balancer_facts_cache_names(self):
+        self.mockModule.params['cache'] = True
+
+        with mock.patch('requests.get',
+                        self.mockRequestsGetDescribeLoadBalancers):
+            nifcloud_lb_facts.get_load_balancer_facts(self.mockModule)
+            self.mockModule.params['loadbalancer_names'] = ['lb001']
+            facts = nifcloud_lb_facts.get_load_balancer_facts(self.mockModule)
+
+        self.assertEqual(False, facts['cached'])
+        self.assertEqual(
+            [lb['loadbalancer_name'] for lb in facts['load_balancers']],
+            ['lb001'])
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+    # cache_dir can not be created
+    def test_get_load_balancer_facts_cache_dir_error(self):
+        self.mockModule.params['cache'] = True
+        path = os.path.join(self.cache_dir, 'file')
+        open(path, 'w').close()
+        self.mockModule.params['cache_dir'] = os.path.join(path, 'cache')
+
+        self.assertRaises(
+            Exception,
+            nifcloud_lb_facts.get_load_balancer_facts,
+            self.mockModule
+        )
+
+        kwargs = self.mockModule.fail_json.call_args[1]
+        self.assertEqual(kwargs['msg'], 'cache_dir can not be created')
+
+
+nifcloud_api_response_sample = dict(
+    describeLoadBalancers='''
+<DescribeLoadBalancersResponse xmlns="https://cp.cloud.nifty.com/api/">
+<DescribeLoadBalancersResult>
+ <LoadBalancerDescriptions>
+  <member>
+  <LoadBalancerName>lb000</LoadBalancerName>
+  <DNSName>111.171.200.1</DNSName>
+  <NetworkVolume>10</NetworkVolume>
+  <ListenerDescriptions>
+   <member>
+   <Listener>
+    <Protocol>HTTP</Protocol>
+    <LoadBalancerPort>80</LoadBalancerPort>
+    <InstancePort>80</InstancePort>
+    <balancingType>1</balancingType>
+   </Listener>
+   </member>
+  </ListenerDescriptions>
+  <Instances>
+  </Instances>
+  <HealthCheck>
+   <Target>TCP:80</Target>
+   <Interval>300</Interval>
+   <Timeout>900</Timeout>
+   <UnhealthyThreshold>3</UnhealthyThreshold>
+   <HealthyThreshold>1</HealthyThreshold>
+  </HealthCheck>
+  <Filter>
+   <FilterType>1</FilterType>
+   <IPAddresses>
+    <member>
+     <IPAddress>*.*.*.*</IPAddress>
+    </member>
+   </IPAddresses>
+  </Filter>
+  <CreatedTime>2010-05-17T11:22:33.456Z</CreatedTime>
+  <AccountingType>1</AccountingType>
+  </member>
+  <member>
+  <LoadBalancerName>lb001</LoadBalancerName>
+  <DNSName>111.171.200.2</DNSName>
+  <NetworkVolume>20</NetworkVolume>
+  <ListenerDescriptions>
+   <member>
+   <Listener>
+    <Protocol>HTTP</Protocol>
+    <LoadBalancerPort>80</LoadBalancerPort>
+    <InstancePort>80</InstancePort>
+    <balancingType>1</balancingType>
+   </Listener>
+   </member>
+  </ListenerDescriptions>
+  <Instances>
+   <member>
+   <InstanceId>test001</InstanceId>
+   <InstanceUniqueId>i-asdg1234</InstanceUniqueId>
+   </member>
+   <member>
+   <InstanceId>test002</InstanceId>
+   <InstanceUniqueId>i-asdg1235</InstanceUniqueId>
+   </member>
+  </Instances>
+  <HealthCheck>
+   <Target>TCP:80</Target>
+   <Interval>300</Interval>
+   <Timeout>900</Timeout>
+   <UnhealthyThreshold>3</UnhealthyThreshold>
+   <HealthyThreshold>1</HealthyThreshold>
+   <InstanceStates>
+    <member>
+     <InstanceId>test001</InstanceId>
+     <InstanceUniqueId>i-asdg1234</InstanceUniqueId>
+     <State>InService</State>
+     <ResponseCode />
+     <Description />
+    </member>
+    <member>
+     <InstanceId>test002</InstanceId>
+     <InstanceUniqueId>i-asdg1235</InstanceUniqueId>
+     <State>OutOfService</State>
+     <ResponseCode />
+     <Description />
+    </member>
+   </InstanceStates>
+  </HealthCheck>
+  <Filter>
+   <FilterType>1</FilterType>
+   <IPAddresses>
+    <member>
+     <IPAddress>111.111.111.111</IPAddress>
+     <IPAddress>111.111.111.112</IPAddress>
+    </member>
+   </IPAddresses>
+  </Filter>
+  <CreatedTime>2010-05-17T11:22:33.456Z</CreatedTime>
+  <AccountingType>2</AccountingType>
+  </member>
+  <member>
+  <LoadBalancerName>lb001</LoadBalancerName>
+  <DNSName>111.171.200.2</DNSName>
+  <NetworkVolume>20</NetworkVolume>
+  <ListenerDescriptions>
+   <member>
+   <Listener>
+    <Protocol>HTTPS</Protocol>
+    <LoadBalancerPort>443</LoadBalancerPort>
+    <InstancePort>443</InstancePort>
+    <balancingType>2</balancingType>
+    <SSLPolicy>
+     <SSLPolicyId>1</SSLPolicyId>
+     <SSLPolicyName>Standard Ciphers A ver1</SSLPolicyName>
+    </SSLPolicy>
+   </Listener>
+   </member>
+  </ListenerDescriptions>
+  <Instances>
+   <member>
+   <InstanceId>test001</InstanceId>
+   <InstanceUniqueId>i-asdg1234</InstanceUniqueId>
+   </member>
+  </Instances>
+  <HealthCheck>
+   <Target>TCP:443</Target>
+   <Interval>300</Interval>
+   <Timeout>900</Timeout>
+   <UnhealthyThreshold>3</UnhealthyThreshold>
+   <HealthyThreshold>1</HealthyThreshold>
+  </HealthCheck>
+  <Filter>
+   <FilterType>1</FilterType>
+  </Filter>
+  <CreatedTime>2010-05-17T11:22:33.456Z</CreatedTime>
+  <AccountingType>2</AccountingType>
+  </member>
+ </LoadBalancerDescriptions>
+ </DescribeLoadBalancersResult>
+  <ResponseMetadata>
+    <RequestId>f6dd8353-eb6b-6b4fd32e4f05</RequestId>
+  </ResponseMetadata>
+</DescribeLoadBalancersResponse>
+''',
+    describeLoadBalancersNameNotFound='''
+<Response>
+ <Errors>
+  <Error>
+   <Code>Client.InvalidParameterNotFound.LoadBalancer</Code>
+   <Message>The LoadBalancerName 'lb002' does not exist.</Message>
+  </Error>
+ </Errors>
+ <RequestID>5ec8da0a-6e23-4343-b474-ca0bb5c22a51</RequestID>
+</Response>
+''',
+    internalServerError='''
+<Response>
+ <Errors>
+  <Error>
+   <Code>Server.InternalError</Code>
+   <Message>An error has occurred. Please try again later.</Message>
+  </Error>
+ </Errors>
+ <RequestID>5ec8da0a-6e23-4343-b474-ca0bb5c22a51</RequestID>
+</Response>
+'''
+)
+
+if __name__ == '__main__':
+    unittest.main()
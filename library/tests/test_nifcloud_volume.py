@@ -19,6 +19,7 @@ import xml.etree.ElementTree as etree
 
 import mock
 import nifcloud_volume
+from ansible.module_utils.six.moves.urllib.parse import parse_qsl
 
 sys.path.append('.')
 sys.path.append('..')
@@ -75,6 +76,8 @@ class TestNifcloud(unittest.TestCase):
         self.addCleanup(patcher.stop)
         self.mock_time_sleep = patcher.start()
 
+        nifcloud_volume.API_CALLS.clear()
+
     # calculate signature
     def test_calculate_signature(self):
         secret_access_key = self.mockModule.params['secret_access_key']
@@ -148,6 +151,17 @@ class TestNifcloud(unittest.TestCase):
             etree.tostring(etree.fromstring(self.xml['describeVolumes']))
         )
 
+    # api calls are counted by action
+    def test_request_to_api_count(self):
+        with mock.patch('requests.get', self.mockRequestsGetDescribeVolumes):
+            for action in ['DescribeVolumes', 'DescribeVolumes',
+                           'AttachVolume']:
+                nifcloud_volume.request_to_api(self.mockModule, 'GET',
+                                               action, dict())
+
+        self.assertEqual(nifcloud_volume.API_CALLS,
+                         dict(DescribeVolumes=2, AttachVolume=1))
+
     # api error
     def test_request_to_api_error(self):
         method = 'GET'
@@ -238,6 +252,21 @@ class TestNifcloud(unittest.TestCase):
                 nifcloud_volume.get_volume_state(self.mockModule)
             )
 
+    # parse volume item
+    def test_parse_volume_item(self):
+        nc = '{{{0}}}'.format(self.xmlnamespace)
+        xml_body = etree.fromstring(self.build_describe_volumes([
+            ('disk01', 'attached', 'test001'),
+            ('disk02', 'available', None),
+        ]))
+
+        self.assertEqual(
+            [nifcloud_volume.parse_volume_item(item, nc) for item
+             in nifcloud_volume.iter_volume_items(xml_body, nc)],
+            [('disk01', ('attached', 'test001')),
+             ('disk02', ('available', None))]
+        )
+
     # create volume success
     def test_create_volume_success(self):
         with mock.patch('nifcloud_volume.get_volume_state',
@@ -249,6 +278,44 @@ class TestNifcloud(unittest.TestCase):
                     nifcloud_volume.create_volume(self.mockModule)
                 )
 
+    # create volume without volume_id
+    def test_create_volume_without_volume_id(self):
+        self.mockModule.params['volume_id'] = None
+        mockGetVolumeState = mock.MagicMock(
+            return_value=('attached', 'test001'))
+        result = dict()
+
+        with mock.patch('nifcloud_volume.get_volume_state',
+                        mockGetVolumeState):
+            with mock.patch('requests.get',
+                            self.mockRequestsGetCreateVolume):
+                self.assertEqual(
+                    (True, 'created'),
+                    nifcloud_volume.create_volume(self.mockModule, result)
+                )
+
+        # the volume id of the response is polled
+        mockGetVolumeState.assert_called_with(self.mockModule, 'disk01')
+        self.assertEqual(result['seconds_to_attached'], 5)
+
+    # create volume wait timeout
+    def test_create_volume_wait_timeout(self):
+        self.mockModule.params['wait_timeout'] = 30
+        with mock.patch('nifcloud_volume.get_volume_state',
+                        mock.MagicMock(return_value=('creating', None))):
+            with mock.patch('requests.get',
+                            self.mockRequestsGetCreateVolume):
+                self.assertRaises(
+                    Exception,
+                    nifcloud_volume.create_volume,
+                    (self.mockModule)
+                )
+
+        kwargs = self.mockModule.fail_json.call_args[1]
+        self.assertEqual(kwargs['msg'], 'changes failed (create_volume)')
+        self.assertEqual(kwargs['current_state'], 'creating')
+        self.assertEqual(kwargs['seconds_to_attached'], 30)
+
     # create volume (check_mode)
     def test_create_volume_check_mode(self):
         mockModule = mock.MagicMock(
@@ -295,6 +362,73 @@ class TestNifcloud(unittest.TestCase):
                     nifcloud_volume.attach_volume(self.mockModule)
                 )
 
+    # attach volume without polling the state of the response
+    def test_attach_volume_api_calls(self):
+        (mockGet, calls) = self.build_requests_get(dict(
+            DescribeVolumes=[
+                (200, self.build_describe_volumes([
+                    ('disk01', 'available', None),
+                ])),
+            ],
+            AttachVolume=[(200, self.xml['attachVolume'])],
+        ))
+
+        with mock.patch('requests.get', mockGet):
+            self.assertEqual(
+                (True, 'attached'),
+                nifcloud_volume.attach_volume(self.mockModule)
+            )
+
+        self.assertEqual(nifcloud_volume.API_CALLS,
+                         dict(DescribeVolumes=1, AttachVolume=1))
+        self.assertEqual(self.mock_time_sleep.call_count, 0)
+
+    # attach volume polled without the state in the response
+    def test_attach_volume_response_without_status(self):
+        (mockGet, calls) = self.build_requests_get(dict(
+            DescribeVolumes=[
+                (200, self.build_describe_volumes([
+                    ('disk01', 'available', None),
+                ])),
+                (200, self.build_describe_volumes([
+                    ('disk01', 'attached', 'test001'),
+                ])),
+            ],
+            AttachVolume=[(200, self.xml['attachVolume'].replace(
+                '<status>attached</status>', ''))],
+        ))
+
+        with mock.patch('requests.get', mockGet):
+            self.assertEqual(
+                (True, 'attached'),
+                nifcloud_volume.attach_volume(self.mockModule)
+            )
+
+        self.assertEqual(nifcloud_volume.API_CALLS,
+                         dict(DescribeVolumes=2, AttachVolume=1))
+
+    # create volume with one poll
+    def test_attach_volume_absent_api_calls(self):
+        (mockGet, calls) = self.build_requests_get(dict(
+            DescribeVolumes=[
+                (200, self.build_describe_volumes([])),
+                (200, self.build_describe_volumes([
+                    ('disk01', 'attached', 'test001'),
+                ])),
+            ],
+            CreateVolume=[(200, self.xml['createVolume'])],
+        ))
+
+        with mock.patch('requests.get', mockGet):
+            self.assertEqual(
+                (True, 'created'),
+                nifcloud_volume.attach_volume(self.mockModule)
+            )
+
+        self.assertEqual(nifcloud_volume.API_CALLS,
+                         dict(DescribeVolumes=2, CreateVolume=1))
+        self.assertEqual(self.mock_time_sleep.call_count, 1)
+
     # attach volume (check_mode)
     def test_attach_volume_check_mode(self):
         mockModule = mock.MagicMock(
@@ -340,15 +474,606 @@ class TestNifcloud(unittest.TestCase):
                 (self.mockModule)
             )
 
-    # detach volume
-    def test_detach_volume(self):
+    # attach volume waits until attached
+    def test_attach_volume_wait(self):
+        mockGetVolumeState = mock.MagicMock(side_effect=[
+            ('available', None),
+            ('attached', 'test001'),
+        ])
+        result = dict()
+
+        with mock.patch('nifcloud_volume.get_volume_state',
+                        mockGetVolumeState):
+            with mock.patch('requests.get', mock.MagicMock(
+                    return_value=mock.MagicMock(
+                        status_code=200,
+                        text=self.xml['attachVolume'].replace(
+                            '<status>attached</status>',
+                            '<status>attaching</status>')))):
+                self.assertEqual(
+                    (True, 'attached'),
+                    nifcloud_volume.attach_volume(self.mockModule, result)
+                )
+
+        self.assertEqual(self.mock_time_sleep.call_count, 1)
+        self.assertEqual(result, dict(seconds_to_attached=5))
+
+    # wait for volume attached at the first poll
+    def test_wait_for_volume_attached_first_poll(self):
+        with mock.patch('nifcloud_volume.get_volume_state',
+                        mock.MagicMock(return_value=('attached', 'test001'))):
+            self.assertEqual(
+                ('attached', 'test001', 5),
+                nifcloud_volume.wait_for_volume(self.mockModule)
+            )
+
+        # the first poll is sent after wait_interval
+        self.assertEqual(self.mock_time_sleep.call_count, 1)
+
+    # wait for volume attached with backoff
+    def test_wait_for_volume_attached_backoff(self):
+        self.mockModule.params['wait_interval'] = 2
+        self.mockModule.params['wait_max_interval'] = 10
+        mockGetVolumeState = mock.MagicMock(
+            side_effect=[('attaching', None)] * 4 + [('attached', 'test001')])
+
+        with mock.patch('nifcloud_volume.get_volume_state',
+                        mockGetVolumeState):
+            (current_state, instance_id, elapsed) = \
+                nifcloud_volume.wait_for_volume(self.mockModule)
+
+        self.assertEqual(current_state, 'attached')
+        self.assertEqual(
+            [args[0][0] for args in self.mock_time_sleep.call_args_list],
+            [2, 4, 8, 10, 10])
+        self.assertEqual(elapsed, 34)
+
+    # wait for volume attached until the deadline
+    def test_wait_for_volume_attached_timeout(self):
+        self.mockModule.params['wait_timeout'] = 30
+
+        with mock.patch('nifcloud_volume.get_volume_state',
+                        mock.MagicMock(return_value=('attaching', None))):
+            (current_state, instance_id, elapsed) = \
+                nifcloud_volume.wait_for_volume(self.mockModule)
+
+        self.assertEqual(current_state, 'attaching')
+        self.assertEqual(
+            [args[0][0] for args in self.mock_time_sleep.call_args_list],
+            [5, 10, 15])
+        self.assertEqual(elapsed, 30)
+
+    # wait for volume attached stops at error states
+    def test_wait_for_volume_attached_error(self):
+        mockGetVolumeState = mock.MagicMock(
+            side_effect=[('attaching', None), ('error', None)])
+
+        with mock.patch('nifcloud_volume.get_volume_state',
+                        mockGetVolumeState):
+            (current_state, instance_id, elapsed) = \
+                nifcloud_volume.wait_for_volume(self.mockModule)
+
+        self.assertEqual(current_state, 'error')
+        self.assertEqual(mockGetVolumeState.call_count, 2)
+        self.assertEqual(self.mock_time_sleep.call_count, 2)
+
+    def build_describe_volumes(self, volumes):
+        items = ''
+        for (volume_id, status, instance_id) in volumes:
+            attachment = ''
+            if instance_id is not None:
+                attachment = VOLUME_ATTACHMENT_TEMPLATE.format(
+                    volume_id=volume_id, instance_id=instance_id,
+                    status=status)
+                status = 'in-use'
+            items += VOLUME_ITEM_TEMPLATE.format(
+                volume_id=volume_id, status=status, attachment=attachment)
+        return DESCRIBE_VOLUMES_TEMPLATE.format(items=items)
+
+    def build_requests_get(self, responses):
+        # responses of each action are returned in order, and the last one
+        # is repeated
+        calls = []
+
+        def get(url):
+            params = dict(parse_qsl(url.split('?')[1]))
+            calls.append(params)
+            queue = responses[params['Action']]
+            (status_code, text) = queue.pop(0) if len(queue) > 1 \
+                else queue[0]
+            return mock.MagicMock(status_code=status_code, text=text)
+
+        return (mock.MagicMock(side_effect=get), calls)
+
+    def build_volumes_module(self, volumes, check_mode=False):
+        mockModule = mock.MagicMock(
+            params=copy.deepcopy(self.mockModule.params),
+            fail_json=self.mockModule.fail_json,
+            check_mode=check_mode,
+        )
+        mockModule.params['volume_id'] = None
+        mockModule.params['instance_id'] = None
+        mockModule.params['volumes'] = volumes
+        mockModule.params['volumes_max_workers'] = 2
+        return mockModule
+
+    # describe volumes at once
+    def test_describe_volumes(self):
+        (mockGet, calls) = self.build_requests_get(dict(DescribeVolumes=[
+            (200, self.build_describe_volumes([
+                ('disk01', 'attached', 'test001'),
+                ('disk02', 'available', None),
+                ('disk09', 'available', None),
+            ])),
+        ]))
+
+        with mock.patch('requests.get', mockGet):
+            states = nifcloud_volume.describe_volumes(
+                self.mockModule, ['disk01', 'disk02', 'disk03'])
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(
+            [calls[0]['VolumeId.{0}'.format(i)] for i in (1, 2, 3)],
+            ['disk01', 'disk02', 'disk03'])
+        self.assertEqual(states, dict(
+            disk01=('attached', 'test001'),
+            disk02=('available', None),
+        ))
+
+    # describe all volumes when some of them do not exist
+    def test_describe_volumes_not_found(self):
+        (mockGet, calls) = self.build_requests_get(dict(DescribeVolumes=[
+            (400, self.xml['volumeNotFound']),
+            (200, self.build_describe_volumes([
+                ('disk01', 'attached', 'test001'),
+            ])),
+        ]))
+
+        with mock.patch('requests.get', mockGet):
+            states = nifcloud_volume.describe_volumes(
+                self.mockModule, ['disk01', 'disk02'])
+
+        self.assertEqual(len(calls), 2)
+        self.assertNotIn('VolumeId.1', calls[1])
+        self.assertEqual(states, dict(disk01=('attached', 'test001')))
+
+    # describe volumes failed without the fallback
+    def test_describe_volumes_error(self):
+        with mock.patch('requests.get', self.mockRequestsInternalServerError):
+            self.assertRaises(
+                Exception,
+                nifcloud_volume.describe_volumes,
+                self.mockModule, ['disk01']
+            )
+
+        self.assertEqual(self.mockRequestsInternalServerError.call_count, 1)
+        kwargs = self.mockModule.fail_json.call_args[1]
+        self.assertEqual(kwargs['error_code'], 'Server.InternalError')
+        self.assertEqual(kwargs['api_calls'], dict(DescribeVolumes=1))
+
+    # attach volumes with one describe and one batched poll
+    def test_attach_volumes(self):
+        mockModule = self.build_volumes_module([
+            dict(volume_id='disk01', instance_id='test001'),
+            dict(volume_id='disk02', instance_id='test002'),
+            dict(volume_id='disk03', instance_id='test003', size='200'),
+        ])
+        (mockGet, calls) = self.build_requests_get(dict(
+            DescribeVolumes=[
+                (200, self.build_describe_volumes([
+                    ('disk01', 'attached', 'test001'),
+                    ('disk02', 'available', None),
+                ])),
+                (200, self.build_describe_volumes([
+                    ('disk01', 'attached', 'test001'),
+                    ('disk02', 'attached', 'test002'),
+                    ('disk03', 'attached', 'test003'),
+                ])),
+            ],
+            AttachVolume=[(200, self.xml['attachVolume'].replace(
+                'attached', 'attaching'))],
+            CreateVolume=[(200, self.xml['createVolume'].replace(
+                'disk01', 'disk03'))],
+        ))
+
+        with mock.patch('requests.get', mockGet):
+            result = nifcloud_volume.attach_volumes(mockModule)
+
+        self.assertEqual(True, result['changed'])
+        self.assertEqual(
+            [(volume['volume_id'], volume['changed'], volume['status'])
+             for volume in result['volumes']],
+            [('disk01', False, 'attached'), ('disk02', True, 'attached'),
+             ('disk03', True, 'created')])
+        self.assertEqual(result['seconds_to_attached'], 5)
+
+        actions = [params['Action'] for params in calls]
+        self.assertEqual(actions.count('DescribeVolumes'), 2)
+        self.assertEqual(actions.count('AttachVolume'), 1)
+        self.assertEqual(actions.count('CreateVolume'), 1)
+        create_params = [params for params in calls
+                         if params['Action'] == 'CreateVolume'][0]
+        self.assertEqual(create_params['Size'], '200')
+        self.assertEqual(create_params['InstanceId'], 'test003')
+        # only the changed volumes are polled
+        poll_params = [params for params in calls
+                       if params['Action'] == 'DescribeVolumes'][1]
+        self.assertEqual(
+            sorted(value for (key, value) in poll_params.items()
+                   if key.startswith('VolumeId.')),
+            ['disk02', 'disk03'])
+        self.assertEqual(self.mock_time_sleep.call_count, 1)
+
+    # attach volumes (check_mode)
+    def test_attach_volumes_check_mode(self):
+        mockModule = self.build_volumes_module([
+            dict(volume_id='disk01', instance_id='test001'),
+            dict(volume_id='disk02', instance_id='test002'),
+        ], check_mode=True)
+        (mockGet, calls) = self.build_requests_get(dict(DescribeVolumes=[
+            (200, self.build_describe_volumes([
+                ('disk01', 'available', None),
+            ])),
+        ]))
+
+        with mock.patch('requests.get', mockGet):
+            result = nifcloud_volume.attach_volumes(mockModule)
+
+        self.assertEqual(True, result['changed'])
+        self.assertEqual(
+            [volume['status'] for volume in result['volumes']],
+            ['available', 'absent'])
+        self.assertEqual(len(calls), 1)
+
+    # attach volumes attached to the other instance
+    def test_attach_volumes_invalid_state(self):
+        mockModule = self.build_volumes_module([
+            dict(volume_id='disk01', instance_id='test002'),
+            dict(volume_id='disk02', instance_id='test002'),
+        ])
+        (mockGet, calls) = self.build_requests_get(dict(DescribeVolumes=[
+            (200, self.build_describe_volumes([
+                ('disk01', 'attached', 'test001'),
+                ('disk02', 'available', None),
+            ])),
+        ]))
+
+        with mock.patch('requests.get', mockGet):
+            self.assertRaises(
+                Exception,
+                nifcloud_volume.attach_volumes,
+                mockModule
+            )
+
+        self.assertEqual(len(calls), 1)
+        kwargs = mockModule.fail_json.call_args[1]
+        self.assertEqual(kwargs['volume_id'], 'disk01')
+
+    # attach volumes with request failed
+    def test_attach_volumes_request_failed(self):
+        mockModule = self.build_volumes_module([
+            dict(volume_id='disk02', instance_id='test002'),
+        ])
+        (mockGet, calls) = self.build_requests_get(dict(
+            DescribeVolumes=[
+                (200, self.build_describe_volumes([
+                    ('disk02', 'available', None),
+                ])),
+            ],
+            AttachVolume=[(500, self.xml['internalServerError'])],
+        ))
+
+        with mock.patch('requests.get', mockGet):
+            self.assertRaises(
+                Exception,
+                nifcloud_volume.attach_volumes,
+                mockModule
+            )
+
+        kwargs = mockModule.fail_json.call_args[1]
+        self.assertEqual(kwargs['msg'], 'changes failed (attach_volume)')
+        self.assertEqual(kwargs['volume_id'], 'disk02')
+        self.assertEqual(kwargs['changed'], False)
+        self.assertEqual(kwargs['api_calls'],
+                         dict(DescribeVolumes=1, AttachVolume=1))
+
+    # attach volumes wait timeout
+    def test_attach_volumes_wait_timeout(self):
+        mockModule = self.build_volumes_module([
+            dict(volume_id='disk02', instance_id='test002'),
+        ])
+        mockModule.params['wait_timeout'] = 30
+        (mockGet, calls) = self.build_requests_get(dict(
+            DescribeVolumes=[
+                (200, self.build_describe_volumes([
+                    ('disk02', 'available', None),
+                ])),
+                (200, self.build_describe_volumes([
+                    ('disk02', 'attaching', 'test002'),
+                ])),
+            ],
+            AttachVolume=[(200, self.xml['attachVolume'].replace(
+                'attached', 'attaching'))],
+        ))
+
+        with mock.patch('requests.get', mockGet):
+            self.assertRaises(
+                Exception,
+                nifcloud_volume.attach_volumes,
+                mockModule
+            )
+
+        kwargs = mockModule.fail_json.call_args[1]
+        self.assertEqual(kwargs['msg'], 'changes failed (attach_volumes)')
+        self.assertEqual(kwargs['volumes'][0]['status'], 'attaching')
+        self.assertEqual(kwargs['seconds_to_attached'], 30)
+        self.assertEqual(self.mock_time_sleep.call_count, 3)
+
+    # attach volumes without instance_id
+    def test_attach_volumes_invalid(self):
+        mockModule = self.build_volumes_module([dict(volume_id='disk01')])
+
+        self.assertRaises(
+            Exception,
+            nifcloud_volume.attach_volumes,
+            mockModule
+        )
+
+    # detach volume absent
+    def test_detach_volume_absent(self):
+        with mock.patch('nifcloud_volume.get_volume_state',
+                        mock.MagicMock(return_value=('absent', None))):
+            self.assertEqual(
+                (False, 'absent'),
+                nifcloud_volume.detach_volume(self.mockModule)
+            )
+
+    # detach and delete volume
+    def test_detach_volume_attached(self):
+        mockGetVolumeState = mock.MagicMock(side_effect=[
+            ('attached', 'test009'),
+            ('available', None),
+            ('absent', None),
+        ])
+        (mockGet, calls) = self.build_requests_get(dict(
+            DetachVolume=[(200, self.xml['detachVolume'])],
+            DeleteVolume=[(200, self.xml['deleteVolume'])],
+        ))
+        result = dict()
+
+        with mock.patch('nifcloud_volume.get_volume_state',
+                        mockGetVolumeState):
+            with mock.patch('requests.get', mockGet):
+                self.assertEqual(
+                    (True, 'absent'),
+                    nifcloud_volume.detach_volume(self.mockModule, result)
+                )
+
+        self.assertEqual([params['Action'] for params in calls],
+                         ['DetachVolume', 'DeleteVolume'])
+        # detached from the instance attached now
+        self.assertEqual(calls[0]['InstanceId'], 'test009')
+        self.assertEqual(calls[1]['VolumeId'], 'disk01')
+        self.assertEqual(result['seconds_to_absent'], 10)
+        self.assertEqual(self.mock_time_sleep.call_count, 2)
+
+    # delete available volume
+    def test_detach_volume_available(self):
+        mockGetVolumeState = mock.MagicMock(side_effect=[
+            ('available', None),
+            ('absent', None),
+        ])
+        (mockGet, calls) = self.build_requests_get(dict(
+            DeleteVolume=[(200, self.xml['deleteVolume'])],
+        ))
+
+        with mock.patch('nifcloud_volume.get_volume_state',
+                        mockGetVolumeState):
+            with mock.patch('requests.get', mockGet):
+                self.assertEqual(
+                    (True, 'absent'),
+                    nifcloud_volume.detach_volume(self.mockModule)
+                )
+
+        self.assertEqual([params['Action'] for params in calls],
+                         ['DeleteVolume'])
+
+    # detach volume (check_mode)
+    def test_detach_volume_check_mode(self):
+        mockModule = mock.MagicMock(
+            params=copy.deepcopy(self.mockModule.params),
+            check_mode=True,
+        )
+
+        with mock.patch('nifcloud_volume.get_volume_state',
+                        mock.MagicMock(return_value=('attached', 'test001'))):
+            with mock.patch('requests.get', self.mockRequestsError):
+                self.assertEqual(
+                    (True, 'attached'),
+                    nifcloud_volume.detach_volume(mockModule)
+                )
+
+        self.assertEqual(self.mockRequestsError.call_count, 0)
+
+    # detach volume unknown status
+    def test_detach_volume_unknown(self):
+        with mock.patch('nifcloud_volume.get_volume_state',
+                        mock.MagicMock(return_value=('creating', None))):
+            self.assertRaises(
+                Exception,
+                nifcloud_volume.detach_volume,
+                (self.mockModule)
+            )
+
+    # detach volume failed
+    def test_detach_volume_failed(self):
+        with mock.patch('nifcloud_volume.get_volume_state',
+                        mock.MagicMock(return_value=('attached', 'test001'))):
+            with mock.patch('requests.get',
+                            self.mockRequestsInternalServerError):
+                self.assertRaises(
+                    Exception,
+                    nifcloud_volume.detach_volume,
+                    (self.mockModule)
+                )
+
+        kwargs = self.mockModule.fail_json.call_args[1]
+        self.assertEqual(kwargs['msg'], 'changes failed (detach_volume)')
+        self.assertEqual(kwargs['error_code'], 'Server.InternalError')
+
+    # detach volume wait timeout
+    def test_detach_volume_wait_timeout(self):
+        self.mockModule.params['wait_timeout'] = 30
+        (mockGet, calls) = self.build_requests_get(dict(
+            DetachVolume=[(200, self.xml['detachVolume'])],
+        ))
+        mockGetVolumeState = mock.MagicMock(
+            side_effect=[('attached', 'test001')] +
+            [('detaching', 'test001')] * 4)
+
+        with mock.patch('nifcloud_volume.get_volume_state',
+                        mockGetVolumeState):
+            with mock.patch('requests.get', mockGet):
+                self.assertRaises(
+                    Exception,
+                    nifcloud_volume.detach_volume,
+                    (self.mockModule)
+                )
+
+        kwargs = self.mockModule.fail_json.call_args[1]
+        self.assertEqual(kwargs['msg'], 'changes failed (detach_volume)')
+        self.assertEqual(kwargs['current_state'], 'detaching')
+        self.assertEqual(kwargs['seconds_to_absent'], 30)
+
+    # detach and delete volumes with one describe for each wait
+    def test_detach_volumes(self):
+        mockModule = self.build_volumes_module([
+            dict(volume_id='disk01'),
+            dict(volume_id='disk02'),
+            dict(volume_id='disk03'),
+        ])
+        (mockGet, calls) = self.build_requests_get(dict(
+            DescribeVolumes=[
+                (200, self.build_describe_volumes([
+                    ('disk01', 'attached', 'test001'),
+                    ('disk02', 'available', None),
+                ])),
+                (200, self.build_describe_volumes([
+                    ('disk01', 'available', None),
+                    ('disk02', 'available', None),
+                ])),
+                (200, self.build_describe_volumes([])),
+            ],
+            DetachVolume=[(200, self.xml['detachVolume'])],
+            DeleteVolume=[(200, self.xml['deleteVolume'])],
+        ))
+
+        with mock.patch('requests.get', mockGet):
+            result = nifcloud_volume.detach_volumes(mockModule)
+
+        self.assertEqual(True, result['changed'])
+        self.assertEqual(
+            [(volume['volume_id'], volume['changed'], volume['status'])
+             for volume in result['volumes']],
+            [('disk01', True, 'absent'), ('disk02', True, 'absent'),
+             ('disk03', False, 'absent')])
+
+        actions = [params['Action'] for params in calls]
+        self.assertEqual(actions.count('DescribeVolumes'), 3)
+        self.assertEqual(actions.count('DetachVolume'), 1)
+        self.assertEqual(actions.count('DeleteVolume'), 2)
+        detach_params = [params for params in calls
+                         if params['Action'] == 'DetachVolume'][0]
+        self.assertEqual(detach_params['VolumeId'], 'disk01')
+        self.assertEqual(detach_params['InstanceId'], 'test001')
+        self.assertEqual(self.mock_time_sleep.call_count, 2)
+
+    # detach volumes (check_mode)
+    def test_detach_volumes_check_mode(self):
+        mockModule = self.build_volumes_module([
+            dict(volume_id='disk01'),
+            dict(volume_id='disk02'),
+        ], check_mode=True)
+        (mockGet, calls) = self.build_requests_get(dict(DescribeVolumes=[
+            (200, self.build_describe_volumes([
+                ('disk01', 'attached', 'test001'),
+            ])),
+        ]))
+
+        with mock.patch('requests.get', mockGet):
+            result = nifcloud_volume.detach_volumes(mockModule)
+
+        self.assertEqual(True, result['changed'])
+        self.assertEqual(
+            [volume['status'] for volume in result['volumes']],
+            ['attached', 'absent'])
+        self.assertEqual(len(calls), 1)
+
+    # detach volumes with delete failed
+    def test_detach_volumes_request_failed(self):
+        mockModule = self.build_volumes_module([
+            dict(volume_id='disk01'),
+            dict(volume_id='disk02'),
+        ])
+        (mockGet, calls) = self.build_requests_get(dict(
+            DescribeVolumes=[
+                (200, self.build_describe_volumes([
+                    ('disk01', 'available', None),
+                    ('disk02', 'available', None),
+                ])),
+            ],
+            DeleteVolume=[(200, self.xml['deleteVolume']),
+                          (500, self.xml['internalServerError'])],
+        ))
+
+        with mock.patch('requests.get', mockGet):
+            self.assertRaises(
+                Exception,
+                nifcloud_volume.detach_volumes,
+                mockModule
+            )
+
+        kwargs = mockModule.fail_json.call_args[1]
+        self.assertEqual(kwargs['msg'], 'changes failed (delete_volume)')
+        self.assertIn(kwargs['volume_id'], ('disk01', 'disk02'))
+        self.assertEqual(kwargs['changed'], True)
+
+    # detach volumes without volume_id
+    def test_detach_volumes_invalid(self):
+        mockModule = self.build_volumes_module([dict(instance_id='test001')])
+
         self.assertRaises(
             Exception,
-            nifcloud_volume.detach_volume,
-            (self.mockModule)
+            nifcloud_volume.detach_volumes,
+            mockModule
         )
 
 
+DESCRIBE_VOLUMES_TEMPLATE = '''
+<DescribeVolumesResponse xmlns="https://cp.cloud.nifty.com/api/">
+  <requestId>5f781c9f-ad69-4a20-a0bc-d3ebbeff6c75</requestId>
+  <volumeSet>{items}
+  </volumeSet>
+</DescribeVolumesResponse>
+'''
+
+VOLUME_ITEM_TEMPLATE = '''
+    <item>
+      <volumeId>{volume_id}</volumeId>
+      <size>100</size>
+      <diskType>High-Speed Storage A</diskType>
+      <status>{status}</status>{attachment}
+    </item>'''
+
+VOLUME_ATTACHMENT_TEMPLATE = '''
+      <attachmentSet>
+        <item>
+          <volumeId>{volume_id}</volumeId>
+          <instanceId>{instance_id}</instanceId>
+          <status>{status}</status>
+        </item>
+      </attachmentSet>'''
+
 nifcloud_api_response_sample = dict(
     describeVolumes='''
 <DescribeVolumesResponse xmlns="https://cp.cloud.nifty.com/api/">
@@ -403,6 +1128,34 @@ nifcloud_api_response_sample = dict(
   <status>attached</status>
   <attachTime>2010-05-17T11:22:33.456Z</attachTime>
 </AttachVolumeResponse>
+''',
+    detachVolume='''
+<DetachVolumeResponse xmlns="https://cp.cloud.nifty.com/api/">
+  <requestId>f6dd8353-eb6b-6b4fd32e4f05</requestId>
+  <volumeId>disk01</volumeId>
+  <instanceId>test001</instanceId>
+  <instanceUniqueId>i-abfd1234</instanceUniqueId>
+  <device>SCSI(0:1)</device>
+  <status>detaching</status>
+  <attachTime>2010-05-17T11:22:33.456Z</attachTime>
+</DetachVolumeResponse>
+''',
+    deleteVolume='''
+<DeleteVolumeResponse xmlns="https://cp.cloud.nifty.com/api/">
+  <requestId>f6dd8353-eb6b-6b4fd32e4f05</requestId>
+  <return>true</return>
+</DeleteVolumeResponse>
+''',
+    volumeNotFound='''
+<Response>
+ <Errors>
+  <Error>
+   <Code>Client.InvalidParameterNotFound.Volume</Code>
+   <Message>The VolumeId 'disk02' does not exist.</Message>
+  </Error>
+ </Errors>
+ <RequestID>5ec8da0a-6e23-4343-b474-ca0bb5c22a51</RequestID>
+</Response>
 ''',
     internalServerError='''
 <Response>